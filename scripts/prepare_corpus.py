@@ -3,10 +3,39 @@
 import json
 import gzip
 import os
+import sys
+import argparse
+from collections import deque
 from pathlib import Path
 from tqdm import tqdm
 from multiprocessing import Pool, cpu_count
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'retireval'))
+from parent_index import PARTS_FOLDER, write_part, build_parent_index
+
+try:
+    import orjson  # 較快的 JSON 編解碼；沒有安裝時退回標準函式庫
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:  # 只有 --codec zstd 時才需要
+    zstandard = None
+
+# 交給一個工作行程轉換與壓縮的區塊大小 (解壓縮後的位元組，切在行尾)
+CHUNK_BYTES = 32 * 2 ** 20
+
+if orjson is not None:
+    loads = orjson.loads
+    dumps = orjson.dumps
+else:
+    loads = json.loads
+
+    def dumps(doc):
+        return json.dumps(doc).encode('utf-8')
+
+
 def convert_document(doc):
     """將文檔轉換為 Pyserini 期望的格式"""
     return {
@@ -14,45 +43,260 @@ def convert_document(doc):
         "contents": doc["segment"],
         "title": doc["title"],
         "headings": doc["headings"],
-        "url": doc["url"]
+        "url": doc["url"],
+        "start_char": doc.get("start_char", -1),
+        "end_char": doc.get("end_char", -1)
     }
 
-def process_file(input_file):
-    """處理單個文件"""
-    output_file = Path("data/corpus/processed") / input_file.name
-    
-    # 計算總行數
-    with gzip.open(input_file, 'rt', encoding='utf-8') as f:
-        total_lines = sum(1 for _ in f)
-    
-    with gzip.open(input_file, 'rt', encoding='utf-8') as f_in:
-        with gzip.open(output_file, 'wt', encoding='utf-8') as f_out:
-            for line in tqdm(f_in, total=total_lines, desc=f"處理 {input_file.name}"):
-                doc = json.loads(line)
-                converted_doc = convert_document(doc)
-                f_out.write(json.dumps(converted_doc) + '\n')
+
+def output_name(input_file, codec):
+    name = input_file.name
+    return name[:-3] + '.zst' if codec == 'zstd' and name.endswith('.gz') else name
+
+
+def iter_chunks(input_file, chunk_bytes=CHUNK_BYTES):
+    """
+    以單一個循序讀取器解壓縮整個檔案 (每個檔案只解壓縮一次)，產生約 chunk_bytes 大小、切在行尾的區塊。
+    """
+    with gzip.open(input_file, 'rb') as f:
+        remainder = b''
+        while True:
+            block = f.read(chunk_bytes)
+            if not block:
+                break
+            block = remainder + block
+            cut = block.rfind(b'\n') + 1
+            remainder = block[cut:]
+            if cut:
+                yield block[:cut]
+        if remainder:
+            yield remainder
+
+
+def _compress(data, codec, level):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ImportError("--codec zstd requires zstandard. Install it with `pip install zstandard`.")
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return gzip.compress(data, compresslevel=level)
+
+
+def process_chunk(task):
+    """
+    轉換一個區塊的每一行並壓縮成獨立的 gzip member (或 zstd frame)，依序串接即為完整的輸出檔。
+    回傳 (壓縮後的位元組, 段落數, 父文件索引需要的 (docid, start_char, end_char) 或 None)。
+    """
+    data, codec, level, collect_parts = task
+    lines = []
+    doc_ids, start_chars, end_chars = [], [], []
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        doc = convert_document(loads(line))
+        lines.append(dumps(doc))
+        if collect_parts:
+            doc_ids.append(doc["id"])
+            start_chars.append(doc["start_char"])
+            end_chars.append(doc["end_char"])
+    payload = b'\n'.join(lines) + b'\n' if lines else b''
+    parts = (doc_ids, start_chars, end_chars) if collect_parts else None
+    return _compress(payload, codec, level), len(lines), parts
+
+
+class _OutputFile:
+    """
+    一個輸出檔：壓縮好的區塊依讀取順序寫入暫存檔，全部寫完才改名為最終檔名 (中斷後重跑會重新轉換)。
+    """
+
+    def __init__(self, path, codec, level, parts_folder):
+        self.path = str(path)
+        self.codec = codec
+        self.level = level
+        self.parts_folder = parts_folder
+        self.f = open(f"{self.path}.tmp", 'wb')
+        self.empty = True
+        self.doc_ids, self.start_chars, self.end_chars = [], [], []
+
+    def write(self, result):
+        compressed, count, parts = result
+        self.f.write(compressed)
+        self.empty = False
+        if parts is not None:
+            self.doc_ids.extend(parts[0])
+            self.start_chars.extend(parts[1])
+            self.end_chars.extend(parts[2])
+        return count
+
+    def close(self):
+        if self.empty:
+            self.f.write(_compress(b'', self.codec, self.level))
+        self.f.close()
+        if self.parts_folder:
+            name = os.path.basename(self.path)
+            # 舊版以多塊轉換時留下的 .partNNNN 一併清掉，避免與這次的結果重複
+            if os.path.isdir(self.parts_folder):
+                for filename in os.listdir(self.parts_folder):
+                    if filename.rsplit('.part', 1)[0] == name:
+                        os.remove(os.path.join(self.parts_folder, filename))
+            write_part(self.parts_folder, f"{name}.part0000", self.doc_ids, self.start_chars, self.end_chars)
+        os.replace(f"{self.path}.tmp", self.path)
+
+
+def process_file(input_file, output_dir="data/corpus/processed", codec='gzip', level=6, parts_folder=None,
+                 chunk_bytes=CHUNK_BYTES):
+    """處理單個文件 (不使用進程池)"""
+    output = _OutputFile(Path(output_dir) / output_name(input_file, codec), codec, level, parts_folder)
+    count = 0
+    for data in iter_chunks(input_file, chunk_bytes):
+        count += output.write(process_chunk((data, codec, level, parts_folder is not None)))
+    output.close()
+    return count
+
+
+def convert_whole_file(task):
+    """工作行程自己讀取並轉換整個檔案 (pool 用的包裝)"""
+    return process_file(*task)
+
+
+def convert_files(pending, output_dir, codec, level, num_processes, chunk_bytes, parts_folder, tail_files=None):
+    """
+    平行轉換待處理的檔案。大部分檔案整個交給一個工作行程 (各自解壓縮、轉換、壓縮，讀取本身也平行)；
+    依大小由大到小排程，最後 tail_files 個 (最小的) 檔案則由主行程依序解壓縮，切成區塊分給先做完的工作行程，
+    避免最後只剩幾個檔案時其他行程閒置。主行程只有一個讀取器，大約只夠餵飽幾個工作行程
+    (gzip 解壓縮比 JSON 轉換加重新壓縮快數倍)，所以只用在尾端；尾端在途的區塊最多為進程數的兩倍，
+    記憶體用量與檔案大小無關。
+    """
+    print(f"使用 {num_processes} 個進程進行處理")
+    pending = sorted(pending, key=lambda f: f.stat().st_size, reverse=True)
+    if tail_files is None:
+        tail_files = max(1, num_processes // 4)
+    num_whole = max(0, len(pending) - tail_files) if num_processes > 1 else len(pending)
+    whole, tail = pending[:num_whole], pending[num_whole:]
+    in_flight = deque()
+    max_in_flight = 2 * num_processes
+    counts = []
+
+    with Pool(num_processes) as pool:
+        with tqdm(total=len(pending), desc="總體進度") as pbar:
+            def file_done(count):
+                counts.append(count)
+                pbar.update(1)
+
+            def write_next():
+                # 最早送出的區塊 (或檔案結束標記)；None 代表該檔案的區塊都已寫入
+                output, result = in_flight.popleft()
+                if result is None:
+                    output.close()
+                    file_done(0)
+                    return
+                counts.append(output.write(result.get()))
+
+            # 整檔的工作先送出 (pool 依送出順序執行)，尾端的區塊排在後面
+            results = [
+                pool.apply_async(convert_whole_file, ((input_file, output_dir, codec, level, parts_folder,
+                                                       chunk_bytes),), callback=file_done)
+                for input_file in whole
+            ]
+            for input_file in tail:
+                output = _OutputFile(output_dir / output_name(input_file, codec), codec, level, parts_folder)
+                for data in iter_chunks(input_file, chunk_bytes):
+                    while len(in_flight) >= max_in_flight:
+                        write_next()
+                    task = (data, codec, level, parts_folder is not None)
+                    in_flight.append((output, pool.apply_async(process_chunk, (task,))))
+                in_flight.append((output, None))
+            while in_flight:
+                write_next()
+            for result in results:
+                # 工作行程中的例外在這裡拋出
+                result.get()
+    print(f"完成，共轉換 {sum(counts)} 個段落")
+
+
+def list_parts(parts_folder):
+    """
+    {輸出檔名: [該檔各塊的名稱 (依塊編號排序)]}；資料夾不存在時回傳空的 dict。
+    """
+    parts = {}
+    if not os.path.isdir(parts_folder):
+        return parts
+    for filename in sorted(os.listdir(parts_folder)):
+        if filename.endswith('.ids.txt'):
+            part_name = filename[:-len('.ids.txt')]
+            parts.setdefault(part_name.rsplit('.part', 1)[0], []).append(part_name)
+    return parts
+
+
+def rebuild_part(task):
+    """
+    舊版程式轉換的檔案沒有父文件索引資料 (也沒有 start_char/end_char)，從原始輸入重新產生。
+    """
+    input_file, parts_folder, name = task
+    doc_ids, start_chars, end_chars = [], [], []
+    for data in iter_chunks(input_file):
+        for line in data.splitlines():
+            if not line.strip():
+                continue
+            doc = loads(line)
+            doc_ids.append(doc["docid"])
+            start_chars.append(doc.get("start_char", -1))
+            end_chars.append(doc.get("end_char", -1))
+    write_part(parts_folder, f"{name}.part0000", doc_ids, start_chars, end_chars)
+    return str(input_file)
+
 
 def main():
+    parser = argparse.ArgumentParser(description='Convert MS MARCO v2.1 segmented shards to the Pyserini JSON format')
+    parser.add_argument('--input-dir', default="/tmp2/TREC_RAG2025/corpus/msmarco_v2.1_doc_segmented")
+    parser.add_argument('--output-dir', default="data/corpus/processed")
+    parser.add_argument('--num-processes', type=int, default=cpu_count(), help='Worker processes (default: cpu_count)')
+    parser.add_argument('--chunk-mb', type=int, default=CHUNK_BYTES // 2 ** 20,
+                        help='Uncompressed MB per block read at a time (each shard is still read once, in order)')
+    parser.add_argument('--tail-files', type=int, default=None,
+                        help='Smallest files split into blocks across workers at the end (default: num_processes // 4)')
+    parser.add_argument('--codec', choices=['gzip', 'zstd'], default='gzip',
+                        help='Output compression; zstd writes .json.zst, which Pyserini and run_dense_retrieval.py do not read')
+    parser.add_argument('--level', type=int, default=None, help='Compression level (default: 6 for gzip, 3 for zstd)')
+    parser.add_argument('--parent-index', default="data/corpus/parent_index",
+                        help='Where to build the segment-to-document index (empty string to skip)')
+    args = parser.parse_args()
+
     # 設定目錄
-    input_dir = Path("/tmp2/TREC_RAG2025/corpus/msmarco_v2.1_doc_segmented")
-    output_dir = Path("data/corpus/processed")
+    input_dir = Path(args.input_dir)
+    output_dir = Path(args.output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
+    level = args.level if args.level is not None else (3 if args.codec == 'zstd' else 6)
 
-    # 獲取所有需要處理的文件
-    input_files = list(input_dir.glob("*.json.gz"))
-    print(f"找到 {len(input_files)} 個文件需要處理")
+    # 獲取所有需要處理的文件 (已有輸出的跳過，方便中斷後接續)
+    input_files = sorted(input_dir.glob("*.json.gz"))
+    pending = [f for f in input_files if not (output_dir / output_name(f, args.codec)).exists()]
+    print(f"找到 {len(input_files)} 個文件，其中 {len(pending)} 個需要處理")
+    parts_folder = os.path.join(args.parent_index, PARTS_FOLDER) if args.parent_index else None
+    if pending:
+        convert_files(pending, output_dir, args.codec, level, args.num_processes, args.chunk_mb * 2 ** 20, parts_folder,
+                      args.tail_files)
 
-    # 設定進程數為 16
-    num_processes = 16
-    print(f"使用 {num_processes} 個進程進行處理")
+    if parts_folder:
+        names = [output_name(f, args.codec) for f in input_files]
+        parts = list_parts(parts_folder)
+        # 已有輸出卻沒有對應資料的檔案 (舊版程式轉換的) 要補上，否則索引只會涵蓋新轉換的檔案
+        missing = [
+            (input_file, parts_folder, name) for input_file, name in zip(input_files, names)
+            if name not in parts and (output_dir / name).exists()
+        ]
+        if missing:
+            print(f"{len(missing)} 個已轉換的文件沒有父文件索引資料，從原始文件重新產生")
+            with Pool(args.num_processes) as pool:
+                list(tqdm(pool.imap_unordered(rebuild_part, missing), total=len(missing), desc="父文件索引"))
+            parts = list_parts(parts_folder)
+
+        # 依語料順序 (輸出檔名、塊編號) 合併各塊的 docid 與字元範圍
+        part_names = sorted(part_name for name in names for part_name in parts.get(name, []))
+        if part_names:
+            build_parent_index(args.parent_index, part_names)
+        else:
+            print("沒有已轉換的文件，略過父文件索引")
 
-    # 使用進程池處理文件
-    with Pool(num_processes) as pool:
-        list(tqdm(
-            pool.imap(process_file, input_files),
-            total=len(input_files),
-            desc="總體進度"
-        ))
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
@@ -15,6 +15,11 @@ mkdir -p "runs/retrieval"
 mkdir -p "runs/generation"
 mkdir -p "runs/evaluation"
 
+# Per-stage timing / resource timelines (src/retireval/telemetry.py); every Python stage
+# writes $TELEMETRY_DIR/<stage>.<time>.<pid>.json and generate_trec_report.py --timelines reads the folder
+export TELEMETRY_DIR="runs/telemetry/${TIMESTAMP}"
+mkdir -p "$TELEMETRY_DIR"
+
 # Function to log messages
 log() {
     echo "[$(date '+%Y-%m-%d %H:%M:%S')] $1" | tee -a "$LOG_FILE"
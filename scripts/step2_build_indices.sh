@@ -4,6 +4,10 @@
 # 設定目錄
 CORPUS_DIR="data/corpus/processed"
 INDEX_DIR="indexes/bm25"
+NATIVE_INDEX_DIR="indexes/bm25_native"
+CONFIG_FILE="configs/retrieval_config.yaml"
+# 依設定檔的 bm25.backend (可用 BM25_BACKEND 環境變數覆寫)；native 時改建 bm25_index.py 的 NumPy impact 索引 (不需要 Java)
+BM25_BACKEND="${BM25_BACKEND:-$(python -c "import yaml; print((yaml.safe_load(open('$CONFIG_FILE'))['bm25'] or {}).get('backend', 'lucene'))" 2>/dev/null || echo lucene)}"
 LOG_DIR="logs/indexing"
 
 # 創建必要的目錄
@@ -13,32 +17,52 @@ mkdir -p $LOG_DIR
 # 記錄開始時間
 echo "開始建立索引: $(date)" | tee -a $LOG_DIR/indexing.log
 
-# 使用 Pyserini 建立 BM25 索引
-python -m pyserini.index.lucene \
-    --collection JsonCollection \
-    --input $CORPUS_DIR \
-    --index $INDEX_DIR \
-    --generator DefaultLuceneDocumentGenerator \
-    --threads 8 \
-    --storePositions \
-    --storeDocvectors \
-    --storeRaw \
-    2>&1 | tee -a $LOG_DIR/indexing.log
-
-# 檢查索引是否成功建立
-if [ $? -eq 0 ]; then
-    echo "索引建立成功: $(date)" | tee -a $LOG_DIR/indexing.log
-    
-    # 顯示索引統計資訊
-    echo "索引統計資訊:" | tee -a $LOG_DIR/indexing.log
+if [ "$BM25_BACKEND" = "native" ]; then
+    python src/retireval/bm25_index.py build \
+        --corpus-folder $CORPUS_DIR \
+        --output $NATIVE_INDEX_DIR \
+        --config $CONFIG_FILE \
+        2>&1 | tee -a $LOG_DIR/indexing.log
+    if [ ${PIPESTATUS[0]} -eq 0 ]; then
+        echo "索引建立成功: $(date)" | tee -a $LOG_DIR/indexing.log
+    else
+        echo "索引建立失敗: $(date)" | tee -a $LOG_DIR/indexing.log
+        exit 1
+    fi
+else
+    # 使用 Pyserini 建立 BM25 索引
     python -m pyserini.index.lucene \
+        --collection JsonCollection \
+        --input $CORPUS_DIR \
         --index $INDEX_DIR \
-        --stats \
+        --generator DefaultLuceneDocumentGenerator \
+        --threads 8 \
+        --storePositions \
+        --storeDocvectors \
         2>&1 | tee -a $LOG_DIR/indexing.log
-else
-    echo "索引建立失敗: $(date)" | tee -a $LOG_DIR/indexing.log
-    exit 1
+
+    # 檢查索引是否成功建立
+    if [ $? -eq 0 ]; then
+        echo "索引建立成功: $(date)" | tee -a $LOG_DIR/indexing.log
+    
+        # 顯示索引統計資訊
+        echo "索引統計資訊:" | tee -a $LOG_DIR/indexing.log
+        python -m pyserini.index.lucene \
+            --index $INDEX_DIR \
+            --stats \
+            2>&1 | tee -a $LOG_DIR/indexing.log
+    else
+        echo "索引建立失敗: $(date)" | tee -a $LOG_DIR/indexing.log
+        exit 1
+    fi
 fi
 
+# 建立可依 docid 隨機讀取的段落庫 (取代 Lucene 的 --storeRaw)
+echo "建立段落庫: $(date)" | tee -a $LOG_DIR/indexing.log
+python src/retireval/segment_store.py build \
+    --corpus-folder $CORPUS_DIR \
+    --output data/corpus/segment_store \
+    2>&1 | tee -a $LOG_DIR/indexing.log
+
 # 記錄結束時間
 echo "索引建立完成: $(date)" | tee -a $LOG_DIR/indexing.log
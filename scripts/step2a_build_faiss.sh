@@ -2,8 +2,10 @@
 
 
 # 設定目錄
-CORPUS_DIR="data/corpus/processed"
+EMBEDDINGS_FILE="corpus_embeddings.npy"
+IDS_FILE="corpus_ids"
 INDEX_DIR="indexes/faiss"
+INDEX_TYPE="ivfpq"  # ivfpq, ivfpq-hnsw 或 hnsw
 LOG_DIR="logs/indexing"
 
 # 創建必要的目錄
@@ -13,23 +15,22 @@ mkdir -p $LOG_DIR
 # 記錄開始時間
 echo "開始建立索引: $(date)" | tee -a $LOG_DIR/indexing.log
 
-# 使用 Pyserini 建立 BM25 索引
-python -m pyserini.index.faiss \
-    --input test_data \
-    --output $INDEX_DIR \
+# 由 merge_temp_files 產生的語料嵌入建立 faiss ANN 索引
+python src/retireval/ann_index.py build \
+    --embeddings $EMBEDDINGS_FILE \
+    --ids $IDS_FILE \
+    --output $INDEX_DIR/$INDEX_TYPE.faiss \
+    --index-type $INDEX_TYPE \
     --threads 8 \
     2>&1 | tee -a $LOG_DIR/indexing.log
 
 # 檢查索引是否成功建立
-if [ $? -eq 0 ]; then
+if [ ${PIPESTATUS[0]} -eq 0 ]; then
     echo "索引建立成功: $(date)" | tee -a $LOG_DIR/indexing.log
     
-    # 顯示索引統計資訊
-    echo "索引統計資訊:" | tee -a $LOG_DIR/indexing.log
-    python -m pyserini.index.lucene \
-        --index $INDEX_DIR \
-        --stats \
-        2>&1 | tee -a $LOG_DIR/indexing.log
+    # 顯示索引資訊
+    echo "索引資訊:" | tee -a $LOG_DIR/indexing.log
+    cat $INDEX_DIR/$INDEX_TYPE.faiss.meta.json 2>&1 | tee -a $LOG_DIR/indexing.log
 else
     echo "索引建立失敗: $(date)" | tee -a $LOG_DIR/indexing.log
     exit 1
@@ -37,3 +38,10 @@ fi
 
 # 記錄結束時間
 echo "索引建立完成: $(date)" | tee -a $LOG_DIR/indexing.log
+
+# 以精確掃描為基準比較不同 nprobe 的 recall@1000 與延遲:
+# python src/retireval/ann_index.py evaluate \
+#     --index $INDEX_DIR/$INDEX_TYPE.faiss \
+#     --topics /tmp2/TREC_RAG2025/topics/topics.rag24.test.txt \
+#     --nprobe 16,64,256 \
+#     --output $INDEX_DIR/$INDEX_TYPE.recall.json
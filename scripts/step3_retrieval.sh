@@ -4,6 +4,11 @@
 # TOPICS_FILE="data/topics/topics.rag24.test.txt"
 TOPICS_FILE="/tmp2/TREC_RAG2025/topics/topics.rag24.test.txt"
 INDEX_DIR="indexes/bm25"
+NATIVE_INDEX_DIR="indexes/bm25_native"
+CONFIG_FILE="configs/retrieval_config.yaml"
+# 依設定檔的 bm25.backend (可用 BM25_BACKEND 環境變數覆寫)；native 時改用 bm25_index.py 的 NumPy impact 索引檢索，
+# 另外設定 PARITY_REFERENCE (Pyserini 的 run 檔) 時會比較兩者的結果
+BM25_BACKEND="${BM25_BACKEND:-$(python -c "import yaml; print((yaml.safe_load(open('$CONFIG_FILE'))['bm25'] or {}).get('backend', 'lucene'))" 2>/dev/null || echo lucene)}"
 RUN_DIR="runs/retrieval"
 LOG_DIR="logs/retrieval"
 
@@ -14,17 +19,35 @@ mkdir -p $LOG_DIR
 # 記錄開始時間
 echo "開始檢索: $(date)" | tee -a $LOG_DIR/retrieval.log
 
-# 使用 Pyserini 進行檢索
-python -m pyserini.search.lucene \
-    --index $INDEX_DIR \
-    --topics $TOPICS_FILE \
-    --output $RUN_DIR/bm25_run.txt \
-    --bm25 \
-    --hits 1000 \
-    2>&1 | tee -a $LOG_DIR/retrieval.log
+if [ "$BM25_BACKEND" = "native" ]; then
+    python src/retireval/bm25_index.py search \
+        --index $NATIVE_INDEX_DIR \
+        --topics $TOPICS_FILE \
+        --output $RUN_DIR/bm25_run.txt \
+        --run-name bm25_native \
+        --k 1000 \
+        2>&1 | tee -a $LOG_DIR/retrieval.log
+    status=${PIPESTATUS[0]}
+    if [ $status -eq 0 ] && [ -n "$PARITY_REFERENCE" ]; then
+        python src/retireval/bm25_index.py parity \
+            --reference "$PARITY_REFERENCE" \
+            --run $RUN_DIR/bm25_run.txt \
+            2>&1 | tee -a $LOG_DIR/retrieval.log
+    fi
+else
+    # 使用 Pyserini 進行檢索
+    python -m pyserini.search.lucene \
+        --index $INDEX_DIR \
+        --topics $TOPICS_FILE \
+        --output $RUN_DIR/bm25_run.txt \
+        --bm25 \
+        --hits 1000 \
+        2>&1 | tee -a $LOG_DIR/retrieval.log
+    status=${PIPESTATUS[0]}
+fi
 
 # 檢查檢索是否成功
-if [ $? -eq 0 ]; then
+if [ $status -eq 0 ]; then
     echo "檢索完成: $(date)" | tee -a $LOG_DIR/retrieval.log
 else
     echo "檢索失敗: $(date)" | tee -a $LOG_DIR/retrieval.log
@@ -61,13 +61,21 @@ for method in bm25 dense hybrid; do
 done
 
 # Generate comparison report
+# Stage timelines written by the earlier steps (run_pipeline.sh exports TELEMETRY_DIR)
+TELEMETRY_DIR="${TELEMETRY_DIR:-runs/telemetry/${TIMESTAMP}}"
+TIMELINE_ARGS=()
+if [ -d "$TELEMETRY_DIR" ]; then
+    TIMELINE_ARGS=(--timelines "$TELEMETRY_DIR")
+fi
+
 log "Generating comparison report..."
 python src/evaluation/generate_trec_report.py \
     --bm25-metrics "${RUNS_DIR}/raw_metrics/bm25_metrics.txt" \
     --dense-metrics "${RUNS_DIR}/raw_metrics/dense_metrics.txt" \
     --hybrid-metrics "${RUNS_DIR}/raw_metrics/hybrid_metrics.txt" \
     --output "${RUNS_DIR}/reports/comparison.md" \
-    --log-file "${RUNS_DIR}/evaluation.log"
+    --log-file "${RUNS_DIR}/evaluation.log" \
+    "${TIMELINE_ARGS[@]}"
 
 # Create a summary file
 log "Creating evaluation summary..."
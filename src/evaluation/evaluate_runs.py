@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'retireval'))
+from telemetry import Telemetry, add_telemetry_args
+
+DEFAULT_METRICS = ['map', 'ndcg_cut_10', 'recip_rank', 'P_10', 'recall_100', 'recall_1000']
+METRIC_PATTERN = re.compile(r'^(map|recip_rank|ndcg_cut_(\d+)|P_(\d+)|recall_(\d+))$')
+# Shift between the topic index and the document index in a (topic, docid) key.
+KEY_SHIFT = 32
+
+
+def setup_logging(log_file: Optional[str]) -> logging.Logger:
+    """Set up logging configuration."""
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file))
+    for handler in handlers:
+        handler.setLevel(logging.INFO)
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+
+    return logger
+
+
+def parse_metric(name: str) -> Tuple[str, int]:
+    """Split a trec_eval style metric name (e.g. ndcg_cut_10) into (measure, cutoff)."""
+    match = METRIC_PATTERN.match(name)
+    if match is None:
+        raise ValueError(f"Unsupported metric: {name} (use map, recip_rank, ndcg_cut_K, P_K or recall_K)")
+    cutoff = next((int(group) for group in match.groups()[1:] if group is not None), 0)
+    return name.rsplit('_', 1)[0] if cutoff else name, cutoff
+
+
+class Qrels:
+    """
+    Relevance judgments parsed once into sorted arrays.
+
+    Every (topic, docid) pair is packed into one int64 key so a whole run is
+    joined against the judgments with a single searchsorted.
+    """
+
+    def __init__(self, topics: List[str], docids: List[str], keys: np.ndarray, gains: np.ndarray):
+        self.topics = topics
+        self.topic_index = {topic: i for i, topic in enumerate(topics)}
+        self.doc_index = {docid: i for i, docid in enumerate(docids)}
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.gains = gains[order]
+        key_topics = (self.keys >> KEY_SHIFT).astype(np.int64)
+        self.num_rel = np.bincount(key_topics, weights=self.gains >= 1, minlength=len(topics)).astype(np.int64)
+        self._ideal = self._ideal_dcg(key_topics)
+
+    @classmethod
+    def load(cls, path: str) -> 'Qrels':
+        """Read a qrels file (topic iteration docid relevance)."""
+        with open(path, 'r', encoding='utf-8') as f:
+            fields = f.read().split()
+        if len(fields) % 4:
+            raise ValueError(f"Malformed qrels file: {path}")
+        topics, topic_codes = np.unique(np.array(fields[0::4]), return_inverse=True)
+        docids, doc_codes = np.unique(np.array(fields[2::4]), return_inverse=True)
+        keys = (topic_codes.astype(np.int64) << KEY_SHIFT) | doc_codes.astype(np.int64)
+        return cls(topics.tolist(), docids.tolist(), keys, np.array(fields[3::4], dtype=np.float64))
+
+    def _ideal_dcg(self, key_topics: np.ndarray) -> np.ndarray:
+        """Cumulative ideal DCG per topic, padded to the largest number of judged documents."""
+        counts = np.bincount(key_topics, minlength=len(self.topics))
+        ideal = np.zeros((len(self.topics), max(int(counts.max(initial=0)), 1)))
+        order = np.lexsort((-self.gains, key_topics))
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        ranks = np.arange(len(order)) - starts[key_topics[order]]
+        ideal[key_topics[order], ranks] = np.maximum(self.gains[order], 0) / np.log2(ranks + 2)
+        return np.cumsum(ideal, axis=1)
+
+    def ideal_dcg(self, cutoff: int) -> np.ndarray:
+        return self._ideal[:, min(cutoff, self._ideal.shape[1]) - 1]
+
+
+def load_run(path: str, qrels: Qrels) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Read a TREC run and join it with the judgments.
+
+    Returns (topic, rank, gain) arrays over the lines whose topic is judged,
+    ordered like trec_eval: by topic, descending score, then descending docid.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        fields = f.read().split()
+    if len(fields) % 6:
+        raise ValueError(f"Malformed TREC run file: {path}")
+    docids = fields[2::6]
+    topics = np.array([qrels.topic_index.get(topic, -1) for topic in fields[0::6]], dtype=np.int64)
+    docs = np.array([qrels.doc_index.get(docid, -1) for docid in docids], dtype=np.int64)
+    scores = np.array(fields[4::6], dtype=np.float64)
+    judged_topic = np.flatnonzero(topics >= 0)
+    topics, docs, scores = topics[judged_topic], docs[judged_topic], scores[judged_topic]
+
+    order = np.lexsort((-scores, topics))
+    tied = (np.diff(topics[order]) == 0) & (np.diff(scores[order]) == 0)
+    if tied.any():
+        # Only rows sharing a (topic, score) with another row need the docid tie-break,
+        # so only their docid strings are ranked.
+        tied_rows = order[np.flatnonzero(np.concatenate([[False], tied]) | np.concatenate([tied, [False]]))]
+        doc_rank = np.zeros(len(topics), dtype=np.int64)
+        doc_rank[tied_rows] = np.unique(np.array([docids[i] for i in judged_topic[tied_rows].tolist()]),
+                                        return_inverse=True)[1]
+        order = np.lexsort((-doc_rank, -scores, topics))
+    topics, docs = topics[order], docs[order]
+
+    starts = np.flatnonzero(np.diff(topics, prepend=-1))
+    ranks = np.arange(len(topics)) - np.repeat(starts, np.diff(np.append(starts, len(topics))))
+
+    keys = (topics << KEY_SHIFT) | np.maximum(docs, 0)
+    positions = np.minimum(np.searchsorted(qrels.keys, keys), len(qrels.keys) - 1)
+    found = (docs >= 0) & (qrels.keys[positions] == keys)
+    gains = np.where(found, qrels.gains[positions], 0.0)
+    return topics, ranks, gains
+
+
+def evaluate_arrays(qrels: Qrels, topics: np.ndarray, ranks: np.ndarray, gains: np.ndarray,
+                    metrics: Sequence[str]) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """Per-topic metric values for the topics present in the run (vectorized over all lines)."""
+    evaluated, groups = np.unique(topics, return_inverse=True)
+    num_groups = len(evaluated)
+    num_rel = qrels.num_rel[evaluated].astype(np.float64)
+    safe_num_rel = np.maximum(num_rel, 1)
+    relevant = gains >= 1
+    cum_rel = np.cumsum(relevant)
+    group_starts = np.flatnonzero(np.diff(groups, prepend=-1))
+    cum_rel = cum_rel - np.repeat(cum_rel[group_starts] - relevant[group_starts], np.diff(np.append(group_starts, len(groups))))
+
+    def per_topic(weights: np.ndarray) -> np.ndarray:
+        return np.bincount(groups, weights=weights, minlength=num_groups)
+
+    results = {}
+    for name in metrics:
+        measure, cutoff = parse_metric(name)
+        if measure == 'map':
+            values = per_topic(np.where(relevant, cum_rel / (ranks + 1), 0.0)) / safe_num_rel
+        elif measure == 'recip_rank':
+            values = np.zeros(num_groups)
+            first_groups, first = np.unique(groups[relevant], return_index=True)
+            values[first_groups] = 1.0 / (ranks[relevant][first] + 1)
+        elif measure == 'P':
+            values = per_topic(relevant & (ranks < cutoff)) / cutoff
+        elif measure == 'recall':
+            values = per_topic(relevant & (ranks < cutoff)) / safe_num_rel
+        else:
+            dcg = per_topic(np.where(ranks < cutoff, np.maximum(gains, 0) / np.log2(ranks + 2), 0.0))
+            ideal = qrels.ideal_dcg(cutoff)[evaluated]
+            values = np.divide(dcg, ideal, out=np.zeros(num_groups), where=ideal > 0)
+        results[name] = values
+    return evaluated, results
+
+
+_worker_qrels: Optional[Qrels] = None
+
+
+def _init_worker(qrels: Qrels) -> None:
+    global _worker_qrels
+    _worker_qrels = qrels
+
+
+def _evaluate_worker(task: Tuple[str, Sequence[str]]) -> Tuple[str, np.ndarray, Dict[str, np.ndarray]]:
+    path, metrics = task
+    return (path, *evaluate_arrays(_worker_qrels, *load_run(path, _worker_qrels), metrics))
+
+
+def evaluate_runs(qrels: Qrels, run_paths: Sequence[str], metrics: Sequence[str] = DEFAULT_METRICS,
+                  workers: int = 1) -> Dict[str, Dict[str, Dict[str, float]]]:
+    """
+    Evaluate many run files against the same qrels.
+
+    Returns {run_path: {metric: {topic: value}}}; with workers > 1 the runs are
+    spread over processes that each receive the parsed qrels once.
+    """
+    tasks = [(path, list(metrics)) for path in run_paths]
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(min(workers, len(tasks)), initializer=_init_worker, initargs=(qrels,)) as pool:
+            outputs = list(pool.map(_evaluate_worker, tasks, chunksize=max(1, len(tasks) // (workers * 4))))
+    else:
+        _init_worker(qrels)
+        outputs = [_evaluate_worker(task) for task in tasks]
+
+    results = {}
+    for path, evaluated, values in outputs:
+        topic_names = [qrels.topics[i] for i in evaluated.tolist()]
+        results[path] = {name: dict(zip(topic_names, values[name].tolist())) for name in metrics}
+    return results
+
+
+def mean_scores(per_topic: Dict[str, Dict[str, float]], qrels: Optional[Qrels] = None) -> Dict[str, float]:
+    """
+    Average each metric over the evaluated topics, or over every judged topic
+    (missing ones count as 0, like trec_eval -c) when qrels is given.
+    """
+    means = {}
+    for name, values in per_topic.items():
+        denominator = len(qrels.topics) if qrels is not None else len(values)
+        means[name] = sum(values.values()) / denominator if denominator else 0.0
+    return means
+
+
+def paired_arrays(a: Dict[str, float], b: Dict[str, float]) -> Tuple[np.ndarray, np.ndarray]:
+    topics = sorted(set(a) & set(b))
+    return np.array([a[topic] for topic in topics]), np.array([b[topic] for topic in topics])
+
+
+def randomization_test(a: np.ndarray, b: np.ndarray, trials: int = 10000, seed: int = 0,
+                       chunk: int = 1000) -> float:
+    """Two-sided paired randomization (sign-flip) test on the mean per-topic difference."""
+    diff = np.asarray(a, dtype=np.float64) - np.asarray(b, dtype=np.float64)
+    if not len(diff):
+        return 1.0
+    observed = abs(diff.mean())
+    rng = np.random.default_rng(seed)
+    extreme = 0
+    for start in range(0, trials, chunk):
+        signs = rng.integers(0, 2, size=(min(chunk, trials - start), len(diff)), dtype=np.int8) * 2 - 1
+        extreme += int(np.count_nonzero(np.abs(signs @ diff) / len(diff) >= observed - 1e-12))
+    return (extreme + 1) / (trials + 1)
+
+
+def bootstrap_test(a: np.ndarray, b: np.ndarray, trials: int = 10000, seed: int = 0,
+                   chunk: int = 1000) -> Tuple[float, float, float]:
+    """
+    Two-sided paired bootstrap test (shift method) on the mean per-topic difference.
+
+    Returns (p_value, ci_low, ci_high) with a 95% percentile interval for the difference.
+    """
+    diff = np.asarray(a, dtype=np.float64) - np.asarray(b, dtype=np.float64)
+    if not len(diff):
+        return 1.0, 0.0, 0.0
+    observed = diff.mean()
+    rng = np.random.default_rng(seed)
+    means = []
+    for start in range(0, trials, chunk):
+        samples = rng.integers(0, len(diff), size=(min(chunk, trials - start), len(diff)))
+        means.append(diff[samples].mean(axis=1))
+    means = np.concatenate(means)
+    p_value = (np.count_nonzero(np.abs(means - observed) >= abs(observed) - 1e-12) + 1) / (trials + 1)
+    ci_low, ci_high = np.percentile(means, [2.5, 97.5])
+    return float(p_value), float(ci_low), float(ci_high)
+
+
+def compare_runs(results: Dict[str, Dict[str, Dict[str, float]]], baseline: str, test: str = 'randomization',
+                 trials: int = 10000, seed: int = 0) -> Dict[str, Dict[str, Dict[str, float]]]:
+    """Significance of every run against the baseline, per metric, on the topics both runs answered."""
+    comparisons = {}
+    for path, per_topic in results.items():
+        if path == baseline:
+            continue
+        comparisons[path] = {}
+        for name, values in per_topic.items():
+            a, b = paired_arrays(values, results[baseline][name])
+            entry = {'delta': float((a - b).mean()) if len(a) else 0.0, 'topics': len(a)}
+            if test == 'bootstrap':
+                entry['p_value'], entry['ci_low'], entry['ci_high'] = bootstrap_test(a, b, trials, seed)
+            else:
+                entry['p_value'] = randomization_test(a, b, trials, seed)
+            comparisons[path][name] = entry
+    return comparisons
+
+
+def format_table(means: Dict[str, Dict[str, float]], metrics: Sequence[str],
+                 comparisons: Optional[Dict[str, Dict[str, Dict[str, float]]]] = None, alpha: float = 0.05) -> str:
+    """Markdown table of mean scores; '*' marks significant differences from the baseline."""
+    lines = ["| Run | " + " | ".join(metrics) + " |", "|---|" + "---|" * len(metrics)]
+    for path, scores in means.items():
+        cells = []
+        for name in metrics:
+            marker = ''
+            if comparisons and path in comparisons and comparisons[path][name]['p_value'] < alpha:
+                marker = '*'
+            cells.append(f"{scores[name]:.4f}{marker}")
+        lines.append(f"| {os.path.basename(path)} | " + " | ".join(cells) + " |")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate TREC runs in-process with per-topic scores and significance tests')
+    parser.add_argument('--qrels', required=True, help='Path to qrels file')
+    parser.add_argument('--runs', nargs='+', required=True, help='Run files (e.g. every output of a fusion sweep)')
+    parser.add_argument('--metrics', nargs='+', default=DEFAULT_METRICS,
+                        help='map, recip_rank, ndcg_cut_K, P_K, recall_K')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes evaluating runs in parallel')
+    parser.add_argument('--complete', action='store_true',
+                        help='Average over every judged topic, counting topics missing from a run as 0 (trec_eval -c)')
+    parser.add_argument('--baseline', default=None, help='Run to test every other run against')
+    parser.add_argument('--test', choices=['randomization', 'bootstrap'], default='randomization')
+    parser.add_argument('--trials', type=int, default=10000)
+    parser.add_argument('--alpha', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='Write mean scores and significance results as JSON')
+    parser.add_argument('--per-topic', default=None, help='Write per-topic scores as JSON')
+    parser.add_argument('--log-file', default=None, help='Path to log file')
+    add_telemetry_args(parser)
+    args = parser.parse_args()
+
+    logger = setup_logging(args.log_file)
+    telemetry = Telemetry.from_args(args, 'evaluation')
+    for name in args.metrics:
+        parse_metric(name)
+    if args.baseline and args.baseline not in args.runs:
+        args.runs.insert(0, args.baseline)
+
+    start = time.time()
+    with telemetry.stage('load_qrels') as stage:
+        qrels = Qrels.load(args.qrels)
+        stage.add_items(len(qrels.keys))
+    logger.info(f"Loaded qrels for {len(qrels.topics)} topics ({len(qrels.keys)} judgments) in {time.time() - start:.2f}s")
+
+    start = time.time()
+    with telemetry.stage('evaluate', items=len(args.runs)) as stage:
+        results = evaluate_runs(qrels, args.runs, args.metrics, args.workers)
+        stage.set(workers=args.workers)
+    logger.info(f"Evaluated {len(results)} runs in {time.time() - start:.2f}s")
+
+    means = {path: mean_scores(per_topic, qrels if args.complete else None) for path, per_topic in results.items()}
+    comparisons = None
+    if args.baseline:
+        start = time.time()
+        with telemetry.stage('significance', items=len(results) - 1) as stage:
+            comparisons = compare_runs(results, args.baseline, args.test, args.trials, args.seed)
+            stage.set(test=args.test, trials=args.trials)
+        logger.info(f"Ran {args.test} tests against {os.path.basename(args.baseline)} "
+                    f"({args.trials} trials) in {time.time() - start:.2f}s")
+    logger.info("Mean scores" + (f" (* p < {args.alpha} vs baseline)" if comparisons else "") + ":\n"
+                + format_table(means, args.metrics, comparisons, args.alpha))
+
+    if len(means) > 1:
+        for name in args.metrics:
+            best = max(means, key=lambda path: means[path][name])
+            logger.info(f"Best {name}: {os.path.basename(best)} ({means[best][name]:.4f})")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'metrics': means, 'significance': comparisons, 'test': args.test if comparisons else None},
+                      f, indent=2)
+        logger.info(f"Scores written to {args.output}")
+    if args.per_topic:
+        with open(args.per_topic, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"Per-topic scores written to {args.per_topic}")
+    telemetry.close()
+
+
+if __name__ == "__main__":
+    main()
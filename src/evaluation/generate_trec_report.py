@@ -3,8 +3,13 @@
 import argparse
 import json
 import logging
+import os
+import sys
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'retireval'))
+from telemetry import Telemetry, add_telemetry_args
 
 def setup_logging(log_file: str) -> logging.Logger:
     """Set up logging configuration."""
@@ -39,11 +44,53 @@ def parse_trec_metrics(metrics_file: str) -> Dict[str, float]:
                 metrics[metric] = float(value)
     return metrics
 
+def load_timelines(paths: List[str]) -> List[Dict]:
+    """Load telemetry timelines; directories contribute every *.json file inside them."""
+    files = []
+    for path in paths:
+        if Path(path).is_dir():
+            files.extend(sorted(Path(path).glob('*.json')))
+        else:
+            files.append(Path(path))
+    timelines = []
+    for file in files:
+        with open(file, 'r') as f:
+            timeline = json.load(f)
+        # Skip other JSON files in the folder, e.g. py-spy speedscope profiles
+        if isinstance(timeline, dict) and 'stages' in timeline:
+            timelines.append(timeline)
+    return sorted(timelines, key=lambda timeline: timeline.get('started_at', ''))
+
+def _format_value(value: Optional[float], scale: float = 1.0, digits: int = 1) -> str:
+    return 'N/A' if value is None else f"{value / scale:.{digits}f}"
+
+def generate_timeline_section(timelines: List[Dict]) -> str:
+    """Generate a markdown section with per-stage timing and resource usage."""
+    markdown = "\n## Pipeline Performance\n\n"
+    markdown += "| Stage | Wall (s) | Items | Items/s | CPU % | Peak RSS (MB) | Read (MB) | Written (MB) |\n"
+    markdown += "|-------|----------|-------|---------|-------|---------------|-----------|--------------|\n"
+    for timeline in timelines:
+        markdown += (f"| **{timeline['run_name']}** | {timeline['wall_seconds']:.1f} | | | | "
+                     f"{_format_value(timeline.get('peak_rss_mb'))} | | |\n")
+        for stage in timeline['stages']:
+            indent = '&nbsp;&nbsp;' * (stage['name'].count('/') + 1)
+            markdown += (
+                f"| {indent}{stage['name'].rsplit('/', 1)[-1]} | {stage['wall_seconds']:.2f} "
+                f"| {stage['items'] if stage.get('items') is not None else ''} "
+                f"| {_format_value(stage.get('items_per_second'))} "
+                f"| {_format_value(stage.get('cpu_percent'))} "
+                f"| {_format_value(stage.get('peak_rss_mb'))} "
+                f"| {_format_value(stage.get('io_rchar'), 2 ** 20)} "
+                f"| {_format_value(stage.get('io_wchar'), 2 ** 20)} |\n"
+            )
+    return markdown
+
 def generate_markdown_report(
     bm25_metrics: Dict[str, float],
     dense_metrics: Dict[str, float],
     hybrid_metrics: Dict[str, float],
-    output_file: str
+    output_file: str,
+    timelines: Optional[List[Dict]] = None
 ) -> None:
     """Generate a markdown report comparing different retrieval methods."""
     
@@ -83,6 +130,10 @@ def generate_markdown_report(
         }
         best_method = max(values.items(), key=lambda x: x[1])[0]
         markdown += f"- {metric}: {best_method}\n"
+
+    # Add the stage timelines recorded by telemetry.py
+    if timelines:
+        markdown += generate_timeline_section(timelines)
     
     # Write to file
     with open(output_file, 'w') as f:
@@ -95,26 +146,34 @@ def main():
     parser.add_argument('--hybrid-metrics', required=True, help='Path to hybrid metrics file')
     parser.add_argument('--output', required=True, help='Path to output markdown file')
     parser.add_argument('--log-file', required=True, help='Path to log file')
+    parser.add_argument('--timelines', nargs='*', default=[],
+                        help='Telemetry timeline JSON files or directories (e.g. runs/telemetry/<timestamp>)')
+    add_telemetry_args(parser)
     
     args = parser.parse_args()
     
     # Setup logging
     logger = setup_logging(args.log_file)
     logger.info("Starting TREC report generation")
+    telemetry = Telemetry.from_args(args, 'report')
     
     try:
         # Parse metrics
         bm25_metrics = parse_trec_metrics(args.bm25_metrics)
         dense_metrics = parse_trec_metrics(args.dense_metrics)
         hybrid_metrics = parse_trec_metrics(args.hybrid_metrics)
+        timelines = load_timelines(args.timelines)
         
         # Generate report
-        generate_markdown_report(
-            bm25_metrics,
-            dense_metrics,
-            hybrid_metrics,
-            args.output
-        )
+        with telemetry.stage('report'):
+            generate_markdown_report(
+                bm25_metrics,
+                dense_metrics,
+                hybrid_metrics,
+                args.output,
+                timelines
+            )
+        telemetry.close()
         
         logger.info(f"Report generated successfully: {args.output}")
         
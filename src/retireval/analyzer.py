@@ -0,0 +1,219 @@
+import re
+from collections import Counter
+from functools import lru_cache
+
+# Lucene EnglishAnalyzer 的預設停用詞 (Anserini DefaultEnglishAnalyzer 亦同)
+STOPWORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'if', 'in', 'into', 'is', 'it', 'no', 'not', 'of',
+    'on', 'or', 'such', 'that', 'the', 'their', 'then', 'there', 'these', 'they', 'this', 'to', 'was', 'will', 'with',
+])
+_IDEOGRAPHS = '㐀-䶿一-鿿豈-﫿'
+_WORD = rf"[^\W{_IDEOGRAPHS}]+"
+# StandardTokenizer (UAX#29) 的近似：字母間的 . ' 與數字間的 . , ; 不切開 ("u.s"、"can't"、"1,000")，
+# 中日文漢字各自成一個 token
+TOKEN_PATTERN = re.compile(
+    rf"[{_IDEOGRAPHS}]|{_WORD}(?:(?:(?<=[^\W\d_])[.'’](?=[^\W\d_])|(?<=\d)[.,;'’](?=\d)){_WORD})*"
+)
+MAX_TOKEN_LENGTH = 255
+
+
+class PorterStemmer:
+    """
+    Martin Porter 原始演算法的參考實作 (與 Lucene PorterStemFilter 相同，含 "bli" -> "ble"、"logi" -> "log" 兩處調整)。
+    長度 2 以下的詞不處理。
+    """
+
+    def stem(self, word):
+        if len(word) <= 2:
+            return word
+        self.b = list(word)
+        self.k = len(word) - 1
+        self.j = 0
+        self._step1ab()
+        self._step1c()
+        self._step2()
+        self._step3()
+        self._step4()
+        self._step5()
+        return ''.join(self.b[:self.k + 1])
+
+    def _cons(self, i):
+        ch = self.b[i]
+        if ch in 'aeiou':
+            return False
+        if ch == 'y':
+            return i == 0 or not self._cons(i - 1)
+        return True
+
+    def _m(self):
+        """
+        b[0..j] 中 VC (母音序列 + 子音序列) 的個數。
+        """
+        n, i = 0, 0
+        while True:
+            if i > self.j:
+                return n
+            if not self._cons(i):
+                break
+            i += 1
+        i += 1
+        while True:
+            while True:
+                if i > self.j:
+                    return n
+                if self._cons(i):
+                    break
+                i += 1
+            i += 1
+            n += 1
+            while True:
+                if i > self.j:
+                    return n
+                if not self._cons(i):
+                    break
+                i += 1
+            i += 1
+
+    def _vowel_in_stem(self):
+        return any(not self._cons(i) for i in range(self.j + 1))
+
+    def _double_cons(self, j):
+        return j >= 1 and self.b[j] == self.b[j - 1] and self._cons(j)
+
+    def _cvc(self, i):
+        if i < 2 or not self._cons(i) or self._cons(i - 1) or not self._cons(i - 2):
+            return False
+        return self.b[i] not in 'wxy'
+
+    def _ends(self, suffix):
+        length = len(suffix)
+        if length > self.k + 1 or ''.join(self.b[self.k - length + 1:self.k + 1]) != suffix:
+            return False
+        self.j = self.k - length
+        return True
+
+    def _set_to(self, suffix):
+        self.b[self.j + 1:self.k + 1] = list(suffix)
+        self.k = self.j + len(suffix)
+
+    def _replace(self, suffix):
+        if self._m() > 0:
+            self._set_to(suffix)
+
+    def _step1ab(self):
+        if self.b[self.k] == 's':
+            if self._ends('sses'):
+                self.k -= 2
+            elif self._ends('ies'):
+                self._set_to('i')
+            elif self.k >= 1 and self.b[self.k - 1] != 's':
+                self.k -= 1
+        if self._ends('eed'):
+            if self._m() > 0:
+                self.k -= 1
+        elif (self._ends('ed') or self._ends('ing')) and self._vowel_in_stem():
+            self.k = self.j
+            if self._ends('at'):
+                self._set_to('ate')
+            elif self._ends('bl'):
+                self._set_to('ble')
+            elif self._ends('iz'):
+                self._set_to('ize')
+            elif self._double_cons(self.k):
+                self.k -= 1
+                if self.b[self.k] in 'lsz':
+                    self.k += 1
+            elif self._m() == 1 and self._cvc(self.k):
+                self._set_to('e')
+
+    def _step1c(self):
+        if self._ends('y') and self._vowel_in_stem():
+            self.b[self.k] = 'i'
+
+    STEP2 = {
+        'a': (('ational', 'ate'), ('tional', 'tion')),
+        'c': (('enci', 'ence'), ('anci', 'ance')),
+        'e': (('izer', 'ize'),),
+        'l': (('bli', 'ble'), ('alli', 'al'), ('entli', 'ent'), ('eli', 'e'), ('ousli', 'ous')),
+        'o': (('ization', 'ize'), ('ation', 'ate'), ('ator', 'ate')),
+        's': (('alism', 'al'), ('iveness', 'ive'), ('fulness', 'ful'), ('ousness', 'ous')),
+        't': (('aliti', 'al'), ('iviti', 'ive'), ('biliti', 'ble')),
+        'g': (('logi', 'log'),),
+    }
+    STEP3 = {
+        'e': (('icate', 'ic'), ('ative', ''), ('alize', 'al')),
+        'i': (('iciti', 'ic'),),
+        'l': (('ical', 'ic'), ('ful', '')),
+        's': (('ness', ''),),
+    }
+    STEP4 = {
+        'a': ('al',), 'c': ('ance', 'ence'), 'e': ('er',), 'i': ('ic',), 'l': ('able', 'ible'),
+        'n': ('ant', 'ement', 'ment', 'ent'), 's': ('ism',), 't': ('ate', 'iti'), 'u': ('ous',), 'v': ('ive',),
+        'z': ('ize',),
+    }
+
+    def _apply(self, rules):
+        # 第一個符合的後綴決定結果 (即使 m() 條件不成立也不再嘗試其他後綴)
+        for suffix, replacement in rules:
+            if self._ends(suffix):
+                self._replace(replacement)
+                return
+
+    def _step2(self):
+        if self.k >= 1:
+            self._apply(self.STEP2.get(self.b[self.k - 1], ()))
+
+    def _step3(self):
+        self._apply(self.STEP3.get(self.b[self.k], ()))
+
+    def _step4(self):
+        if self.k < 1:
+            return
+        ch = self.b[self.k - 1]
+        if ch == 'o':
+            if not ((self._ends('ion') and self.j >= 0 and self.b[self.j] in 'st') or self._ends('ou')):
+                return
+        elif not any(self._ends(suffix) for suffix in self.STEP4.get(ch, ())):
+            return
+        if self._m() > 1:
+            self.k = self.j
+
+    def _step5(self):
+        self.j = self.k
+        if self.b[self.k] == 'e':
+            m = self._m()
+            if m > 1 or (m == 1 and not self._cvc(self.k - 1)):
+                self.k -= 1
+        if self.b[self.k] == 'l' and self._double_cons(self.k) and self._m() > 1:
+            self.k -= 1
+
+
+_stemmer = PorterStemmer()
+
+
+@lru_cache(maxsize=1 << 20)
+def stem(word):
+    return _stemmer.stem(word)
+
+
+def analyze(text):
+    """
+    與 Pyserini 預設 (Anserini DefaultEnglishAnalyzer) 相同的處理順序：
+    斷詞 -> 去除所有格 's -> 轉小寫 -> 去除停用詞 -> Porter stemming，回傳 token 清單。
+    """
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text):
+        token = token[:MAX_TOKEN_LENGTH]
+        if token[-2:] in ("'s", "'S", "’s", "’S"):
+            token = token[:-2]
+        token = token.lower()
+        if token and token not in STOPWORDS:
+            tokens.append(stem(token))
+    return tokens
+
+
+def term_counts(text):
+    """
+    {term: tf}；查詢端的重複詞即為 Pyserini BagOfWordsQueryGenerator 的 boost。
+    """
+    return Counter(analyze(text))
@@ -0,0 +1,296 @@
+import os
+import json
+import time
+import math
+import argparse
+import numpy as np
+import torch
+
+from dense_search import FlatIndex, read_topics, encode_queries, format_trec_run
+from doc_ids import DocIdTable
+from quantization import load_quant_params, dequantize_chunk
+
+try:
+    import faiss
+except ImportError:  # faiss 只有建立/使用 ANN 索引時才需要
+    faiss = None
+
+
+def _require_faiss():
+    if faiss is None:
+        raise ImportError("The ANN index requires faiss. Install it with `pip install faiss-cpu`.")
+
+
+def default_nlist(num_vectors):
+    """
+    IVF 分群數的經驗值：約 4 × sqrt(N)，取最接近的 2 的次方。
+    """
+    return max(1, 2 ** round(math.log2(max(1.0, 4 * math.sqrt(num_vectors)))))
+
+
+def make_factory_string(index_type, dim, num_vectors, nlist=None, pq_m=None, pq_bits=8, hnsw_m=32):
+    """
+    依預設組態產生 faiss index_factory 字串。
+    ivfpq: IVF + PQ；ivfpq-hnsw: 以 HNSW 做粗分群的 IVF-PQ；hnsw: HNSW + 原始向量。
+    """
+    nlist = nlist or default_nlist(num_vectors)
+    # 預設每個 PQ 子空間 8 維 (384 維 -> 48 個子向量)
+    pq_m = pq_m or max(1, dim // 8)
+    if index_type == 'ivfpq':
+        return f"IVF{nlist},PQ{pq_m}x{pq_bits}"
+    if index_type == 'ivfpq-hnsw':
+        return f"IVF{nlist}_HNSW{hnsw_m},PQ{pq_m}x{pq_bits}"
+    if index_type == 'hnsw':
+        return f"HNSW{hnsw_m},Flat"
+    raise ValueError(f"Unknown index type: {index_type}")
+
+
+def sample_rows(num_rows, sample_size, seed=0):
+    """
+    均勻抽樣訓練用的列號 (排序後回傳，讀取 memmap 時較連續)。
+    """
+    if sample_size >= num_rows:
+        return np.arange(num_rows)
+    rng = np.random.default_rng(seed)
+    return np.sort(rng.choice(num_rows, size=sample_size, replace=False))
+
+
+def build_ann_index(embeddings_path, ids_path, output_path, index_type='ivfpq', factory=None,
+                    train_size=None, add_chunk_size=1 << 20, ef_construction=None, num_threads=None, **factory_kwargs):
+    """
+    由 merge_temp_files 產生的 corpus_embeddings.npy 建立 faiss ANN 索引。
+    先以抽樣的向量訓練，再以 add_chunk_size 列為單位串流加入，最後把索引與對應的 meta 檔寫入磁碟。
+    索引中的列號即為語料嵌入矩陣的列號，因此直接沿用 merge 產生的 doc-ID 表。
+    float16 / int8 儲存的嵌入 (--storage) 逐塊還原成 float32 (int8 依 .quant.npz 的量化參數) 再訓練與加入，
+    分數與 float32 的嵌入同一個尺度。
+    """
+    _require_faiss()
+    if num_threads:
+        faiss.omp_set_num_threads(num_threads)
+
+    embeddings = np.load(embeddings_path, mmap_mode='r')
+    num_vectors, dim = embeddings.shape
+    quant_params = None
+    if embeddings.dtype == np.int8:
+        quant_params = load_quant_params(embeddings_path)
+        if quant_params is None:
+            raise ValueError(f"int8 embeddings '{embeddings_path}' have no quantization parameters "
+                             f"({embeddings_path}.quant.npz)")
+    elif embeddings.dtype not in (np.float32, np.float16):
+        raise ValueError(f"Unsupported embedding dtype {embeddings.dtype} in '{embeddings_path}'")
+    factory = factory or make_factory_string(index_type, dim, num_vectors, **factory_kwargs)
+    print(f"Building '{factory}' index for {num_vectors} vectors of dim {dim}...")
+
+    index = faiss.index_factory(dim, factory, faiss.METRIC_INNER_PRODUCT)
+    if ef_construction and isinstance(faiss.downcast_index(index), faiss.IndexHNSW):
+        faiss.downcast_index(index).hnsw.efConstruction = ef_construction
+
+    if not index.is_trained:
+        ivf = faiss.try_extract_index_ivf(index)
+        # faiss 建議每個分群至少約 39 個訓練向量
+        train_size = train_size or max(100000, 64 * (ivf.nlist if ivf is not None else 1))
+        train_rows = sample_rows(num_vectors, train_size)
+        print(f"Training on {len(train_rows)} sampled vectors...")
+        start = time.time()
+        index.train(np.ascontiguousarray(dequantize_chunk(embeddings[train_rows], quant_params)))
+        print(f"Training took {time.time() - start:.1f}s")
+
+    start = time.time()
+    for chunk_start in range(0, num_vectors, add_chunk_size):
+        chunk = dequantize_chunk(embeddings[chunk_start:chunk_start + add_chunk_size], quant_params)
+        chunk = np.ascontiguousarray(chunk)
+        index.add(chunk)
+        print(f"Added {min(chunk_start + add_chunk_size, num_vectors)}/{num_vectors} vectors "
+              f"({time.time() - start:.1f}s)")
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    faiss.write_index(index, output_path)
+    with open(f"{output_path}.meta.json", 'w', encoding='utf-8') as f:
+        json.dump({
+            'factory': factory,
+            'num_vectors': num_vectors,
+            'dim': dim,
+            'embeddings_path': os.path.abspath(embeddings_path),
+            'ids_path': os.path.abspath(ids_path),
+        }, f, indent=2)
+    print(f"Index saved to '{output_path}'")
+
+
+class AnnIndex:
+    """
+    faiss ANN 索引，search() 的介面與 FlatIndex 相同。
+    """
+    def __init__(self, index, meta=None):
+        _require_faiss()
+        self.index = index
+        self.meta = meta or {}
+
+    @classmethod
+    def load(cls, index_path, nprobe=None, ef_search=None, mmap=False):
+        _require_faiss()
+        flags = faiss.IO_FLAG_MMAP if mmap else 0
+        index = cls(faiss.read_index(index_path, flags))
+        meta_path = f"{index_path}.meta.json"
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                index.meta = json.load(f)
+        index.set_search_params(nprobe=nprobe, ef_search=ef_search)
+        return index
+
+    def __len__(self):
+        return self.index.ntotal
+
+    @property
+    def dim(self):
+        return self.index.d
+
+    def set_search_params(self, nprobe=None, ef_search=None):
+        """
+        調整搜尋參數：nprobe (IVF 檢查的分群數)、ef_search (HNSW 的候選清單大小)。
+        IVF 以 HNSW 做粗分群時，ef_search 套用在粗分群器上。
+        """
+        params = faiss.ParameterSpace()
+        if nprobe is not None:
+            params.set_index_parameter(self.index, 'nprobe', nprobe)
+        if ef_search is not None:
+            name = 'efSearch' if isinstance(faiss.downcast_index(self.index), faiss.IndexHNSW) else 'quantizer_efSearch'
+            params.set_index_parameter(self.index, name, ef_search)
+
+    def search(self, query_embeddings, k):
+        query_embeddings = np.ascontiguousarray(torch.as_tensor(query_embeddings, dtype=torch.float32).numpy())
+        scores, rows = self.index.search(query_embeddings, k)
+        return scores, rows
+
+
+def recall_at_k(approx_rows, exact_rows):
+    """
+    每個查詢的 ANN 結果與精確結果的重疊比例，回傳平均值。
+    """
+    recalls = []
+    for approx, exact in zip(approx_rows, exact_rows):
+        exact = exact[exact >= 0]
+        if len(exact):
+            recalls.append(len(np.intersect1d(approx[approx >= 0], exact)) / len(exact))
+    return float(np.mean(recalls)) if recalls else 0.0
+
+
+def sweep_search_params(ann_index, flat_index, query_embeddings, k=1000, nprobes=(None,), ef_searches=(None,)):
+    """
+    對每組 (nprobe, ef_search) 量測 recall@k (以精確掃描為基準) 與每個查詢的平均延遲。
+    """
+    start = time.time()
+    _, exact_rows = flat_index.search(query_embeddings, k)
+    exact_seconds = time.time() - start
+    results = [{
+        'nprobe': None, 'ef_search': None, 'method': 'flat',
+        f'recall@{k}': 1.0, 'ms_per_query': 1000 * exact_seconds / len(query_embeddings),
+    }]
+    for nprobe in nprobes:
+        for ef_search in ef_searches:
+            ann_index.set_search_params(nprobe=nprobe, ef_search=ef_search)
+            start = time.time()
+            _, approx_rows = ann_index.search(query_embeddings, k)
+            elapsed = time.time() - start
+            results.append({
+                'nprobe': nprobe, 'ef_search': ef_search, 'method': 'ann',
+                f'recall@{k}': recall_at_k(approx_rows, exact_rows),
+                'ms_per_query': 1000 * elapsed / len(query_embeddings),
+            })
+    return results
+
+
+def _encode_topics(topics_file, model_name, batch_size=256):
+    from run_dense_retrieval import load_model
+    topics = read_topics(topics_file)
+    tokenizer, model = load_model(model_name, 'cpu')
+    query_embeddings = encode_queries([query_text for _, query_text in topics], tokenizer, model, 'cpu', batch_size)
+    return topics, query_embeddings
+
+
+def _parse_int_list(value):
+    return [int(v) for v in value.split(',')] if value else [None]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build, search and evaluate ANN indexes over the merged corpus embeddings')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build = subparsers.add_parser('build', help='Train and build an ANN index')
+    build.add_argument('--embeddings', default='corpus_embeddings.npy')
+    build.add_argument('--ids', default='corpus_ids')
+    build.add_argument('--output', default='indexes/dense/ivfpq.faiss')
+    build.add_argument('--index-type', choices=['ivfpq', 'ivfpq-hnsw', 'hnsw'], default='ivfpq')
+    build.add_argument('--factory', default=None, help='Raw faiss index_factory string (overrides --index-type)')
+    build.add_argument('--nlist', type=int, default=None)
+    build.add_argument('--pq-m', type=int, default=None)
+    build.add_argument('--pq-bits', type=int, default=8)
+    build.add_argument('--hnsw-m', type=int, default=32)
+    build.add_argument('--ef-construction', type=int, default=None)
+    build.add_argument('--train-size', type=int, default=None)
+    build.add_argument('--threads', type=int, default=None)
+
+    for name, help_text in (('search', 'Search topics and write a TREC run'), ('evaluate', 'Report recall@k vs. exact flat search')):
+        sub = subparsers.add_parser(name, help=help_text)
+        sub.add_argument('--index', required=True)
+        sub.add_argument('--topics', required=True)
+        sub.add_argument('--model-name', default='pretrained_model/sentence-transformers/all-MiniLM-L6-v2')
+        sub.add_argument('--k', type=int, default=1000)
+        sub.add_argument('--mmap', action='store_true', help='Memory-map the index instead of loading it')
+        sub.add_argument('--threads', type=int, default=None)
+
+    search = subparsers.choices['search']
+    search.add_argument('--nprobe', type=int, default=None)
+    search.add_argument('--ef-search', type=int, default=None)
+    search.add_argument('--ids', default=None, help='Doc-ID table (defaults to the one recorded at build time)')
+    search.add_argument('--output', required=True)
+    search.add_argument('--run-name', default='MiniLM-ann')
+
+    evaluate = subparsers.choices['evaluate']
+    evaluate.add_argument('--nprobe', default='', help='Comma-separated nprobe values to sweep')
+    evaluate.add_argument('--ef-search', default='', help='Comma-separated efSearch values to sweep')
+    evaluate.add_argument('--embeddings', default=None, help='Embeddings for the exact scan (defaults to the build input)')
+    evaluate.add_argument('--output', default=None, help='Optional JSON report path')
+
+    args = parser.parse_args()
+    if args.threads:
+        _require_faiss()
+        faiss.omp_set_num_threads(args.threads)
+        torch.set_num_threads(args.threads)
+
+    if args.command == 'build':
+        build_ann_index(
+            args.embeddings, args.ids, args.output, index_type=args.index_type, factory=args.factory,
+            train_size=args.train_size, ef_construction=args.ef_construction,
+            nlist=args.nlist, pq_m=args.pq_m, pq_bits=args.pq_bits, hnsw_m=args.hnsw_m
+        )
+        return
+
+    ann_index = AnnIndex.load(args.index, mmap=args.mmap)
+    topics, query_embeddings = _encode_topics(args.topics, args.model_name)
+
+    if args.command == 'search':
+        ann_index.set_search_params(nprobe=args.nprobe, ef_search=args.ef_search)
+        corpus_ids = DocIdTable.load(args.ids or ann_index.meta['ids_path'])
+        scores, rows = ann_index.search(query_embeddings, args.k)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            for line in format_trec_run([query_id for query_id, _ in topics], scores, rows, corpus_ids, args.run_name):
+                f.write(line + '\n')
+        print(f"Run written to '{args.output}'")
+        return
+
+    flat_index = FlatIndex.load(args.embeddings or ann_index.meta['embeddings_path'])
+    results = sweep_search_params(
+        ann_index, flat_index, query_embeddings, k=args.k,
+        nprobes=_parse_int_list(args.nprobe), ef_searches=_parse_int_list(args.ef_search)
+    )
+    print(f"{'method':<6} {'nprobe':>7} {'efSearch':>9} {f'recall@{args.k}':>12} {'ms/query':>10}")
+    for result in results:
+        print(f"{result['method']:<6} {str(result['nprobe'] or '-'):>7} {str(result['ef_search'] or '-'):>9} "
+              f"{result[f'recall@{args.k}']:>12.4f} {result['ms_per_query']:>10.2f}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,513 @@
+import os
+import sys
+import gzip
+import json
+import time
+import shutil
+import platform
+import resource
+import argparse
+import subprocess
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+BENCHMARKS = ('converter', 'encode', 'merge', 'search', 'fusion')
+STORAGES = ('float32', 'float16', 'int8')
+SCALE_UNITS = {'k': 10 ** 3, 'm': 10 ** 6}
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def parse_count(value):
+    """
+    "10k"、"1m"、"250000" 之類的規模設定轉成整數。
+    """
+    value = str(value).strip().lower()
+    if value[-1:] in SCALE_UNITS:
+        return int(float(value[:-1]) * SCALE_UNITS[value[-1]])
+    return int(value)
+
+
+def peak_rss_mb():
+    # Linux 的 ru_maxrss 單位是 KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def latency_stats(seconds):
+    seconds = np.asarray(seconds, dtype=np.float64) * 1000
+    return {
+        'latency_ms_p50': round(float(np.percentile(seconds, 50)), 3),
+        'latency_ms_p99': round(float(np.percentile(seconds, 99)), 3),
+        'latency_ms_mean': round(float(seconds.mean()), 3),
+    }
+
+
+# --- 合成資料 ---
+
+def make_vocab(rng, size=50000):
+    """
+    隨機字母組成的假詞彙；依 Zipf 分佈抽樣時詞頻接近自然語言。
+    """
+    lengths = rng.integers(2, 12, size=size)
+    letters = rng.integers(97, 123, size=int(lengths.sum()), dtype=np.uint8).tobytes().decode('ascii')
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    return [letters[offsets[i]:offsets[i + 1]] for i in range(size)]
+
+
+def iter_synthetic_documents(num_segments, num_files, seed=0):
+    """
+    依 MS MARCO v2.1 分段語料的欄位與 docid 格式產生 (檔案編號, 段落 dict)：
+    每份文件 1~8 段，相鄰段落的字元範圍互相重疊，docid 的位移欄位單調遞增。
+    """
+    rng = np.random.default_rng(seed)
+    vocab = make_vocab(rng)
+    zipf_weights = 1.0 / np.arange(1, len(vocab) + 1)
+    zipf_weights /= zipf_weights.sum()
+    per_file = -(-num_segments // num_files)
+    produced = 0
+    for file_no in range(num_files):
+        offset = 0
+        in_file = min(per_file, num_segments - produced)
+        while in_file > 0:
+            doc_offset = offset
+            num_doc_segments = min(int(rng.integers(1, 9)), in_file)
+            title = ' '.join(rng.choice(vocab, size=int(rng.integers(3, 10)), p=zipf_weights))
+            for segment in range(num_doc_segments):
+                words = rng.choice(vocab, size=int(rng.integers(40, 160)), p=zipf_weights)
+                text = ' '.join(words)
+                start_char = segment * 800
+                yield file_no, {
+                    'docid': f"msmarco_v2.1_doc_{file_no:02d}_{doc_offset}#{segment}_{offset}",
+                    'url': f"http://example.com/{file_no}/{doc_offset}",
+                    'title': title,
+                    'headings': title,
+                    'segment': text,
+                    'start_char': start_char,
+                    'end_char': start_char + len(text),
+                }
+                offset += len(text) + 200
+            in_file -= num_doc_segments
+            produced += num_doc_segments
+
+
+def generate_raw_corpus(folder, num_segments, num_files=4, seed=0):
+    """
+    寫出與 msmarco_v2.1_doc_segmented 相同格式的 .json.gz 分片 (prepare_corpus.py 的輸入)。
+    """
+    os.makedirs(folder, exist_ok=True)
+    handles = {}
+    try:
+        for file_no, doc in iter_synthetic_documents(num_segments, num_files, seed):
+            if file_no not in handles:
+                path = os.path.join(folder, f"msmarco_v2.1_doc_segmented_{file_no:02d}.json.gz")
+                handles[file_no] = gzip.open(path, 'wt', encoding='utf-8', compresslevel=1)
+            handles[file_no].write(json.dumps(doc) + '\n')
+    finally:
+        for handle in handles.values():
+            handle.close()
+
+
+def synthetic_doc_ids(start, end, rows_per_file):
+    """
+    第 start~end 列的 docid (每份文件一個段落)，格式與 doc_ids.py 的壓縮表相容。
+    """
+    return [
+        f"msmarco_v2.1_doc_{row // rows_per_file:02d}_{row % rows_per_file}#0_{row % rows_per_file}"
+        for row in range(start, end)
+    ]
+
+
+def synthetic_embeddings(rng, num_rows, dim, centers):
+    """
+    以群中心加雜訊產生正規化的向量 (比均勻亂數更接近真實嵌入的分群結構，ANN 的行為才有代表性)。
+    """
+    vectors = centers[rng.integers(0, len(centers), size=num_rows)] + rng.standard_normal((num_rows, dim), dtype=np.float32) * 0.5
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def generate_temp_shards(folder, num_rows, dim, num_shards=8, seed=0, chunk_rows=1 << 18):
+    """
+    寫出與 run_dense_retrieval.py 暫存資料夾相同格式的分片 (ids.json、embed.npy、.done)，
+    讓 merge_temp_files 不需要模型也能以任意規模測試。
+    """
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((256, dim), dtype=np.float32)
+    rows_per_shard = -(-num_rows // num_shards)
+    rows_per_file = max(rows_per_shard, 1)
+    for shard in range(num_shards):
+        start, end = shard * rows_per_shard, min((shard + 1) * rows_per_shard, num_rows)
+        if start >= end:
+            break
+        base_path = os.path.join(folder, f"data___corpus___part_{shard:04d}.json.gz")
+        embeddings = np.lib.format.open_memmap(f"{base_path}.embed.npy", mode='w+', dtype=np.float32, shape=(end - start, dim))
+        for chunk_start in range(0, end - start, chunk_rows):
+            chunk_end = min(chunk_start + chunk_rows, end - start)
+            embeddings[chunk_start:chunk_end] = synthetic_embeddings(rng, chunk_end - chunk_start, dim, centers)
+        embeddings.flush()
+        del embeddings
+        with open(f"{base_path}.ids.json", 'w', encoding='utf-8') as f:
+            json.dump(synthetic_doc_ids(start, end, rows_per_file), f)
+        with open(f"{base_path}.done", 'w') as f:
+            f.write('done')
+    return np.random.default_rng(seed + 1), centers
+
+
+def generate_queries(path, num_queries, dim, centers, seed=0):
+    np.save(path, synthetic_embeddings(np.random.default_rng(seed), num_queries, dim, centers))
+
+
+def generate_runs(folder, num_runs, num_topics, depth, num_docs, seed=0):
+    """
+    寫出 num_runs 個彼此部分重疊的 TREC run (模擬 BM25 / 稠密檢索的候選)。
+    """
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+    pools = [rng.choice(num_docs, size=min(num_docs, depth * 2), replace=False) for _ in range(num_topics)]
+    for run in range(num_runs):
+        path = os.path.join(folder, f"run{run}.txt")
+        with open(path, 'w', encoding='utf-8') as f:
+            for topic, pool in enumerate(pools):
+                docs = rng.choice(pool, size=min(depth, len(pool)), replace=False)
+                scores = np.sort(rng.random(len(docs)))[::-1] * (run + 1) * 10
+                f.writelines(
+                    f"{topic} Q0 msmarco_v2.1_doc_00_{doc}#0_{doc} {rank} {score:.6f} r{run}\n"
+                    for rank, (doc, score) in enumerate(zip(docs.tolist(), scores.tolist()), 1)
+                )
+        paths.append(path)
+    return paths
+
+
+# --- 各項基準測試 (每項在獨立的子行程中執行，peak RSS 只反映該項) ---
+
+def bench_converter(raw_folder, output_folder, num_processes):
+    sys.path.insert(0, os.path.join(REPO_ROOT, 'scripts'))
+    from pathlib import Path
+    import prepare_corpus
+
+    shutil.rmtree(output_folder, ignore_errors=True)
+    os.makedirs(output_folder)
+    files = sorted(Path(raw_folder).glob('*.json.gz'))
+    input_bytes = sum(os.path.getsize(path) for path in files)
+    start = time.perf_counter()
+    prepare_corpus.convert_files(files, Path(output_folder), 'gzip', 6, num_processes, prepare_corpus.CHUNK_BYTES, None)
+    seconds = time.perf_counter() - start
+    segments = 0
+    for path in files:
+        with gzip.open(os.path.join(output_folder, path.name), 'rb') as f:
+            segments += sum(1 for _ in f)
+    return {
+        'seconds': round(seconds, 3), 'items': segments,
+        'items_per_second': round(segments / seconds, 1),
+        'mb_per_second': round(input_bytes / 2 ** 20 / seconds, 2),
+    }
+
+
+def bench_encode(corpus_folder, model_name, backend, num_texts, batch_size, token_budget, threads):
+    import torch
+    from encoders import load_model
+    from dense_search import encode_queries
+    from run_dense_retrieval import encode_contents
+
+    if threads:
+        torch.set_num_threads(threads)
+    texts = []
+    for filename in sorted(os.listdir(corpus_folder)):
+        with gzip.open(os.path.join(corpus_folder, filename), 'rt', encoding='utf-8') as f:
+            texts.extend(json.loads(line)['contents'] for line, _ in zip(f, range(num_texts - len(texts))))
+        if len(texts) >= num_texts:
+            break
+    tokenizer, model = load_model(model_name, 'cpu', backend, threads)
+    # 熱身一次，排除第一次呼叫的初始化成本
+    encode_contents(texts[:8], tokenizer, model, 'cpu', token_budget)
+
+    start = time.perf_counter()
+    for batch_start in range(0, len(texts), batch_size):
+        encode_contents(texts[batch_start:batch_start + batch_size], tokenizer, model, 'cpu', token_budget)
+    seconds = time.perf_counter() - start
+
+    queries = [' '.join(text.split()[:8]) for text in texts[:256]]
+    query_latencies = []
+    for query in queries[:64]:
+        query_start = time.perf_counter()
+        encode_queries([query], tokenizer, model, 'cpu')
+        query_latencies.append(time.perf_counter() - query_start)
+    return {
+        'seconds': round(seconds, 3), 'items': len(texts),
+        'items_per_second': round(len(texts) / seconds, 1),
+        **{f"query_{name}": value for name, value in latency_stats(query_latencies).items()},
+    }
+
+
+def bench_merge(temp_folder, output_prefix, storage):
+    from run_dense_retrieval import merge_temp_files
+
+    start = time.perf_counter()
+    merge_temp_files(temp_folder, f"{output_prefix}.npy", f"{output_prefix}_ids", storage=storage)
+    seconds = time.perf_counter() - start
+    rows = np.load(f"{output_prefix}.npy", mmap_mode='r').shape[0]
+    return {'seconds': round(seconds, 3), 'items': rows, 'items_per_second': round(rows / seconds, 1)}
+
+
+def bench_ann_build(embeddings_path, ids_path, index_path, index_type, threads):
+    from ann_index import build_ann_index
+
+    start = time.perf_counter()
+    build_ann_index(embeddings_path, ids_path, index_path, index_type=index_type, num_threads=threads)
+    seconds = time.perf_counter() - start
+    rows = np.load(embeddings_path, mmap_mode='r').shape[0]
+    return {'seconds': round(seconds, 3), 'items': rows, 'items_per_second': round(rows / seconds, 1)}
+
+
+def bench_search(index_path, queries_path, k, latency_queries, threads, exact_rows_path=None, nprobe=None, ef_search=None):
+    """
+    批次搜尋所有查詢的吞吐量 (QPS) 與逐一查詢的延遲；給定精確搜尋的結果時一併回報 recall@k。
+    """
+    import torch
+    from hybrid_search import load_dense_index
+
+    if threads:
+        torch.set_num_threads(threads)
+    index = load_dense_index(index_path, nprobe=nprobe, ef_search=ef_search)
+    queries = np.load(queries_path)
+    index.search(queries[:1], k)
+
+    start = time.perf_counter()
+    _, rows = index.search(queries, k)
+    seconds = time.perf_counter() - start
+
+    latencies = []
+    for query in queries[:latency_queries]:
+        query_start = time.perf_counter()
+        index.search(query[None, :], k)
+        latencies.append(time.perf_counter() - query_start)
+    result = {
+        'seconds': round(seconds, 3), 'items': len(queries), 'qps': round(len(queries) / seconds, 1),
+        **latency_stats(latencies),
+    }
+    if exact_rows_path is not None and os.path.exists(exact_rows_path):
+        from ann_index import recall_at_k
+        result['recall_at_k'] = round(float(recall_at_k(rows, np.load(exact_rows_path))), 4)
+    elif exact_rows_path is not None:
+        np.save(exact_rows_path, rows)
+    return result
+
+
+def bench_fusion(run_paths, method, k, sweep_size):
+    from fusion import DocidVocab, read_run, fuse_runs, fuse_runs_sweep
+
+    start = time.perf_counter()
+    vocab = DocidVocab()
+    runs = [read_run(path, vocab) for path in run_paths]
+    read_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fused = fuse_runs(runs, method=method, k=k)
+    seconds = time.perf_counter() - start
+
+    weight_grid = [[w, 1 - w] + [1.0] * (len(runs) - 2) for w in np.linspace(0, 1, sweep_size)]
+    start = time.perf_counter()
+    fuse_runs_sweep(runs, weight_grid, method=method, k=k)
+    sweep_seconds = time.perf_counter() - start
+    return {
+        'seconds': round(seconds, 3), 'items': len(fused), 'items_per_second': round(len(fused) / seconds, 1),
+        'read_seconds': round(read_seconds, 3), 'sweep_settings': sweep_size,
+        'sweep_seconds': round(sweep_seconds, 3),
+    }
+
+
+def _isolated(function, kwargs):
+    result = function(**kwargs)
+    result['peak_rss_mb'] = round(peak_rss_mb(), 1)
+    return result
+
+
+def run_isolated(function, **kwargs):
+    """
+    在新的 (spawn) 子行程中執行一項測試，回傳其結果與該行程的 peak RSS。
+    """
+    with ProcessPoolExecutor(1, mp_context=mp.get_context('spawn')) as pool:
+        return pool.submit(_isolated, function, kwargs).result()
+
+
+def environment_info():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    info = {
+        'host': platform.node(), 'platform': platform.platform(), 'python': platform.python_version(),
+        'cpu_count': os.cpu_count(), 'numpy': np.__version__, 'git_commit': commit or None,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    try:
+        import torch
+        info['torch'] = torch.__version__
+        info['torch_threads'] = torch.get_num_threads()
+    except ImportError:
+        pass
+    return info
+
+
+def run_benchmarks(args):
+    num_segments = parse_count(args.scale)
+    work_dir = os.path.join(args.work_dir, args.scale)
+    os.makedirs(work_dir, exist_ok=True)
+    results = []
+
+    def record(benchmark, mode, result):
+        result = {'benchmark': benchmark, 'mode': mode, 'scale': num_segments, **result}
+        print(json.dumps(result))
+        results.append(result)
+
+    raw_folder = os.path.join(work_dir, 'raw')
+    processed_folder = os.path.join(work_dir, 'processed')
+    if {'converter', 'encode'} & set(args.benchmarks):
+        if not os.path.isdir(raw_folder):
+            print(f"Generating a synthetic corpus of {num_segments} segments in '{raw_folder}'...")
+            # 文本語料只用於轉換與編碼，最多產生 converter_segments 段
+            generate_raw_corpus(raw_folder, min(num_segments, parse_count(args.converter_segments)), seed=args.seed)
+        record('converter', f"{args.num_processes}proc",
+               run_isolated(bench_converter, raw_folder=raw_folder, output_folder=processed_folder,
+                            num_processes=args.num_processes))
+
+    if 'encode' in args.benchmarks:
+        if not args.model_name:
+            print("Skipping the encode benchmark: --model-name is required")
+        else:
+            for backend in args.backends:
+                record('encode', backend, run_isolated(
+                    bench_encode, corpus_folder=processed_folder, model_name=args.model_name, backend=backend,
+                    num_texts=args.encode_texts, batch_size=args.batch_size, token_budget=args.token_budget,
+                    threads=args.threads
+                ))
+
+    temp_folder = os.path.join(work_dir, 'temp_output')
+    embeddings_prefix = os.path.join(work_dir, 'corpus_embeddings')
+    queries_path = os.path.join(work_dir, 'queries.npy')
+    if {'merge', 'search'} & set(args.benchmarks):
+        if not os.path.isdir(temp_folder):
+            print(f"Generating {num_segments} x {args.dim} synthetic embeddings in '{temp_folder}'...")
+            _, centers = generate_temp_shards(temp_folder, num_segments, args.dim, seed=args.seed)
+            generate_queries(queries_path, args.num_queries, args.dim, centers, seed=args.seed + 1)
+        for storage in STORAGES:
+            prefix = f"{embeddings_prefix}_{storage}"
+            if 'merge' in args.benchmarks or not os.path.exists(f"{prefix}.npy"):
+                record('merge', storage, run_isolated(bench_merge, temp_folder=temp_folder, output_prefix=prefix,
+                                                      storage=storage))
+
+    if 'search' in args.benchmarks:
+        exact_rows_path = os.path.join(work_dir, f"exact_rows_k{args.k}.npy")
+        if os.path.exists(exact_rows_path):
+            os.remove(exact_rows_path)
+        for storage in STORAGES:
+            # float32 最先執行，其結果作為其他模式 recall@k 的基準
+            record('search', f"flat-{storage}", run_isolated(
+                bench_search, index_path=f"{embeddings_prefix}_{storage}.npy", queries_path=queries_path, k=args.k,
+                latency_queries=args.latency_queries, threads=args.threads, exact_rows_path=exact_rows_path
+            ))
+        for index_type in args.ann_types:
+            try:
+                import faiss  # noqa: F401
+            except ImportError:
+                print("Skipping ANN benchmarks: faiss is not installed")
+                break
+            index_path = os.path.join(work_dir, f"ann_{index_type}.faiss")
+            record('ann_build', index_type, run_isolated(
+                bench_ann_build, embeddings_path=f"{embeddings_prefix}_float32.npy",
+                ids_path=f"{embeddings_prefix}_float32_ids", index_path=index_path, index_type=index_type,
+                threads=args.threads
+            ))
+            record('search', f"ann-{index_type}", run_isolated(
+                bench_search, index_path=index_path, queries_path=queries_path, k=args.k,
+                latency_queries=args.latency_queries, threads=args.threads, exact_rows_path=exact_rows_path,
+                nprobe=args.nprobe, ef_search=args.ef_search
+            ))
+
+    if 'fusion' in args.benchmarks:
+        run_paths = generate_runs(os.path.join(work_dir, 'runs'), 2, args.num_topics, args.k, num_segments, args.seed)
+        for method in ('rrf', 'weighted'):
+            record('fusion', method, run_isolated(bench_fusion, run_paths=run_paths, method=method, k=args.k,
+                                                  sweep_size=args.sweep_size))
+
+    output = {'environment': environment_info(), 'config': vars(args), 'results': results}
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(output, f, indent=2)
+    print(f"Results for {len(results)} benchmarks written to '{args.output}'")
+
+
+def compare_results(baseline_path, current_path, threshold=0.1):
+    """
+    比較兩次結果中相同 (benchmark, mode, scale) 的項目：吞吐量下降或延遲/耗時增加超過 threshold 視為退步。
+    回傳退步的項目數。
+    """
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = {(r['benchmark'], r['mode'], r['scale']): r for r in json.load(f)['results']}
+    with open(current_path, 'r', encoding='utf-8') as f:
+        current = json.load(f)['results']
+
+    regressions = 0
+    for result in current:
+        reference = baseline.get((result['benchmark'], result['mode'], result['scale']))
+        if reference is None:
+            continue
+        for metric in ('items_per_second', 'qps', 'latency_ms_p50', 'latency_ms_p99', 'peak_rss_mb'):
+            if metric not in result or not reference.get(metric):
+                continue
+            ratio = result[metric] / reference[metric]
+            higher_is_better = metric in ('items_per_second', 'qps')
+            regressed = ratio < 1 - threshold if higher_is_better else ratio > 1 + threshold
+            regressions += regressed
+            print(f"{result['benchmark']:<10} {result['mode']:<16} {metric:<18} "
+                  f"{reference[metric]:>12.2f} -> {result[metric]:>12.2f}  ({ratio - 1:+7.1%})"
+                  + ("  REGRESSION" if regressed else ""))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the retrieval stack on a reproducible synthetic corpus')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run = subparsers.add_parser('run', help='Generate (or reuse) synthetic data and run the benchmarks')
+    run.add_argument('--scale', default='100k', help='Number of segments, e.g. 10k, 1m, 10m')
+    run.add_argument('--work-dir', default='data/benchmark', help='Synthetic data is cached per scale under this folder')
+    run.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=list(BENCHMARKS))
+    run.add_argument('--output', default='benchmark_results.json')
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--dim', type=int, default=384)
+    run.add_argument('--threads', type=int, default=None, help='torch / faiss threads in each benchmark')
+    run.add_argument('--num-processes', type=int, default=os.cpu_count(), help='Converter worker processes')
+    run.add_argument('--converter-segments', default='1m', help='Cap on the size of the synthetic text corpus')
+    run.add_argument('--model-name', default=None, help='Encoder for the encode benchmark (skipped when unset)')
+    run.add_argument('--backends', nargs='+', default=['torch'], help='Encoder backends to compare (see encoders.py)')
+    run.add_argument('--encode-texts', type=int, default=4096)
+    run.add_argument('--batch-size', type=int, default=1024)
+    run.add_argument('--token-budget', type=int, default=16384)
+    run.add_argument('--num-queries', type=int, default=1000)
+    run.add_argument('--latency-queries', type=int, default=100, help='Queries searched one at a time for latency')
+    run.add_argument('--k', type=int, default=1000)
+    run.add_argument('--ann-types', nargs='*', default=['ivfpq', 'hnsw'])
+    run.add_argument('--nprobe', type=int, default=None)
+    run.add_argument('--ef-search', type=int, default=None)
+    run.add_argument('--num-topics', type=int, default=300, help='Topics per synthetic run for the fusion benchmark')
+    run.add_argument('--sweep-size', type=int, default=101, help='Weight settings in the fusion sweep benchmark')
+
+    compare = subparsers.add_parser('compare', help='Compare two result files and flag regressions')
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--threshold', type=float, default=0.1, help='Relative change counted as a regression')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run_benchmarks(args)
+    else:
+        regressions = compare_results(args.baseline, args.current, args.threshold)
+        print(f"{regressions} regression(s) beyond {args.threshold:.0%}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
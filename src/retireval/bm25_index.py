@@ -0,0 +1,586 @@
+import os
+import gzip
+import json
+import time
+import shutil
+import argparse
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import Pool, cpu_count, get_context
+
+import numpy as np
+from tqdm import tqdm
+
+from analyzer import analyze, term_counts
+from config import load_config
+from doc_ids import DocIdTable, DocIdTableWriter
+from segment_store import list_corpus_files
+from telemetry import Telemetry, add_telemetry_args
+
+# 每個視窗 2^16 個段落，區塊內的段落以 uint16 的視窗內位移儲存
+WINDOW_BITS = 16
+# Lucene SmallFloat.intToByte4 的前 24 個長度值原樣保存
+NUM_FREE_VALUES = 24
+
+
+def _int4_to_long(i):
+    bits = i & 0x07
+    shift = (i >> 3) - 1
+    return bits if shift == -1 else (bits | 0x08) << shift
+
+
+# BM25Similarity 的 LENGTH_TABLE：norm 位元組 -> 近似的段落長度
+LENGTH_TABLE = np.array(
+    [i if i < NUM_FREE_VALUES else NUM_FREE_VALUES + _int4_to_long(i - NUM_FREE_VALUES) for i in range(256)],
+    dtype=np.float32
+)
+
+
+def length_to_norm(lengths):
+    """
+    Lucene SmallFloat.intToByte4 的向量化版本：段落長度以 1 個位元組的 norm 儲存 (大於 24 時會失去精度)，
+    BM25 分數用的是這個近似長度而不是真正的長度。
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    rest = np.maximum(lengths - NUM_FREE_VALUES, 0)
+    num_bits = np.zeros_like(rest)
+    nonzero = rest > 0
+    num_bits[nonzero] = np.floor(np.log2(rest[nonzero])).astype(np.int64) + 1
+    shift = np.maximum(num_bits - 4, 0)
+    encoded = np.where(num_bits < 4, rest, ((rest >> shift) & 0x07) | ((shift + 1) << 3))
+    return np.where(lengths < NUM_FREE_VALUES, lengths, NUM_FREE_VALUES + encoded).astype(np.uint8)
+
+
+def bm25_idf(df, doc_count):
+    return np.log(1 + (doc_count - df + 0.5) / (df + 0.5)).astype(np.float32)
+
+
+def bm25_norm_inverse(k1, b, avgdl):
+    """
+    每個 norm 位元組對應的 1 / (k1 * (1 - b + b * dl / avgdl))，與 Lucene 相同以 float32 計算。
+    """
+    k1, b, avgdl = np.float32(k1), np.float32(b), np.float32(avgdl)
+    return (np.float32(1) / (k1 * ((np.float32(1) - b) + b * LENGTH_TABLE / avgdl))).astype(np.float32)
+
+
+def bm25_scores(idf, tf, norm_inverse):
+    """
+    Lucene 8 以後的 BM25 (不含 (k1 + 1) 因子)：idf - idf / (1 + tf * norm_inverse)。
+    """
+    tf = np.asarray(tf, dtype=np.float32)
+    return idf - idf / (np.float32(1) + tf * norm_inverse)
+
+
+class Vocabulary:
+    """
+    排序後的詞彙表：vocab.bin 為 UTF-8 詞串接，vocab_offsets.npy 為起點 (多一個結尾)，以二分搜尋查詢詞的編號。
+    UTF-8 的位元組順序與 Python 字串的碼位順序相同。
+    """
+
+    def __init__(self, path):
+        self.offsets = np.load(os.path.join(path, 'vocab_offsets.npy'), mmap_mode='r')
+        with open(os.path.join(path, 'vocab.bin'), 'rb') as f:
+            self.data = f.read()
+
+    @staticmethod
+    def write(path, terms):
+        encoded = [term.encode('utf-8') for term in terms]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(term) for term in encoded], out=offsets[1:])
+        with open(os.path.join(path, 'vocab.bin'), 'wb') as f:
+            f.write(b''.join(encoded))
+        np.save(os.path.join(path, 'vocab_offsets.npy'), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, term_id):
+        return self.data[self.offsets[term_id]:self.offsets[term_id + 1]].decode('utf-8')
+
+    def get(self, term):
+        key = term.encode('utf-8')
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.data[self.offsets[mid]:self.offsets[mid + 1]] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self.data[self.offsets[lo]:self.offsets[lo + 1]] == key:
+            return lo
+        return None
+
+
+def _analyze_file(task):
+    """
+    斷詞一個語料檔 (只索引 contents 欄位，與 Pyserini JsonCollection 相同)，以本檔自己的詞彙編號寫出
+    (詞, 段落, tf) 三欄、段落長度與 docid；回傳暫存輸出路徑、段落數與 posting 數。
+    """
+    filepath, part_path = task
+    vocab = {}
+    terms, docs, tfs, lengths = array('I'), array('I'), array('I'), array('I')
+    with gzip.open(filepath, 'rt', encoding='utf-8') as f_in, \
+            open(f"{part_path}.ids.txt", 'w', encoding='utf-8') as f_ids:
+        for line in f_in:
+            line = line.strip()
+            if not line:
+                continue
+            doc = json.loads(line)
+            tokens = analyze(doc.get('contents', ''))
+            counts = Counter(tokens)
+            for term, tf in counts.items():
+                terms.append(vocab.setdefault(term, len(vocab)))
+                tfs.append(tf)
+            docs.extend([len(lengths)] * len(counts))
+            lengths.append(len(tokens))
+            f_ids.write(doc['id'] + '\n')
+    with open(f"{part_path}.terms.txt", 'w', encoding='utf-8') as f:
+        f.writelines(f"{term}\n" for term in vocab)
+    np.save(f"{part_path}.postings.npy", np.stack([np.frombuffer(column, dtype=np.uint32) for column in (terms, docs, tfs)]))
+    np.save(f"{part_path}.lengths.npy", np.frombuffer(lengths, dtype=np.uint32))
+    return part_path, len(lengths), len(terms)
+
+
+def build_index(corpus_folder, output_path, k1=0.9, b=0.4, impact_bits=8, window_bits=WINDOW_BITS, num_processes=None):
+    """
+    從處理好的語料 (data/corpus/processed) 建立 BM25 impact 索引 (不需要 JVM)：
+      term_blocks.npy      每個詞的第一個區塊 (多一個結尾)；區塊 = (詞, 2^window_bits 個段落的視窗)
+      block_windows.npy    區塊所在的視窗
+      block_starts.npy     區塊在 postings 中的起點 (多一個結尾)
+      block_max.npy        區塊內最大的量化分數 (block-max)，查詢時用來跳過不可能進入 top-k 的視窗
+      postings_docs.npy    視窗內位移 (uint16)，依詞再依段落排序
+      postings_impacts.npy 以 k1 / b 預先算好並量化成 impact_bits 位元的 BM25 分數
+      doc_lengths.npy、term_df.npy、vocab.bin / vocab_offsets.npy、ids/ (doc-ID 表) 與 meta.json
+    列號與 segment_store.py / run_dense_retrieval.py 相同 (排序後的檔案順序)。
+    各檔案平行斷詞，合併時以兩次掃描寫出 postings (先取得全域最大分數作為量化比例，再分散寫入各詞的位置)。
+    """
+    if impact_bits not in (8, 16):
+        raise ValueError(f"impact_bits must be 8 or 16, got {impact_bits}")
+    if not 1 <= window_bits <= 16:
+        raise ValueError(f"window_bits must be between 1 and 16 (uint16 offsets), got {window_bits}")
+    files = list_corpus_files(corpus_folder)
+    if not files:
+        raise FileNotFoundError(f"No .json.gz files found in '{corpus_folder}'")
+    os.makedirs(output_path, exist_ok=True)
+    tmp_folder = os.path.join(output_path, 'tmp')
+    os.makedirs(tmp_folder, exist_ok=True)
+
+    tasks = [(filepath, os.path.join(tmp_folder, f"{i:05d}")) for i, filepath in enumerate(files)]
+    with Pool(num_processes or cpu_count()) as pool:
+        parts = list(tqdm(pool.imap(_analyze_file, tasks), total=len(tasks), desc="Analyzing"))
+
+    # 各檔的詞彙編號對應到全域 (依出現順序的) 暫時編號，同時累計 df
+    vocab = {}
+    df = np.zeros(0, dtype=np.int64)
+    for part_path, _, _ in tqdm(parts, desc="Merging vocabularies"):
+        with open(f"{part_path}.terms.txt", 'r', encoding='utf-8') as f:
+            local_terms = f.read().split('\n')[:-1]
+        mapping = np.fromiter((vocab.setdefault(term, len(vocab)) for term in local_terms), dtype=np.uint32,
+                              count=len(local_terms))
+        term_ids = mapping[np.load(f"{part_path}.postings.npy", mmap_mode='r')[0]]
+        np.save(f"{part_path}.term_ids.npy", term_ids)
+        df = np.pad(df, (0, len(vocab) - len(df)))
+        df += np.bincount(term_ids, minlength=len(vocab))
+
+    # 最終的詞編號依詞排序
+    terms = list(vocab)
+    del vocab
+    order = np.array(sorted(range(len(terms)), key=terms.__getitem__), dtype=np.int64)
+    new_ids = np.empty(len(terms), dtype=np.uint32)
+    new_ids[order] = np.arange(len(terms), dtype=np.uint32)
+    Vocabulary.write(output_path, [terms[i] for i in order])
+    df = df[order]
+    np.save(os.path.join(output_path, 'term_df.npy'), df.astype(np.uint32))
+
+    doc_lengths = np.concatenate([np.load(f"{part_path}.lengths.npy") for part_path, _, _ in parts])
+    np.save(os.path.join(output_path, 'doc_lengths.npy'), doc_lengths)
+    total_rows = len(doc_lengths)
+    # Lucene 的 docCount / avgdl 只計入 contents 至少有一個詞的段落
+    doc_count = int(np.count_nonzero(doc_lengths))
+    avgdl = float(doc_lengths.sum(dtype=np.int64)) / max(doc_count, 1)
+    norms = length_to_norm(doc_lengths)
+    norm_inverse = bm25_norm_inverse(k1, b, avgdl)
+    idf = bm25_idf(df.astype(np.float64), doc_count)
+
+    def part_scores(part_path, row):
+        postings = np.load(f"{part_path}.postings.npy", mmap_mode='r')
+        term_ids = new_ids[np.load(f"{part_path}.term_ids.npy")]
+        rows = postings[1].astype(np.int64) + row
+        return term_ids, rows, bm25_scores(idf[term_ids], postings[2], norm_inverse[norms[rows]])
+
+    row = 0
+    max_score = 0.0
+    for part_path, count, num_postings in tqdm(parts, desc="Scoring"):
+        if num_postings:
+            max_score = max(max_score, float(part_scores(part_path, row)[2].max()))
+        row += count
+
+    max_impact = 2 ** impact_bits - 1
+    impact_dtype = np.uint8 if impact_bits == 8 else np.uint16
+    scale = max_score / max_impact if max_score > 0 else 1.0
+    total_postings = int(df.sum())
+    postings_docs = np.lib.format.open_memmap(os.path.join(output_path, 'postings_docs.npy'), mode='w+',
+                                              dtype=np.uint16, shape=(total_postings,))
+    postings_impacts = np.lib.format.open_memmap(os.path.join(output_path, 'postings_impacts.npy'), mode='w+',
+                                                 dtype=impact_dtype, shape=(total_postings,))
+    # 每個詞下一個 posting 的寫入位置；各檔依列順序處理，所以每個詞的 postings 依段落排序
+    cursor = np.zeros(len(df) + 1, dtype=np.int64)
+    np.cumsum(df, out=cursor[1:])
+    cursor = cursor[:-1]
+    block_parts = []
+    ids_writer = DocIdTableWriter(os.path.join(output_path, 'ids'), total_rows)
+    row = 0
+    for part_path, count, num_postings in tqdm(parts, desc="Writing postings"):
+        with open(f"{part_path}.ids.txt", 'r', encoding='utf-8') as f_ids:
+            ids_writer.append(f_ids.read().splitlines())
+        if num_postings:
+            term_ids, rows, scores = part_scores(part_path, row)
+            impacts = np.clip(np.rint(scores / np.float32(scale)), 1, max_impact).astype(impact_dtype)
+            by_term = np.argsort(term_ids, kind='stable')
+            term_ids, rows, impacts = term_ids[by_term], rows[by_term], impacts[by_term]
+            group_terms, group_starts, group_counts = np.unique(term_ids, return_index=True, return_counts=True)
+            positions = cursor[term_ids] + (np.arange(len(term_ids)) - np.repeat(group_starts, group_counts))
+            postings_docs[positions] = rows & ((1 << window_bits) - 1)
+            postings_impacts[positions] = impacts
+            cursor[group_terms] += group_counts
+
+            windows = rows >> window_bits
+            boundaries = np.flatnonzero((term_ids[1:] != term_ids[:-1]) | (windows[1:] != windows[:-1])) + 1
+            starts = np.concatenate([[0], boundaries])
+            block_parts.append((
+                term_ids[starts], windows[starts].astype(np.uint32),
+                np.diff(np.append(starts, len(term_ids))), np.maximum.reduceat(impacts, starts)
+            ))
+        row += count
+    ids_writer.close()
+    postings_docs.flush()
+    postings_impacts.flush()
+
+    # 跨越檔案邊界的視窗在兩個檔案中各有一段，依 (詞, 視窗) 排序後合併
+    block_terms, block_windows, block_counts, block_max = (np.concatenate(column) for column in zip(*block_parts))
+    del block_parts
+    order = np.lexsort((block_windows, block_terms))
+    block_terms, block_windows, block_counts, block_max = (
+        block_terms[order], block_windows[order], block_counts[order], block_max[order]
+    )
+    starts = np.flatnonzero(np.concatenate([
+        [True], (block_terms[1:] != block_terms[:-1]) | (block_windows[1:] != block_windows[:-1])
+    ]))
+    block_counts = np.add.reduceat(block_counts, starts)
+    block_max = np.maximum.reduceat(block_max, starts)
+    block_terms, block_windows = block_terms[starts], block_windows[starts]
+    block_starts = np.zeros(len(block_counts) + 1, dtype=np.int64)
+    np.cumsum(block_counts, out=block_starts[1:])
+    np.save(os.path.join(output_path, 'term_blocks.npy'),
+            np.searchsorted(block_terms, np.arange(len(df) + 1)).astype(np.int64))
+    np.save(os.path.join(output_path, 'block_windows.npy'), block_windows)
+    np.save(os.path.join(output_path, 'block_starts.npy'), block_starts)
+    np.save(os.path.join(output_path, 'block_max.npy'), block_max)
+
+    meta = {
+        'count': total_rows, 'doc_count': doc_count, 'avgdl': avgdl, 'terms': len(df),
+        'postings': total_postings, 'blocks': len(block_counts),
+        'k1': k1, 'b': b, 'impact_bits': impact_bits, 'scale': scale, 'window_bits': window_bits,
+    }
+    with open(os.path.join(output_path, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
+    shutil.rmtree(tmp_folder)
+    print(f"BM25 impact index with {total_rows} segments, {len(df)} terms and {total_postings} postings "
+          f"in {len(block_counts)} blocks written to '{output_path}'")
+    return meta
+
+
+class ImpactIndex:
+    """
+    以 mmap 開啟的 BM25 impact 索引，查詢採視窗層級的 block-max 剪枝：
+    先以各查詢詞的 block_max 加總出每個視窗的分數上界，依上界由高到低處理視窗，
+    上界低於目前第 k 名的分數時即可停止 (其餘視窗不可能有段落進入 top-k)，結果與不剪枝的完整計算相同。
+    同一個視窗內以密集陣列累加各詞的 impact。查詢詞重複出現時分數乘上次數 (同 Pyserini 的 boost)。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.vocab = Vocabulary(path)
+        for name in ('term_blocks', 'block_windows', 'block_starts', 'block_max', 'postings_docs', 'postings_impacts'):
+            setattr(self, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r'))
+        self.scale = np.float32(self.meta['scale'])
+        self.window_bits = self.meta['window_bits']
+        self._accumulator = np.zeros(1 << self.window_bits, dtype=np.int64)
+
+    def __len__(self):
+        return self.meta['count']
+
+    def query_terms(self, query_text):
+        """
+        [(詞編號, 次數), ...]；索引中沒有的詞略過。
+        """
+        terms = []
+        for term, count in term_counts(query_text).items():
+            term_id = self.vocab.get(term)
+            if term_id is not None:
+                terms.append((term_id, count))
+        return terms
+
+    def search(self, query_text, k):
+        """
+        回傳 (scores[k'], rows[k'])，k' <= k，依分數由高到低 (同分時列號小者在前)。
+        """
+        terms = self.query_terms(query_text)
+        if not terms or k <= 0:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+        blocks = np.concatenate([np.arange(self.term_blocks[t], self.term_blocks[t + 1]) for t, _ in terms])
+        weights = np.concatenate([
+            np.full(self.term_blocks[t + 1] - self.term_blocks[t], count, dtype=np.int64) for t, count in terms
+        ])
+        windows = np.asarray(self.block_windows[blocks])
+        order = np.argsort(windows, kind='stable')
+        blocks, weights, windows = blocks[order], weights[order], windows[order]
+        starts = np.flatnonzero(np.concatenate([[True], windows[1:] != windows[:-1]]))
+        ends = np.append(starts[1:], len(windows))
+        upper_bounds = np.add.reduceat(self.block_max[blocks].astype(np.int64) * weights, starts)
+
+        top_scores = np.empty(0, dtype=np.int64)
+        top_rows = np.empty(0, dtype=np.int64)
+        threshold = -1
+        accumulator = self._accumulator
+        for i in np.argsort(-upper_bounds, kind='stable'):
+            # 同分時列號小者優先，所以上界等於門檻的視窗仍要處理
+            if upper_bounds[i] < threshold:
+                break
+            base = int(windows[starts[i]]) << self.window_bits
+            if ends[i] - starts[i] == 1:
+                start, end = self.block_starts[blocks[starts[i]]], self.block_starts[blocks[starts[i]] + 1]
+                offsets = self.postings_docs[start:end].astype(np.int64)
+                scores = self.postings_impacts[start:end].astype(np.int64) * weights[starts[i]]
+            else:
+                touched = []
+                for block, weight in zip(blocks[starts[i]:ends[i]], weights[starts[i]:ends[i]]):
+                    start, end = self.block_starts[block], self.block_starts[block + 1]
+                    offsets = self.postings_docs[start:end]
+                    # 同一區塊內的位移不重複，可直接以索引累加
+                    accumulator[offsets] += self.postings_impacts[start:end].astype(np.int64) * weight
+                    touched.append(offsets)
+                offsets = np.unique(np.concatenate(touched)).astype(np.int64)
+                scores = accumulator[offsets]
+                accumulator[offsets] = 0
+            if len(top_scores) >= k:
+                keep = scores >= threshold
+                offsets, scores = offsets[keep], scores[keep]
+            top_scores = np.concatenate([top_scores, scores])
+            top_rows = np.concatenate([top_rows, offsets + base])
+            if len(top_scores) >= k:
+                best = np.lexsort((top_rows, -top_scores))[:k]
+                top_scores, top_rows = top_scores[best], top_rows[best]
+                threshold = top_scores[-1]
+        best = np.lexsort((top_rows, -top_scores))[:k]
+        return top_scores[best].astype(np.float32) * self.scale, top_rows[best]
+
+
+_worker_index = None
+
+
+def _init_worker(index_path):
+    global _worker_index
+    _worker_index = ImpactIndex(index_path)
+
+
+def _search_worker(task):
+    query_texts, k = task
+    return [_worker_index.search(query_text, k) for query_text in query_texts]
+
+
+class NativeBm25Retriever:
+    """
+    與 hybrid_search.Bm25Retriever 相同介面的原生 BM25 檢索器；threads > 1 時以工作行程平行處理一批中的各個查詢
+    (每個工作行程各自 mmap 同一份索引)。k1 / b 在建立索引時已算進 impact，傳入時必須與索引相同。
+    """
+
+    def __init__(self, index_dir, k1=None, b=None, threads=8, chunk_size=8):
+        self.index = ImpactIndex(index_dir)
+        for name, value in (('k1', k1), ('b', b)):
+            if value is not None and not np.isclose(value, self.index.meta[name]):
+                raise ValueError(f"Native BM25 index '{index_dir}' was built with {name}={self.index.meta[name]}, "
+                                 f"got {name}={value}; rebuild it with bm25_index.py build")
+        self.corpus_ids = DocIdTable.load(os.path.join(index_dir, 'ids'))
+        self.threads = threads
+        self.chunk_size = chunk_size
+        self.executor = None
+        if threads > 1:
+            self.executor = ProcessPoolExecutor(
+                max_workers=threads, mp_context=get_context('spawn'), initializer=_init_worker, initargs=(index_dir,)
+            )
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def search_texts(self, query_texts, k):
+        """
+        [(scores, rows), ...]，順序與 query_texts 相同。
+        """
+        query_texts = list(query_texts)
+        if self.executor is None or len(query_texts) <= 1:
+            return [self.index.search(query_text, k) for query_text in query_texts]
+        tasks = [(query_texts[i:i + self.chunk_size], k) for i in range(0, len(query_texts), self.chunk_size)]
+        return [result for chunk in self.executor.map(_search_worker, tasks) for result in chunk]
+
+    def search(self, query_ids, query_texts, k):
+        """
+        回傳 {query_id: (docids, scores)}，依分數由高到低排序。
+        """
+        return {
+            query_id: (self.corpus_ids.decode(rows), scores)
+            for query_id, (scores, rows) in zip(query_ids, self.search_texts(query_texts, k))
+        }
+
+
+def exact_search(index_path, corpus_folder, query_text, k):
+    """
+    不量化、不剪枝的暴力 BM25 (同一個分析器與 Lucene 的長度近似)，用來確認 impact 索引的誤差；只適合小語料。
+    """
+    index = ImpactIndex(index_path)
+    query = term_counts(query_text)
+    doc_lengths = np.load(os.path.join(index_path, 'doc_lengths.npy'))
+    df = np.load(os.path.join(index_path, 'term_df.npy'))
+    norm_inverse = bm25_norm_inverse(index.meta['k1'], index.meta['b'], index.meta['avgdl'])[length_to_norm(doc_lengths)]
+    scores = np.zeros(len(doc_lengths), dtype=np.float32)
+    row = 0
+    for filepath in list_corpus_files(corpus_folder):
+        with gzip.open(filepath, 'rt', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                counts = Counter(analyze(json.loads(line).get('contents', '')))
+                for term, count in query.items():
+                    term_id = index.vocab.get(term)
+                    if counts.get(term) and term_id is not None:
+                        idf = bm25_idf(float(df[term_id]), index.meta['doc_count'])
+                        scores[row] += count * bm25_scores(idf, counts[term], norm_inverse[row])
+                row += 1
+    rows = np.lexsort((np.arange(len(scores)), -scores))[:k]
+    rows = rows[scores[rows] > 0]
+    return scores[rows], rows
+
+
+def read_trec_run(path):
+    """
+    {query_id: ([docid, ...], [score, ...])}，依檔案中的順序。
+    """
+    run = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 6:
+                continue
+            docids, scores = run.setdefault(fields[0], ([], []))
+            docids.append(fields[2])
+            scores.append(float(fields[4]))
+    return run
+
+
+def compare_runs(reference, run, depths=(10, 100, 1000)):
+    """
+    與參考 run (例如 Pyserini 的 BM25) 比較：各深度的 top-k 重疊率、第一名相同的比例，
+    以及兩邊都取回的段落的分數差 (量化誤差與分析器差異都會反映在這裡)。
+    """
+    overlaps = {depth: [] for depth in depths}
+    same_top1 = []
+    score_diffs = []
+    for query_id, (ref_docids, ref_scores) in reference.items():
+        docids, scores = run.get(query_id, ([], []))
+        for depth in depths:
+            expected = set(ref_docids[:depth])
+            if expected:
+                overlaps[depth].append(len(expected & set(docids[:depth])) / len(expected))
+        if ref_docids:
+            same_top1.append(bool(docids) and docids[0] == ref_docids[0])
+        ref_by_docid = dict(zip(ref_docids, ref_scores))
+        score_diffs.extend(abs(score - ref_by_docid[docid]) for docid, score in zip(docids, scores)
+                           if docid in ref_by_docid)
+    score_diffs = np.array(score_diffs) if score_diffs else np.zeros(1)
+    return {
+        'topics': len(reference),
+        'missing_topics': sum(1 for query_id in reference if query_id not in run),
+        **{f"overlap@{depth}": float(np.mean(values)) if values else None for depth, values in overlaps.items()},
+        'same_top1': float(np.mean(same_top1)) if same_top1 else None,
+        'score_diff_mean': float(score_diffs.mean()),
+        'score_diff_p99': float(np.percentile(score_diffs, 99)),
+        'score_diff_max': float(score_diffs.max()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Native NumPy BM25 impact index with block-max pruning')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build = subparsers.add_parser('build', help='Build the impact index from the processed corpus')
+    build.add_argument('--corpus-folder', default='data/corpus/processed/')
+    build.add_argument('--output', default='indexes/bm25_native')
+    build.add_argument('--config', default=None, help='retrieval_config.yaml (bm25.k1 / bm25.b)')
+    build.add_argument('--k1', type=float, default=None)
+    build.add_argument('--b', type=float, default=None)
+    build.add_argument('--impact-bits', type=int, choices=(8, 16), default=None)
+    build.add_argument('--window-bits', type=int, default=WINDOW_BITS, help='Segments per block-max window (log2)')
+    build.add_argument('--num-processes', type=int, default=None)
+
+    search = subparsers.add_parser('search', help='Retrieve a TREC run for a topics file')
+    search.add_argument('--index', default='indexes/bm25_native')
+    search.add_argument('--topics', required=True)
+    search.add_argument('--output', required=True)
+    search.add_argument('--run-name', default='bm25_native')
+    search.add_argument('--k', type=int, default=1000)
+    search.add_argument('--threads', type=int, default=cpu_count(), help='Worker processes (parallel across topics)')
+    add_telemetry_args(search)
+
+    parity = subparsers.add_parser('parity', help='Compare a native run with a reference (Pyserini) BM25 run')
+    parity.add_argument('--reference', required=True, help='Reference run, e.g. from Pyserini')
+    parity.add_argument('--run', required=True, help='Run retrieved with the native index')
+    parity.add_argument('--min-overlap', type=float, default=None,
+                        help='Exit with status 1 if overlap@10 falls below this value')
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        bm25_config = load_config(args.config).get('bm25', {}) if args.config else {}
+        k1 = args.k1 if args.k1 is not None else bm25_config.get('k1', 0.9)
+        b = args.b if args.b is not None else bm25_config.get('b', 0.4)
+        impact_bits = args.impact_bits or bm25_config.get('impact_bits', 8)
+        start = time.time()
+        build_index(args.corpus_folder, args.output, k1=k1, b=b, impact_bits=impact_bits,
+                    window_bits=args.window_bits, num_processes=args.num_processes)
+        print(f"Built in {time.time() - start:.1f}s")
+
+    elif args.command == 'search':
+        from dense_search import read_topics, format_trec_run
+        telemetry = Telemetry.from_args(args, 'bm25_native')
+        with telemetry.stage('load'):
+            retriever = NativeBm25Retriever(args.index, threads=args.threads)
+            topics = read_topics(args.topics)
+        start = time.time()
+        with telemetry.stage('retrieve', items=len(topics)):
+            results = retriever.search_texts([query_text for _, query_text in topics], args.k)
+        elapsed = time.time() - start
+        with telemetry.stage('write'), open(args.output, 'w', encoding='utf-8') as f:
+            for (query_id, _), (scores, rows) in zip(topics, results):
+                f.writelines(f"{line}\n" for line in format_trec_run(
+                    [query_id], [scores], [rows], retriever.corpus_ids, args.run_name
+                ))
+        retriever.close()
+        telemetry.close()
+        print(f"Retrieved {len(topics)} topics in {elapsed:.2f}s ({len(topics) / max(elapsed, 1e-9):.1f} queries/s) "
+              f"-> '{args.output}'")
+
+    else:
+        report = compare_runs(read_trec_run(args.reference), read_trec_run(args.run))
+        for name, value in report.items():
+            print(f"{name:>16}: {value:.4f}" if isinstance(value, float) else f"{name:>16}: {value}")
+        if args.min_overlap is not None and (report['overlap@10'] or 0) < args.min_overlap:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,11 @@
+import yaml
+
+
+def load_config(config_path):
+    """
+    讀取 configs/ 下的 YAML 設定檔；未提供路徑時回傳空設定。
+    """
+    if not config_path:
+        return {}
+    with open(config_path, 'r', encoding='utf-8') as f:
+        return yaml.safe_load(f) or {}
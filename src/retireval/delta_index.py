@@ -0,0 +1,527 @@
+import os
+import sys
+import json
+import time
+import fcntl
+import argparse
+import subprocess
+from contextlib import contextmanager
+
+import numpy as np
+
+from dense_search import FlatIndex
+from doc_ids import DocIdTable, DocIdTableWriter
+from quantization import STORAGE_DTYPES, load_quant_params, save_quant_params
+from run_dense_retrieval import list_temp_shards, merge_shards
+from sharded_search import merge_shard_results
+
+MANIFEST_NAME = 'index.live.json'
+SEGMENT_FOLDER = 'segments'
+
+
+def _storage_name(dtype):
+    for name, storage_dtype in STORAGE_DTYPES.items():
+        if np.dtype(storage_dtype) == dtype:
+            return name
+    raise ValueError(f"Unsupported embedding dtype {dtype}")
+
+
+def _shard_key(json_path):
+    """
+    暫存檔的名稱 (原始語料路徑把 / 換成 ___)，作為來源的識別。
+    """
+    return os.path.basename(json_path)[:-len('.ids.json')]
+
+
+def _fingerprint(embed_path):
+    """
+    重新編碼的暫存檔會以新檔案改名取代，大小或修改時間就會不同。
+    """
+    stat = os.stat(embed_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def list_done_shards(temp_output_folder):
+    """
+    [(key, ids.json, embed.npy), ...]，只包含已有 .done 標記 (編碼完成) 的暫存檔，依檔名排序。
+    """
+    shards = []
+    for json_path, embed_path in list_temp_shards(temp_output_folder):
+        if os.path.exists(f"{json_path[:-len('.ids.json')]}.done"):
+            shards.append((_shard_key(json_path), json_path, embed_path))
+    return shards
+
+
+def load_manifest(manifest_path):
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _write_manifest(manifest_path, manifest):
+    """
+    先寫暫存檔再改名，讀取端 (LiveIndex.refresh) 不會讀到寫一半的清單。
+    """
+    tmp_path = f"{manifest_path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+@contextmanager
+def manifest_lock(manifest_path, blocking=True):
+    """
+    修改清單 (update / compact 的最後一步) 時的檔案鎖；blocking=False 且已被占用時產生 False。
+    """
+    with open(f"{manifest_path}.lock", 'w') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _path(manifest_path, relative):
+    return os.path.join(os.path.dirname(os.path.abspath(manifest_path)), relative)
+
+
+def _relpath(manifest_path, path):
+    return os.path.relpath(os.path.abspath(path), os.path.dirname(os.path.abspath(manifest_path)))
+
+
+def read_deleted(manifest_path, segment):
+    """
+    分段的 tombstone：已刪除 / 被取代的分段內列號 (排序、不重複)。
+    """
+    if not segment.get('deleted'):
+        return np.empty(0, dtype=np.int64)
+    return np.load(_path(manifest_path, segment['deleted']))
+
+
+def _write_deleted(manifest_path, segment, rows):
+    rows = np.unique(np.asarray(rows, dtype=np.int64))
+    relative = os.path.join(SEGMENT_FOLDER, f"{segment['name']}.deleted.npy")
+    tmp_path = f"{_path(manifest_path, relative)}.tmp{os.getpid()}.npy"
+    np.save(tmp_path, rows)
+    os.replace(tmp_path, _path(manifest_path, relative))
+    segment['deleted'] = relative
+    segment['num_deleted'] = int(len(rows))
+
+
+def _segment_offsets(segments):
+    offsets = np.zeros(len(segments) + 1, dtype=np.int64)
+    np.cumsum([segment['rows'] for segment in segments], out=offsets[1:])
+    return offsets
+
+
+def init_live_index(embeddings_path, ids_path, temp_output_folder, output_folder):
+    """
+    以 merge_temp_files 的輸出作為 base 分段建立可增量更新的索引清單 (<output_folder>/index.live.json)。
+    base 的嵌入與 doc-ID 表不複製，只記錄路徑；暫存資料夾中的每個檔案記為一個來源 (在 base 中的列區間與指紋)，
+    之後 update 只需要處理指紋改變或新增的檔案。
+    """
+    embeddings = np.load(embeddings_path, mmap_mode='r')
+    shards = list_temp_shards(temp_output_folder)
+    manifest_path = os.path.join(output_folder, MANIFEST_NAME)
+    os.makedirs(os.path.join(output_folder, SEGMENT_FOLDER), exist_ok=True)
+
+    sources = {}
+    row = 0
+    for json_path, embed_path in shards:
+        rows = int(np.load(embed_path, mmap_mode='r').shape[0])
+        sources[_shard_key(json_path)] = {
+            'segment': 'base', 'start': row, 'rows': rows, 'fingerprint': _fingerprint(embed_path)
+        }
+        row += rows
+    if row != embeddings.shape[0]:
+        raise ValueError(f"'{temp_output_folder}' holds {row} rows but '{embeddings_path}' has {embeddings.shape[0]}; "
+                         f"initialize from the temp folder the base was merged from")
+
+    manifest = {
+        'generation': 0,
+        'storage': _storage_name(embeddings.dtype),
+        'dim': int(embeddings.shape[1]),
+        'temp_folder': _relpath(manifest_path, temp_output_folder),
+        'next_segment': 1,
+        'segments': [{
+            'name': 'base', 'embeddings': _relpath(manifest_path, embeddings_path),
+            'ids': _relpath(manifest_path, ids_path), 'rows': int(embeddings.shape[0]),
+            'deleted': None, 'num_deleted': 0,
+        }],
+        'sources': sources,
+    }
+    _write_manifest(manifest_path, manifest)
+    print(f"Live index with {embeddings.shape[0]} base rows from {len(sources)} files written to '{manifest_path}'")
+    return manifest_path
+
+
+def _lookup_live(manifest_path, segments, doc_ids):
+    """
+    {分段名稱: 分段內列號} ，doc_ids 在各分段中 (尚未刪除) 的位置。
+    """
+    found = {}
+    for segment in segments:
+        rows = DocIdTable.load(_path(manifest_path, segment['ids'])).lookup(doc_ids)
+        rows = rows[rows >= 0]
+        rows = rows[~np.isin(rows, read_deleted(manifest_path, segment))]
+        if len(rows):
+            found[segment['name']] = rows
+    return found
+
+
+def update_live_index(manifest_path, temp_output_folder=None, delete_ids=(), prune_missing=False, copy_rows=1 << 20):
+    """
+    把暫存資料夾中新完成 (.done) 或重新編碼過 (指紋改變) 的檔案合併成一個新的 delta 分段，
+    並對被取代的舊列、在其他檔案中重新出現的 docid、delete_ids 以及 (prune_missing 時) 已從暫存資料夾移除的檔案
+    寫入 tombstone。工作量只和變動的檔案大小有關。回傳摘要 dict。
+    """
+    with manifest_lock(manifest_path):
+        manifest = load_manifest(manifest_path)
+        temp_output_folder = temp_output_folder or _path(manifest_path, manifest['temp_folder'])
+        segments = {segment['name']: segment for segment in manifest['segments']}
+        done = list_done_shards(temp_output_folder)
+        changed = [
+            (key, json_path, embed_path) for key, json_path, embed_path in done
+            if key not in manifest['sources'] or manifest['sources'][key]['fingerprint'] != _fingerprint(embed_path)
+        ]
+        removed = []
+        if prune_missing:
+            done_keys = {key for key, _, _ in done}
+            removed = [key for key in manifest['sources'] if key not in done_keys]
+
+        deletions = {}
+        for key in [key for key, _, _ in changed if key in manifest['sources']] + removed:
+            source = manifest['sources'].pop(key)
+            deletions.setdefault(source['segment'], []).append(
+                np.arange(source['start'], source['start'] + source['rows'], dtype=np.int64)
+            )
+
+        added_rows = 0
+        if changed:
+            name = f"delta_{manifest['next_segment']:04d}"
+            embeddings_path = os.path.join(SEGMENT_FOLDER, f"{name}.npy")
+            ids_path = os.path.join(SEGMENT_FOLDER, f"{name}_ids")
+            quant_params = None
+            if manifest['storage'] == 'int8':
+                # delta 沿用 base 的量化範圍，壓縮後的 base 也能直接串接整數碼
+                quant_params = load_quant_params(_path(manifest_path, manifest['segments'][0]['embeddings']))
+            added_rows = merge_shards(
+                [(json_path, embed_path) for _, json_path, embed_path in changed],
+                _path(manifest_path, embeddings_path), _path(manifest_path, ids_path), copy_rows,
+                manifest['storage'], quant_params
+            )
+            # 在其他檔案中仍存活的相同 docid (段落改放到別的檔案) 以新分段為準
+            new_ids = []
+            for key, json_path, embed_path in changed:
+                with open(json_path, 'r', encoding='utf-8') as f:
+                    ids = json.load(f)
+                manifest['sources'][key] = {
+                    'segment': name, 'start': len(new_ids), 'rows': len(ids), 'fingerprint': _fingerprint(embed_path)
+                }
+                new_ids.extend(ids)
+            for segment_name, rows in _lookup_live(manifest_path, manifest['segments'], new_ids).items():
+                deletions.setdefault(segment_name, []).append(rows)
+            segment = {'name': name, 'embeddings': embeddings_path, 'ids': ids_path, 'rows': added_rows,
+                       'deleted': None, 'num_deleted': 0}
+            manifest['segments'].append(segment)
+            segments[name] = segment
+            manifest['next_segment'] += 1
+
+        if delete_ids:
+            for segment_name, rows in _lookup_live(manifest_path, manifest['segments'], list(delete_ids)).items():
+                deletions.setdefault(segment_name, []).append(rows)
+
+        deleted_rows = 0
+        for segment_name, rows in deletions.items():
+            segment = segments[segment_name]
+            before = segment['num_deleted']
+            _write_deleted(manifest_path, segment, np.concatenate([read_deleted(manifest_path, segment)] + rows))
+            deleted_rows += segment['num_deleted'] - before
+        if changed or deleted_rows:
+            manifest['generation'] += 1
+            _write_manifest(manifest_path, manifest)
+    return {
+        'generation': manifest['generation'], 'changed_files': len(changed), 'removed_files': len(removed),
+        'added_rows': added_rows, 'deleted_rows': deleted_rows, **index_stats(manifest),
+    }
+
+
+def index_stats(manifest):
+    total = sum(segment['rows'] for segment in manifest['segments'])
+    deleted = sum(segment['num_deleted'] for segment in manifest['segments'])
+    base = manifest['segments'][0]
+    return {
+        'segments': len(manifest['segments']), 'rows': total, 'live_rows': total - deleted, 'deleted': deleted,
+        # 需要壓縮掉的比例：tombstone 加上 delta 分段的列數 (相對於總列數)
+        'garbage_ratio': (deleted + total - base['rows']) / max(total, 1),
+    }
+
+
+def compact_live_index(manifest_path, copy_rows=1 << 20, keep_old=False):
+    """
+    把目前所有分段的存活列依序寫成新的 base (segments/base_<generation>.npy 與 doc-ID 表)，丟棄 tombstone。
+    耗時的複製不持有清單鎖，期間的 update 仍可進行：換上新 base 時，壓縮期間新增的 delta 分段保留，
+    對舊分段新增的 tombstone 則換算成新 base 的列號。同一時間只會有一個壓縮在執行。
+    """
+    with manifest_lock(f"{manifest_path}.compact", blocking=False) as acquired:
+        if not acquired:
+            print(f"Another compaction of '{manifest_path}' is running")
+            return None
+        with manifest_lock(manifest_path):
+            snapshot = load_manifest(manifest_path)
+        segments = snapshot['segments']
+        deleted = {segment['name']: read_deleted(manifest_path, segment) for segment in segments}
+        live_rows = sum(segment['rows'] - len(deleted[segment['name']]) for segment in segments)
+        name = f"base_{snapshot['generation']:04d}"
+        embeddings_path = os.path.join(SEGMENT_FOLDER, f"{name}.npy")
+        ids_path = os.path.join(SEGMENT_FOLDER, f"{name}_ids")
+
+        output = np.lib.format.open_memmap(_path(manifest_path, embeddings_path), mode='w+',
+                                           dtype=STORAGE_DTYPES[snapshot['storage']], shape=(live_rows, snapshot['dim']))
+        ids_writer = DocIdTableWriter(_path(manifest_path, ids_path), live_rows)
+        new_offsets = {}
+        row = 0
+        for segment in segments:
+            new_offsets[segment['name']] = row
+            embeddings = np.load(_path(manifest_path, segment['embeddings']), mmap_mode='r')
+            corpus_ids = DocIdTable.load(_path(manifest_path, segment['ids']))
+            mask = np.ones(segment['rows'], dtype=bool)
+            mask[deleted[segment['name']]] = False
+            for start in range(0, segment['rows'], copy_rows):
+                keep = np.flatnonzero(mask[start:start + copy_rows]) + start
+                output[row:row + len(keep)] = embeddings[keep]
+                ids_writer.append(corpus_ids.decode(keep))
+                row += len(keep)
+            output.flush()
+        ids_writer.close()
+        del output
+        quant_params = None
+        if snapshot['storage'] == 'int8':
+            quant_params = load_quant_params(_path(manifest_path, segments[0]['embeddings']))
+            save_quant_params(_path(manifest_path, embeddings_path), quant_params)
+
+        def remap(segment_name, rows):
+            # 舊分段內列號 -> 新 base 列號 (減去之前被刪除的列數)
+            return new_offsets[segment_name] + rows - np.searchsorted(deleted[segment_name], rows)
+
+        with manifest_lock(manifest_path):
+            current = load_manifest(manifest_path)
+            compacted = {segment['name'] for segment in segments}
+            base = {'name': name, 'embeddings': embeddings_path, 'ids': ids_path, 'rows': live_rows,
+                    'deleted': None, 'num_deleted': 0}
+            late_deletions = [
+                remap(segment['name'], np.setdiff1d(read_deleted(manifest_path, segment), deleted[segment['name']]))
+                for segment in current['segments'] if segment['name'] in compacted
+            ]
+            for source in current['sources'].values():
+                if source['segment'] in compacted:
+                    dropped = deleted[source['segment']]
+                    end = source['start'] + source['rows']
+                    source['rows'] -= int(np.searchsorted(dropped, end) - np.searchsorted(dropped, source['start']))
+                    source['start'] = int(remap(source['segment'], np.array([source['start']]))[0])
+                    source['segment'] = name
+            late_deletions = np.concatenate(late_deletions) if late_deletions else np.empty(0, dtype=np.int64)
+            if len(late_deletions):
+                _write_deleted(manifest_path, base, late_deletions)
+            old_segments = [segment for segment in current['segments'] if segment['name'] in compacted]
+            current['segments'] = [base] + [segment for segment in current['segments'] if segment['name'] not in compacted]
+            current['generation'] += 1
+            _write_manifest(manifest_path, current)
+
+        if not keep_old:
+            # 只刪除 segments/ 下由本模組產生的檔案，init 時指定的原始 base 保留；
+            # 已 mmap 舊檔的讀取端在 Linux 上不受影響，下一次 refresh 就會改用新 base
+            segment_folder = os.path.abspath(_path(manifest_path, SEGMENT_FOLDER))
+            for segment in old_segments:
+                for relative in (segment['embeddings'], f"{segment['embeddings']}.quant.npz", segment['deleted'],
+                                 segment['ids']):
+                    path = os.path.abspath(_path(manifest_path, relative)) if relative else None
+                    if path is None or not path.startswith(segment_folder + os.sep) or not os.path.exists(path):
+                        continue
+                    if os.path.isdir(path):
+                        for filename in os.listdir(path):
+                            os.remove(os.path.join(path, filename))
+                        os.rmdir(path)
+                    else:
+                        os.remove(path)
+    print(f"Compacted {len(segments)} segments into '{embeddings_path}' ({live_rows} rows)")
+    return index_stats(current)
+
+
+def start_background_compaction(manifest_path, log_path=None):
+    """
+    以獨立的行程在背景壓縮 (不隨呼叫端結束)，輸出寫到 <清單>.compact.log。
+    """
+    log_path = log_path or f"{manifest_path}.compact.log"
+    with open(log_path, 'a') as log:
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), 'compact', '--index', manifest_path],
+            stdout=log, stderr=subprocess.STDOUT, start_new_session=True
+        )
+    print(f"Background compaction started (pid {process.pid}), log: '{log_path}'")
+    return process
+
+
+class SegmentedDocIds:
+    """
+    跨 base 與各 delta 分段的 doc-ID 表，介面與 DocIdTable 相同 (decode / lookup / len)。
+    LiveIndex 重新加載時就地更新，持有這個物件的 DenseRetriever 不需要重建。
+    """
+
+    def __init__(self, tables=(), offsets=(0,)):
+        self.reset(tables, offsets)
+
+    def reset(self, tables, offsets):
+        self.tables = list(tables)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, row):
+        return self.decode([row])[0]
+
+    def decode(self, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        parts = np.searchsorted(self.offsets, rows, side='right') - 1
+        doc_ids = [None] * len(rows)
+        for part in np.unique(parts):
+            positions = np.flatnonzero(parts == part)
+            for position, doc_id in zip(positions, self.tables[part].decode(rows[positions] - self.offsets[part])):
+                doc_ids[position] = doc_id
+        return doc_ids
+
+    def lookup(self, doc_ids):
+        """
+        docid → 全域列號，找不到的回傳 -1；同一個 docid 出現在多個分段時回傳最新的分段。
+        """
+        rows = np.full(len(doc_ids), -1, dtype=np.int64)
+        for table, offset in zip(self.tables, self.offsets):
+            found = table.lookup(doc_ids)
+            rows = np.where(found >= 0, found + offset, rows)
+        return rows
+
+
+class LiveIndex:
+    """
+    base + delta 分段的精確搜尋：每個分段以 FlatIndex 掃描並在分塊內排除 tombstone 列，
+    各分段的 top-k 以全域列號 (依分段順序串接) 合併。search() 的介面與 FlatIndex 相同，
+    corpus_ids 為對應的 SegmentedDocIds。每次搜尋前檢查清單，update / compact 之後自動改用新的分段。
+    """
+
+    def __init__(self, manifest_path, block_size=131072):
+        self.manifest_path = manifest_path
+        self.block_size = block_size
+        self.corpus_ids = SegmentedDocIds()
+        self.meta = {}
+        self.parts = []
+        self._stamp = None
+        self.refresh()
+
+    @classmethod
+    def load(cls, manifest_path, block_size=131072):
+        return cls(manifest_path, block_size=block_size)
+
+    def refresh(self):
+        """
+        清單有變動時重新加載，回傳是否重新加載。
+        """
+        stamp = os.stat(self.manifest_path).st_mtime_ns
+        if stamp == self._stamp:
+            return False
+        manifest = load_manifest(self.manifest_path)
+        parts, tables = [], []
+        offsets = _segment_offsets(manifest['segments'])
+        for segment, offset in zip(manifest['segments'], offsets):
+            index = FlatIndex.load(_path(self.manifest_path, segment['embeddings']), block_size=self.block_size)
+            deleted = None
+            if segment['num_deleted']:
+                deleted = np.zeros(segment['rows'], dtype=bool)
+                deleted[read_deleted(self.manifest_path, segment)] = True
+            parts.append((index, deleted, int(offset)))
+            tables.append(DocIdTable.load(_path(self.manifest_path, segment['ids'])))
+        self.parts = parts
+        self.corpus_ids.reset(tables, offsets)
+        self.meta = {'generation': manifest['generation'], **index_stats(manifest)}
+        self._stamp = stamp
+        return True
+
+    def __len__(self):
+        return len(self.corpus_ids)
+
+    @property
+    def dim(self):
+        return self.parts[0][0].dim
+
+    def search(self, query_embeddings, k):
+        self.refresh()
+        results = []
+        for index, deleted, offset in self.parts:
+            scores, rows = index.search(query_embeddings, k, deleted=deleted)
+            results.append((scores, np.where(rows >= 0, rows + offset, -1)))
+        return merge_shard_results(results, k)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Incremental dense index: base + delta segments with tombstones')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    init = subparsers.add_parser('init', help='Start a live index from the merged embeddings')
+    init.add_argument('--embeddings', default='corpus_embeddings.npy')
+    init.add_argument('--ids', default='corpus_ids')
+    init.add_argument('--temp-output-folder', default='temp_output', help='Temp folder the base was merged from')
+    init.add_argument('--output', default='indexes/dense_live')
+
+    update = subparsers.add_parser('update', help='Append changed temp files as a delta segment')
+    update.add_argument('--index', default=f"indexes/dense_live/{MANIFEST_NAME}")
+    update.add_argument('--temp-output-folder', default=None, help='Defaults to the folder given at init')
+    update.add_argument('--delete-ids', default=None, help='File with one docid per line to tombstone')
+    update.add_argument('--prune-missing', action='store_true',
+                        help='Tombstone rows of files that are no longer in the temp folder')
+    update.add_argument('--compact-threshold', type=float, default=None,
+                        help='Start a background compaction when tombstones + delta rows exceed this fraction')
+
+    compact = subparsers.add_parser('compact', help='Rewrite the live rows into a new base segment')
+    compact.add_argument('--index', default=f"indexes/dense_live/{MANIFEST_NAME}")
+    compact.add_argument('--background', action='store_true', help='Run in a detached process')
+    compact.add_argument('--keep-old', action='store_true', help='Keep the files of the compacted segments')
+
+    status = subparsers.add_parser('status', help='Print segments and tombstone counts')
+    status.add_argument('--index', default=f"indexes/dense_live/{MANIFEST_NAME}")
+
+    args = parser.parse_args()
+    if args.command == 'init':
+        init_live_index(args.embeddings, args.ids, args.temp_output_folder, args.output)
+
+    elif args.command == 'update':
+        delete_ids = []
+        if args.delete_ids:
+            with open(args.delete_ids, 'r', encoding='utf-8') as f:
+                delete_ids = [line.strip() for line in f if line.strip()]
+        start = time.time()
+        summary = update_live_index(args.index, args.temp_output_folder, delete_ids, args.prune_missing)
+        print(f"Updated in {time.time() - start:.1f}s: {json.dumps(summary)}")
+        if args.compact_threshold is not None and summary['garbage_ratio'] > args.compact_threshold:
+            start_background_compaction(args.index)
+
+    elif args.command == 'compact':
+        if args.background:
+            start_background_compaction(args.index)
+        else:
+            start = time.time()
+            compact_live_index(args.index, keep_old=args.keep_old)
+            print(f"Compacted in {time.time() - start:.1f}s")
+
+    else:
+        manifest = load_manifest(args.index)
+        print(f"generation {manifest['generation']}: {json.dumps(index_stats(manifest))}")
+        for segment in manifest['segments']:
+            print(f"  {segment['name']:<12} rows {segment['rows']:>10}  deleted {segment['num_deleted']:>10}  "
+                  f"{segment['embeddings']}")
+
+
+if __name__ == '__main__':
+    main()
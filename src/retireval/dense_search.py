@@ -0,0 +1,133 @@
+import numpy as np
+import torch
+
+from run_dense_retrieval import encode_features
+from quantization import load_quant_params
+
+
+def read_topics(topics_file):
+    """
+    讀取 TREC 主題檔 (每行 query_id<TAB>query_text)，回傳 [(query_id, query_text), ...]。
+    """
+    topics = []
+    with open(topics_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            query_id, query_text = line.split('\t', 1)
+            topics.append((query_id, query_text))
+    return topics
+
+
+def encode_queries(query_texts, tokenizer, model, device, batch_size=256):
+    """
+    以批次方式一次編碼所有查詢，回傳正規化後的 (Q, dim) 嵌入向量。
+    """
+    query_embeddings = []
+    for start in range(0, len(query_texts), batch_size):
+        encoded_input = tokenizer(
+            query_texts[start:start + batch_size], padding=True, truncation=True, return_tensors='pt'
+        ).to(device)
+        query_embeddings.append(encode_features(encoded_input, model))
+    return torch.cat(query_embeddings)
+
+
+def merge_topk(scores, rows, new_scores, new_rows, k):
+    """
+    把目前的 top-k 與另一組候選合併，回傳新的 top-k (scores, rows)。
+    """
+    if scores is None:
+        return new_scores, new_rows
+    merged_scores = torch.cat([scores, new_scores], dim=1)
+    merged_rows = torch.cat([rows, new_rows], dim=1)
+    top_scores, positions = torch.topk(merged_scores, k=min(k, merged_scores.shape[1]), dim=1, largest=True)
+    return top_scores, torch.gather(merged_rows, 1, positions)
+
+
+class FlatIndex:
+    """
+    精確 (暴力) 內積搜尋。語料嵌入以 memory-map 讀取並以固定列數分塊掃描，
+    每塊只保留各查詢的 block-local top-k 再與目前結果合併，
+    因此不會建立長度為 N 的完整分數向量，記憶體用量只和 block_size × 查詢數有關。
+
+    嵌入可用 float16 或 int8 (每維度 scale/offset，見 quantization.py) 儲存以減少磁碟與記憶體頻寬：
+    float16 逐塊轉回 float32；int8 則把 scale 乘進查詢向量，直接對整數碼計算分數再加上偏移量。
+    """
+    def __init__(self, embeddings, block_size=131072, quant_params=None):
+        self.embeddings = embeddings
+        self.block_size = block_size
+        self.quant_params = quant_params
+
+    @classmethod
+    def load(cls, embeddings_path, block_size=131072):
+        embeddings = np.load(embeddings_path, mmap_mode='r')
+        quant_params = None
+        if embeddings.dtype == np.int8:
+            quant_params = load_quant_params(embeddings_path)
+            if quant_params is None:
+                raise FileNotFoundError(f"Missing quantization parameters for int8 embeddings '{embeddings_path}'")
+        return cls(embeddings, block_size=block_size, quant_params=quant_params)
+
+    def __len__(self):
+        return self.embeddings.shape[0]
+
+    @property
+    def dim(self):
+        return self.embeddings.shape[1]
+
+    def read_block(self, start, end):
+        """
+        讀取 [start, end) 列並轉成 float32 張量 (int8 儲存時為未還原的整數碼)。
+        """
+        return torch.from_numpy(np.array(self.embeddings[start:end], dtype=np.float32))
+
+    def search(self, query_embeddings, k, start_row=0, end_row=None, deleted=None):
+        """
+        回傳每個查詢的 top-k (scores, rows)，形狀皆為 (Q, k)，依分數由高到低排序。
+        可用 start_row/end_row 只掃描部分列，回傳的列號仍是全域列號。
+        deleted 為長度 N 的布林遮罩 (delta_index.py 的 tombstone)，這些列在分塊掃描時直接排除；
+        存活的列不足 k 個時，空位的列號為 -1。
+        """
+        query_embeddings = torch.as_tensor(query_embeddings, dtype=torch.float32)
+        bias = None
+        if self.quant_params is not None:
+            # x ≈ code * scale + (offset + 128 * scale)，所以 q·x = (q * scale)·code + q·(offset + 128 * scale)
+            scale = torch.from_numpy(self.quant_params['scale'])
+            offset = torch.from_numpy(self.quant_params['offset'])
+            bias = (query_embeddings @ (offset + 128 * scale)).unsqueeze(1)
+            query_embeddings = query_embeddings * scale
+        end_row = len(self) if end_row is None else end_row
+        top_scores, top_rows = None, None
+        for start in range(start_row, end_row, self.block_size):
+            end = min(start + self.block_size, end_row)
+            # (Q, dim) @ (dim, B) -> (Q, B)
+            block_scores = torch.mm(query_embeddings, self.read_block(start, end).T)
+            if bias is not None:
+                block_scores += bias
+            if deleted is not None:
+                block_deleted = torch.from_numpy(np.asarray(deleted[start:end], dtype=bool))
+                if block_deleted.any():
+                    block_scores[:, block_deleted] = -float('inf')
+            block_top = torch.topk(block_scores, k=min(k, end - start), dim=1, largest=True)
+            top_scores, top_rows = merge_topk(top_scores, top_rows, block_top.values, block_top.indices + start, k)
+        if top_scores is None:
+            empty = torch.empty((len(query_embeddings), 0))
+            return empty.numpy(), empty.long().numpy()
+        top_scores, top_rows = top_scores.numpy(), top_rows.numpy()
+        if deleted is not None:
+            top_rows[np.isneginf(top_scores)] = -1
+        return top_scores, top_rows
+
+
+def format_trec_run(query_ids, scores, rows, corpus_ids, run_name):
+    """
+    產生 TREC 格式的結果行：query_id Q0 document_id rank score run_name。
+    只對 top-k 的列號組回 docid 字串；列號為 -1 (ANN 索引找不到足夠結果時) 的位置會略過。
+    """
+    for query_id, query_scores, query_rows in zip(query_ids, scores, rows):
+        valid = query_rows >= 0
+        query_scores, query_rows = query_scores[valid], query_rows[valid]
+        doc_ids = corpus_ids.decode(query_rows)
+        for rank, (score, doc_id) in enumerate(zip(query_scores.tolist(), doc_ids), 1):
+            yield f"{query_id} Q0 {doc_id} {rank} {score:.4f} {run_name}"
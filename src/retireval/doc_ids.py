@@ -0,0 +1,235 @@
+import os
+import re
+import json
+import argparse
+import numpy as np
+
+# MS MARCO v2.1 段落 ID：msmarco_v2.1_doc_<檔案編號>_<文件位移>#<段落序號>_<段落位移>
+DOCID_PATTERN = re.compile(r'^(.*_)(\d+)_(\d+)#(\d+)_(\d+)$')
+DEFAULT_PREFIX = 'msmarco_v2.1_doc_'
+EXTRA_FILE = np.iinfo(np.uint16).max  # 無法解析的 ID 以此檔案編號標記，原字串存在 extra.bin
+KEY_SHIFT = 40
+
+COLUMNS = {
+    'file': np.uint16,
+    'doc_offset': np.uint64,
+    'segment': np.uint32,
+    'segment_offset': np.uint64,
+}
+
+
+def make_keys(files, segment_offsets):
+    """
+    排序用的鍵值：(檔案編號 << 40) | 段落位移；段落位移在同一個分段檔內是唯一的。
+    """
+    return (np.asarray(files, dtype=np.uint64) << np.uint64(KEY_SHIFT)) | np.asarray(segment_offsets, dtype=np.uint64)
+
+
+def parse_docid(doc_id, prefix=DEFAULT_PREFIX, file_width=2):
+    """
+    解析段落 ID，回傳 (檔案編號, 文件位移, 段落序號, 段落位移)；
+    格式不符或無法原樣還原時回傳 None。
+    """
+    match = DOCID_PATTERN.match(doc_id)
+    if match is None or match.group(1) != prefix:
+        return None
+    file_no, doc_offset, segment, segment_offset = (int(group) for group in match.groups()[1:])
+    if file_no >= EXTRA_FILE or format_docid(prefix, file_width, file_no, doc_offset, segment, segment_offset) != doc_id:
+        return None
+    return file_no, doc_offset, segment, segment_offset
+
+
+def format_docid(prefix, file_width, file_no, doc_offset, segment, segment_offset):
+    return f"{prefix}{file_no:0{file_width}d}_{doc_offset}#{segment}_{segment_offset}"
+
+
+class DocIdTableWriter:
+    """
+    串流寫入緊湊的二進位 doc-ID 表 (一個資料夾，內含數個可 mmap 的 .npy 欄位)。
+    需要預先知道總筆數，append() 依列順序寫入，close() 時建立 docid → 列號 的排序索引。
+    """
+    def __init__(self, path, count, prefix=DEFAULT_PREFIX, file_width=2):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.count = count
+        self.prefix = prefix
+        self.file_width = file_width
+        self.columns = {
+            name: np.lib.format.open_memmap(os.path.join(path, f"{name}.npy"), mode='w+', dtype=dtype, shape=(count,))
+            for name, dtype in COLUMNS.items()
+        }
+        self.extra = open(os.path.join(path, 'extra.bin'), 'wb')
+        self.extra_size = 0
+        self.row = 0
+
+    def append(self, doc_ids):
+        if self.row + len(doc_ids) > self.count:
+            raise ValueError(f"DocIdTableWriter expected {self.count} ids, got more")
+        parsed = np.empty((len(doc_ids), 4), dtype=np.uint64)
+        for i, doc_id in enumerate(doc_ids):
+            fields = parse_docid(doc_id, self.prefix, self.file_width)
+            if fields is None:
+                # 無法解析的 ID：doc_offset/segment_offset 改存 extra.bin 中的位置與長度
+                raw = doc_id.encode('utf-8')
+                self.extra.write(raw)
+                fields = (EXTRA_FILE, self.extra_size, 0, len(raw))
+                self.extra_size += len(raw)
+            parsed[i] = fields
+        end = self.row + len(doc_ids)
+        for j, name in enumerate(COLUMNS):
+            self.columns[name][self.row:end] = parsed[:, j]
+        self.row = end
+
+    def close(self):
+        if self.row != self.count:
+            raise ValueError(f"DocIdTableWriter expected {self.count} ids, got {self.row}")
+        self.extra.close()
+        keys = make_keys(self.columns['file'], self.columns['segment_offset'])
+        order = np.argsort(keys, kind='stable')
+        np.save(os.path.join(self.path, 'sorted_keys.npy'), keys[order])
+        np.save(os.path.join(self.path, 'sorted_rows.npy'), order.astype(np.int64))
+        for column in self.columns.values():
+            column.flush()
+        with open(os.path.join(self.path, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({
+                'count': self.count,
+                'prefix': self.prefix,
+                'file_width': self.file_width,
+                'extra_bytes': self.extra_size,
+            }, f, indent=2)
+        self.columns = None
+
+
+def write_doc_id_table(path, doc_ids, **kwargs):
+    """
+    把一個 ID 清單一次寫成 doc-ID 表。
+    """
+    writer = DocIdTableWriter(path, len(doc_ids), **kwargs)
+    writer.append(doc_ids)
+    writer.close()
+
+
+class DocIdTable:
+    """
+    可 mmap 的 doc-ID 表。列號 → docid 只在需要時 (例如 top-k 結果) 才組回字串，
+    docid → 列號 則透過排序後的鍵值以二分搜尋查找。
+    """
+    def __init__(self, columns, sorted_keys, sorted_rows, extra=b'', prefix=DEFAULT_PREFIX, file_width=2):
+        self.file = columns['file']
+        self.doc_offset = columns['doc_offset']
+        self.segment = columns['segment']
+        self.segment_offset = columns['segment_offset']
+        self.sorted_keys = sorted_keys
+        self.sorted_rows = sorted_rows
+        self.extra = extra
+        self.prefix = prefix
+        self.file_width = file_width
+        self._extra_lookup = None
+
+    @classmethod
+    def load(cls, path):
+        """
+        加載 doc-ID 表；若給的是舊格式的 JSON 清單，則在記憶體中建立同樣的結構。
+        """
+        if not os.path.isdir(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                return cls.from_ids(json.load(f))
+
+        with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        columns = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r') for name in COLUMNS}
+        extra = b''
+        if meta.get('extra_bytes'):
+            with open(os.path.join(path, 'extra.bin'), 'rb') as f:
+                extra = f.read()
+        return cls(
+            columns,
+            np.load(os.path.join(path, 'sorted_keys.npy'), mmap_mode='r'),
+            np.load(os.path.join(path, 'sorted_rows.npy'), mmap_mode='r'),
+            extra=extra, prefix=meta['prefix'], file_width=meta['file_width']
+        )
+
+    @classmethod
+    def from_ids(cls, doc_ids, prefix=DEFAULT_PREFIX, file_width=2):
+        columns = {name: np.empty(len(doc_ids), dtype=dtype) for name, dtype in COLUMNS.items()}
+        extra = bytearray()
+        for i, doc_id in enumerate(doc_ids):
+            fields = parse_docid(doc_id, prefix, file_width)
+            if fields is None:
+                raw = doc_id.encode('utf-8')
+                fields = (EXTRA_FILE, len(extra), 0, len(raw))
+                extra.extend(raw)
+            for name, value in zip(COLUMNS, fields):
+                columns[name][i] = value
+        keys = make_keys(columns['file'], columns['segment_offset'])
+        order = np.argsort(keys, kind='stable')
+        return cls(columns, keys[order], order.astype(np.int64), bytes(extra), prefix, file_width)
+
+    def __len__(self):
+        return len(self.file)
+
+    def __getitem__(self, row):
+        return self.decode([row])[0]
+
+    def decode(self, rows):
+        """
+        把列號轉回 docid 字串，只讀取這些列。
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        files = self.file[rows]
+        doc_offsets = self.doc_offset[rows]
+        segments = self.segment[rows]
+        segment_offsets = self.segment_offset[rows]
+        doc_ids = []
+        for file_no, doc_offset, segment, segment_offset in zip(
+            files.tolist(), doc_offsets.tolist(), segments.tolist(), segment_offsets.tolist()
+        ):
+            if file_no == EXTRA_FILE:
+                doc_ids.append(self.extra[doc_offset:doc_offset + segment_offset].decode('utf-8'))
+            else:
+                doc_ids.append(format_docid(self.prefix, self.file_width, file_no, doc_offset, segment, segment_offset))
+        return doc_ids
+
+    def lookup(self, doc_ids):
+        """
+        docid → 列號，找不到的回傳 -1。
+        """
+        rows = np.full(len(doc_ids), -1, dtype=np.int64)
+        parsed = [parse_docid(doc_id, self.prefix, self.file_width) for doc_id in doc_ids]
+        valid = np.array([fields is not None for fields in parsed], dtype=bool)
+        if valid.any() and len(self.sorted_keys):
+            fields = np.array([fields for fields in parsed if fields is not None], dtype=np.uint64)
+            keys = make_keys(fields[:, 0], fields[:, 3])
+            positions = np.searchsorted(self.sorted_keys, keys)
+            positions = np.minimum(positions, len(self.sorted_keys) - 1)
+            found = np.asarray(self.sorted_keys[positions]) == keys
+            candidates = np.asarray(self.sorted_rows[positions])
+            # 再比對其餘欄位，確保鍵值相同時仍是同一個段落
+            found &= np.asarray(self.doc_offset[candidates]) == fields[:, 1]
+            found &= np.asarray(self.segment[candidates]) == fields[:, 2]
+            rows[np.flatnonzero(valid)] = np.where(found, candidates, -1)
+        for i in np.flatnonzero(~valid):
+            rows[i] = self._lookup_extra(doc_ids[i])
+        return rows
+
+    def _lookup_extra(self, doc_id):
+        if self._extra_lookup is None:
+            extra_rows = np.flatnonzero(np.asarray(self.file) == EXTRA_FILE)
+            self._extra_lookup = dict(zip(self.decode(extra_rows), extra_rows.tolist()))
+        return self._extra_lookup.get(doc_id, -1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert a JSON list of doc ids into a packed doc-ID table')
+    parser.add_argument('input', help='Path to corpus_ids.json')
+    parser.add_argument('output', help='Output directory for the packed table')
+    args = parser.parse_args()
+
+    with open(args.input, 'r', encoding='utf-8') as f:
+        doc_ids = json.load(f)
+    write_doc_id_table(args.output, doc_ids)
+    print(f"Packed {len(doc_ids)} doc ids into '{args.output}'")
+
+
+if __name__ == '__main__':
+    main()
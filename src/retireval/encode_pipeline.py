@@ -0,0 +1,193 @@
+import gzip
+import json
+import queue
+import threading
+import time
+
+import torch
+
+_END = object()
+
+
+class StageStats:
+    """
+    單一管線階段的吞吐量計數器。
+    busy_seconds 為實際工作的時間，wait_seconds 為等待上游 (取不到資料) 或下游 (佇列已滿) 的時間；
+    某階段 wait 很少而其他階段 wait 很多時，它就是瓶頸。
+    """
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.tokens = 0
+        self.busy_seconds = 0.0
+        self.wait_seconds = 0.0
+
+    def add(self, items, busy_seconds, tokens=0):
+        self.items += items
+        self.tokens += tokens
+        self.busy_seconds += busy_seconds
+
+    @property
+    def items_per_second(self):
+        return self.items / self.busy_seconds if self.busy_seconds > 0 else 0.0
+
+    def as_dict(self):
+        return {
+            'stage': self.name,
+            'items': self.items,
+            'tokens': self.tokens,
+            'busy_seconds': round(self.busy_seconds, 3),
+            'wait_seconds': round(self.wait_seconds, 3),
+            'items_per_second': round(self.items_per_second, 1),
+        }
+
+    def __str__(self):
+        return (f"{self.name:<8} {self.items:>10} items  busy {self.busy_seconds:8.1f}s  "
+                f"wait {self.wait_seconds:8.1f}s  {self.items_per_second:10.1f} items/s")
+
+
+def new_pipeline_stats():
+    """
+    建立讀取/解析、tokenize、模型編碼三個階段的計數器。
+    """
+    return {name: StageStats(name) for name in ('read', 'tokenize', 'encode')}
+
+
+def _put(q, item, stop_event, stats):
+    # 佇列滿時定期檢查 stop_event，避免下游出錯後背景執行緒永遠卡住
+    start = time.perf_counter()
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            break
+        except queue.Full:
+            continue
+    stats.wait_seconds += time.perf_counter() - start
+
+
+def _get(q, stop_event, stats):
+    start = time.perf_counter()
+    item = _END
+    while not stop_event.is_set():
+        try:
+            item = q.get(timeout=0.1)
+            break
+        except queue.Empty:
+            continue
+    stats.wait_seconds += time.perf_counter() - start
+    return item
+
+
+def _read_stage(filepath, window_size, out_queue, stop_event, stats):
+    """
+    讀取與解析階段：解壓縮 gzip、json.loads，每 window_size 筆段落送出一個視窗。
+    """
+    try:
+        ids_batch, contents_batch = [], []
+        start = time.perf_counter()
+        with gzip.open(filepath, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if stop_event.is_set():
+                    return
+                try:
+                    data = json.loads(line)
+                    if 'id' in data and 'contents' in data and data['contents']:
+                        ids_batch.append(data['id'])
+                        contents_batch.append(data['contents'])
+                except (json.JSONDecodeError, KeyError):
+                    continue
+
+                if len(contents_batch) >= window_size:
+                    stats.add(len(contents_batch), time.perf_counter() - start)
+                    _put(out_queue, (ids_batch, contents_batch), stop_event, stats)
+                    ids_batch, contents_batch = [], []
+                    start = time.perf_counter()
+
+        if contents_batch:
+            stats.add(len(contents_batch), time.perf_counter() - start)
+            _put(out_queue, (ids_batch, contents_batch), stop_event, stats)
+        _put(out_queue, _END, stop_event, stats)
+    except Exception as e:
+        _put(out_queue, e, stop_event, stats)
+
+
+def _tokenize_stage(tokenize_window, in_queue, out_queue, stop_event, stats, cache=None):
+    """
+    Tokenize 階段：把一個視窗的文本轉成可直接送進模型的批次張量。
+    給定 SegmentEmbeddingCache 時先以內容雜湊去重，只 tokenize 快取中沒有的文本，
+    批次索引再對應回視窗中的位置。
+    """
+    try:
+        while not stop_event.is_set():
+            item = _get(in_queue, stop_event, stats)
+            if item is _END or isinstance(item, Exception):
+                _put(out_queue, item, stop_event, stats)
+                return
+            ids_batch, contents_batch = item
+            start = time.perf_counter()
+            plan = None
+            if cache is None:
+                batches = list(tokenize_window(contents_batch))
+            else:
+                plan = cache.plan(contents_batch)
+                miss_positions = plan.miss_positions
+                batches = [
+                    (torch.from_numpy(miss_positions[batch_indices.numpy()]), encoded)
+                    for batch_indices, encoded in (
+                        tokenize_window([contents_batch[i] for i in miss_positions.tolist()]) if len(miss_positions) else []
+                    )
+                ]
+            num_tokens = sum(int(encoded['attention_mask'].sum()) for _, encoded in batches)
+            stats.add(len(contents_batch), time.perf_counter() - start, tokens=num_tokens)
+            _put(out_queue, (ids_batch, batches, plan), stop_event, stats)
+    except Exception as e:
+        _put(out_queue, e, stop_event, stats)
+
+
+def iter_encoded_windows(filepath, window_size, tokenize_window, encode_batch, stats=None, queue_size=4, cache=None):
+    """
+    重疊執行的編碼管線，依檔案順序逐一產生 (ids, embeddings)。
+
+    讀取/解析與 tokenize 各自在背景執行緒中進行，以有界佇列串接，
+    呼叫端 (模型) 的執行緒只處理已經準備好的張量。
+    tokenize_window(contents) 需產生 (原始索引, 已補齊的輸入) 的批次；
+    encode_batch(encoded_input) 回傳該批次的嵌入向量 (torch.Tensor)。
+    cache 為 SegmentEmbeddingCache 時，快取中已有的文本不會被 tokenize 與編碼。
+    """
+    if stats is None:
+        stats = new_pipeline_stats()
+    text_queue = queue.Queue(maxsize=queue_size)
+    tensor_queue = queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+
+    threads = [
+        threading.Thread(target=_read_stage, args=(filepath, window_size, text_queue, stop_event, stats['read']), daemon=True),
+        threading.Thread(target=_tokenize_stage, args=(tokenize_window, text_queue, tensor_queue, stop_event, stats['tokenize'], cache), daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            item = _get(tensor_queue, stop_event, stats['encode'])
+            if item is _END:
+                break
+            if isinstance(item, Exception):
+                raise item
+            ids_batch, batches, plan = item
+
+            start = time.perf_counter()
+            embeddings = None
+            for batch_indices, encoded_input in batches:
+                batch_embeddings = encode_batch(encoded_input)
+                if embeddings is None:
+                    embeddings = batch_embeddings.new_empty((len(ids_batch), batch_embeddings.shape[1]))
+                embeddings[batch_indices] = batch_embeddings
+            if plan is not None:
+                embeddings = cache.fill(plan, embeddings[torch.from_numpy(plan.miss_positions)] if embeddings is not None else None)
+            stats['encode'].add(len(ids_batch), time.perf_counter() - start)
+            yield ids_batch, embeddings
+    finally:
+        stop_event.set()
+        for thread in threads:
+            thread.join()
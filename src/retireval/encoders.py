@@ -0,0 +1,240 @@
+import os
+import gzip
+import json
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+from transformers import AutoTokenizer, AutoModel
+from transformers.modeling_outputs import BaseModelOutput, SequenceClassifierOutput
+
+try:
+    import onnxruntime
+except ImportError:  # 只有 onnx / onnx-int8 後端才需要
+    onnxruntime = None
+
+# torch       PyTorch fp32 (可用 GPU)
+# torch-int8  PyTorch 動態 int8 量化 (Linear 層，僅 CPU)
+# onnx        匯出成 ONNX 後以 ONNX Runtime 執行 (僅 CPU)
+# onnx-int8   ONNX 模型再做動態 int8 量化
+BACKENDS = ('torch', 'torch-int8', 'onnx', 'onnx-int8')
+# 各種模型匯出時的輸出名稱、包裝輸出的型別與匯出用的範例輸入
+ONNX_TASKS = {
+    'embedding': ('last_hidden_state', BaseModelOutput, (['query'],)),
+    'classification': ('logits', SequenceClassifierOutput, (['query'], ['passage'])),
+}
+
+
+def _require_onnxruntime():
+    if onnxruntime is None:
+        raise ImportError("The ONNX backends require onnxruntime (and onnx for the export). "
+                          "Install them with `pip install onnx onnxruntime`.")
+
+
+def mean_pooling(model_output, attention_mask):
+    token_embeddings = model_output[0]
+    input_mask_expanded = attention_mask.unsqueeze(-1).expand(token_embeddings.size()).float()
+    return torch.sum(token_embeddings * input_mask_expanded, 1) / torch.clamp(input_mask_expanded.sum(1), min=1e-9)
+
+
+def encode_features(encoded_input, model):
+    """
+    對已 tokenize (且已補齊) 的輸入做前向計算、mean pooling 與正規化。
+    """
+    # Compute token embeddings
+    with torch.no_grad():
+        model_output = model(**encoded_input)
+    # Perform pooling
+    sentence_embeddings = mean_pooling(model_output, encoded_input['attention_mask'])
+    # Normalize embeddings
+    sentence_embeddings = F.normalize(sentence_embeddings, p=2, dim=1)
+    return sentence_embeddings.cpu()
+
+
+def export_onnx(model, tokenizer, onnx_path, task='embedding'):
+    """
+    把 transformers 模型匯出成 ONNX (批次大小與序列長度皆為動態維度)。
+    """
+    output_name, _, sample_texts = ONNX_TASKS[task]
+    os.makedirs(os.path.dirname(onnx_path) or '.', exist_ok=True)
+    input_names = list(tokenizer.model_input_names)
+    sample = tokenizer(*sample_texts, return_tensors='pt')
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names}
+    dynamic_axes[output_name] = {0: 'batch', 1: 'sequence'} if task == 'embedding' else {0: 'batch'}
+    tmp_path = f"{onnx_path}.tmp{os.getpid()}"
+    with torch.no_grad():
+        torch.onnx.export(
+            model, tuple(sample[name] for name in input_names), tmp_path, input_names=input_names,
+            output_names=[output_name], dynamic_axes=dynamic_axes, opset_version=17, dynamo=False
+        )
+    os.replace(tmp_path, onnx_path)
+    return onnx_path
+
+
+def default_onnx_dir(model_name):
+    """
+    ONNX 匯出檔的預設位置：本機模型資料夾下的 onnx/；Hub 模型 id (例如 cross-encoder/ms-marco-MiniLM-L-6-v2)
+    則放在 HF_HOME (預設 ~/.cache/huggingface) 下的 onnx/<org>--<name>，
+    避免在目前目錄建立與模型 id 同名的資料夾 (之後 from_pretrained 會誤把它當成本機模型)。
+    """
+    if os.path.isdir(model_name):
+        return os.path.join(model_name, 'onnx')
+    hf_home = os.environ.get('HF_HOME', os.path.join(os.path.expanduser('~'), '.cache', 'huggingface'))
+    return os.path.join(hf_home, 'onnx', model_name.replace('/', '--'))
+
+
+def prepare_onnx(model, tokenizer, model_name, backend, onnx_dir=None, task='embedding'):
+    """
+    回傳後端要用的 ONNX 檔路徑；匯出 (與 int8 量化) 只做一次，結果存在 onnx_dir
+    (預設見 default_onnx_dir) 供之後的執行與其他工作行程重複使用。
+    """
+    _require_onnxruntime()
+    onnx_dir = onnx_dir or default_onnx_dir(model_name)
+    onnx_path = os.path.join(onnx_dir, 'model.onnx')
+    if not os.path.exists(onnx_path):
+        print(f"Exporting '{model_name}' to '{onnx_path}'")
+        export_onnx(model, tokenizer, onnx_path, task)
+    if backend != 'onnx-int8':
+        return onnx_path
+    quantized_path = os.path.join(onnx_dir, 'model.int8.onnx')
+    if not os.path.exists(quantized_path):
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        tmp_path = f"{quantized_path}.tmp{os.getpid()}"
+        quantize_dynamic(onnx_path, tmp_path, weight_type=QuantType.QInt8)
+        os.replace(tmp_path, quantized_path)
+    return quantized_path
+
+
+class OnnxModel:
+    """
+    以 ONNX Runtime 執行的模型，呼叫方式與 transformers 模型相同：
+    model(**inputs) 回傳 BaseModelOutput (model_output[0] 為 token 嵌入) 或 SequenceClassifierOutput (.logits)，
+    因此 encode_features / cross-encoder 的程式碼不需要區分後端。
+    intra-op 執行緒數對應 torch.set_num_threads；多個工作行程時 inter-op 固定為 1 避免互搶 CPU。
+    """
+    def __init__(self, onnx_path, task='embedding', threads=None, inter_op_threads=1):
+        _require_onnxruntime()
+        self.output_name, self.output_type, _ = ONNX_TASKS[task]
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        options.inter_op_num_threads = inter_op_threads
+        self.session = onnxruntime.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+
+    def eval(self):
+        return self
+
+    def to(self, device):
+        return self
+
+    def __call__(self, **inputs):
+        feed = {name: inputs[name].cpu().numpy() for name in self.input_names}
+        output = self.session.run([self.output_name], feed)[0]
+        return self.output_type(**{self.output_name: torch.from_numpy(output)})
+
+
+def apply_backend(model, tokenizer, model_name, backend='torch', device='cpu', threads=None, onnx_dir=None,
+                  task='embedding'):
+    """
+    把已加載 (評估模式) 的 transformers 模型換成指定後端的版本。
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}")
+    if backend == 'torch':
+        return model.to(device)
+    if backend == 'torch-int8':
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    onnx_path = prepare_onnx(model, tokenizer, model_name, backend, onnx_dir, task)
+    return OnnxModel(onnx_path, task, threads)
+
+
+def load_model(model_name, device, backend='torch', threads=None, onnx_dir=None):
+    """
+    加載 tokenizer 與模型並切換到評估模式。
+    backend 不是 torch 時回傳的模型只在 CPU 上執行，但呼叫方式不變。
+    """
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name)
+    model.eval()
+    return tokenizer, apply_backend(model, tokenizer, model_name, backend, device, threads, onnx_dir)
+
+
+def check_parity(tokenizer, reference_model, model, texts, batch_size=64, threshold=0.99):
+    """
+    以同一批文本比較兩個後端的嵌入 (例如 PyTorch fp32 vs. ONNX int8)，
+    回傳逐筆餘弦相似度的統計；最小值低於 threshold 時 ok 為 False。
+    """
+    similarities = []
+    for start in range(0, len(texts), batch_size):
+        encoded_input = tokenizer(texts[start:start + batch_size], padding=True, truncation=True,
+                                  return_tensors='pt', max_length=512)
+        reference = encode_features(encoded_input, reference_model)
+        candidate = encode_features(encoded_input, model)
+        similarities.append((reference * candidate).sum(dim=1).numpy())
+    similarities = np.concatenate(similarities) if similarities else np.ones(0, dtype=np.float32)
+    minimum = float(similarities.min()) if len(similarities) else 1.0
+    return {
+        'texts': len(similarities),
+        'min_cosine': round(minimum, 6),
+        'mean_cosine': round(float(similarities.mean()) if len(similarities) else 1.0, 6),
+        'threshold': threshold,
+        'ok': minimum >= threshold,
+    }
+
+
+def sample_texts(corpus_file, num_texts=256):
+    """
+    從處理好的語料檔 (json.gz) 取前 num_texts 段非空的 contents 作為一致性檢查的樣本。
+    """
+    texts = []
+    with gzip.open(corpus_file, 'rt', encoding='utf-8') as f:
+        for line in f:
+            contents = json.loads(line).get('contents')
+            if contents:
+                texts.append(contents)
+                if len(texts) >= num_texts:
+                    break
+    return texts
+
+
+def verify_backend(model_name, backend, texts, threads=None, onnx_dir=None, threshold=0.99):
+    """
+    在 CPU 上加載 PyTorch fp32 參考模型與指定後端 (需要時一併完成 ONNX 匯出/量化)，
+    比較兩者的嵌入；一致性不足時拋出 ValueError，避免以偏差過大的後端編碼整個語料。
+    """
+    tokenizer, reference_model = load_model(model_name, 'cpu')
+    model = apply_backend(AutoModel.from_pretrained(model_name).eval(), tokenizer, model_name, backend, 'cpu',
+                          threads, onnx_dir)
+    result = check_parity(tokenizer, reference_model, model, texts, threshold=threshold)
+    print(f"Backend {backend} vs torch on {result['texts']} texts: "
+          f"min cosine {result['min_cosine']:.6f}, mean {result['mean_cosine']:.6f}")
+    if not result['ok']:
+        raise ValueError(f"Backend {backend} diverges from the PyTorch embeddings "
+                         f"(min cosine {result['min_cosine']:.6f} < {threshold})")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export / check the sentence-embedding encoder backends')
+    parser.add_argument('--model-name', default='pretrained_model/sentence-transformers/all-MiniLM-L6-v2')
+    parser.add_argument('--backend', choices=BACKENDS, default='onnx-int8')
+    parser.add_argument('--onnx-dir', default=None, help='Where the exported ONNX model is kept (default: <model>/onnx for a local model, else under $HF_HOME/onnx)')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--corpus-file', default=None, help='Processed corpus .json.gz to sample texts from')
+    parser.add_argument('--num-texts', type=int, default=256)
+    parser.add_argument('--threshold', type=float, default=0.99, help='Minimum cosine similarity to the PyTorch embeddings')
+    args = parser.parse_args()
+
+    texts = sample_texts(args.corpus_file, args.num_texts) if args.corpus_file else [
+        'how long does it take a car to accelerate', 'cooking pasta in salted water', 'the history of the printing press'
+    ]
+    try:
+        verify_backend(args.model_name, args.backend, texts, args.threads, args.onnx_dir, args.threshold)
+    except ValueError as e:
+        raise SystemExit(str(e))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+import numpy as np
+
+
+class DocidVocab:
+    """
+    docid 字串 ↔ 整數代碼。讀入 run 時只做一次轉換，之後各主題的對齊、排序都在整數陣列上進行。
+    """
+    def __init__(self):
+        self.index = {}
+        self._docids = []
+
+    def encode(self, docids):
+        index = self.index
+        setdefault = index.setdefault
+        # dict 保留插入順序，新的 docid 取得目前的大小作為代碼
+        codes = np.fromiter((setdefault(docid, len(index)) for docid in docids), dtype=np.int64, count=len(docids))
+        return codes
+
+    def decode(self, codes):
+        if len(self._docids) != len(self.index):
+            self._docids = list(self.index)
+        docids = self._docids
+        return [docids[code] for code in codes.tolist()]
+
+
+class TopicRun:
+    """
+    單一主題的檢索結果，docids (DocidVocab 的整數代碼) 與 scores 依分數由高到低排序。
+    """
+    __slots__ = ('docids', 'scores')
+
+    def __init__(self, docids, scores):
+        self.docids = docids
+        self.scores = scores
+
+    def __len__(self):
+        return len(self.docids)
+
+
+def group_run(query_ids, docids, scores, vocab):
+    """
+    把扁平的 (query_id, docid, score) 陣列依主題分組，保留主題第一次出現的順序，
+    組內依分數由高到低排序 (與 trec_eval 相同，忽略檔案中的 rank 欄位)。
+    同一主題中重複的 docid 只保留分數最高 (排名最前) 的一筆。
+    """
+    # 主題依第一次出現的順序編號，避免對字串陣列做 np.unique
+    topic_index = {}
+    topic_codes = np.fromiter(
+        (topic_index.setdefault(query_id, len(topic_index)) for query_id in query_ids),
+        dtype=np.int64, count=len(query_ids)
+    )
+    docids = vocab.encode(docids)
+    scores = np.asarray(scores, dtype=np.float64)
+    # 先依主題、再依分數 (高到低) 排序；lexsort 以最後一個鍵為主鍵
+    order = np.lexsort((-scores, topic_codes))
+    if len(order):
+        # 排序後每組 (主題, docid) 第一次出現的位置就是分數最高的一筆
+        pairs = topic_codes[order] * (int(docids.max()) + 1) + docids[order]
+        _, first = np.unique(pairs, return_index=True)
+        if len(first) < len(order):
+            order = order[np.sort(first)]
+    bounds = np.searchsorted(topic_codes[order], np.arange(len(topic_index) + 1))
+    return {
+        query_id: TopicRun(docids[order[bounds[i]:bounds[i + 1]]], scores[order[bounds[i]:bounds[i + 1]]])
+        for i, query_id in enumerate(topic_index)
+    }
+
+
+def read_run(path, vocab):
+    """
+    讀取 TREC run 檔 (query_id Q0 docid rank score run_name)，回傳 {query_id: TopicRun}。
+    逐行讀取，只保留 query_id、docid 與分數三欄；docid 以共用的 vocab 轉成整數代碼。
+    """
+    query_ids, docids, scores = [], [], []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            fields = line.split()
+            if not fields:
+                continue
+            if len(fields) != 6:
+                raise ValueError(f"Malformed TREC run file: {path} (line {line_number})")
+            query_ids.append(fields[0])
+            docids.append(fields[2])
+            scores.append(float(fields[4]))
+    return group_run(query_ids, docids, np.array(scores, dtype=np.float64), vocab)
+
+
+def topic_run_from_hits(docids, scores, vocab):
+    """
+    由單一主題已排序的 (docid 字串, 分數) 建立 TopicRun，例如 Lucene 或稠密索引的搜尋結果。
+    """
+    return TopicRun(vocab.encode(docids), np.asarray(scores, dtype=np.float64))
+
+
+def format_run(run, run_name, vocab):
+    """
+    產生 {query_id: TopicRun} 的 TREC 格式結果行。
+    """
+    for query_id, topic_run in run.items():
+        for rank, (docid, score) in enumerate(zip(vocab.decode(topic_run.docids), topic_run.scores.tolist()), 1):
+            yield f"{query_id} Q0 {docid} {rank} {score:.6f} {run_name}\n"
+
+
+def write_run(path, run, run_name, vocab):
+    """
+    以 TREC 格式寫出 {query_id: TopicRun}。
+    """
+    with open(path, 'w', encoding='utf-8') as f:
+        f.writelines(format_run(run, run_name, vocab))
+
+
+def normalize_scores(scores, method):
+    """
+    每個主題內的分數正規化：minmax 縮放到 [0, 1]，zscore 減平均除以標準差。
+    """
+    if method == 'minmax':
+        low, high = scores.min(), scores.max()
+        return (scores - low) / (high - low) if high > low else np.ones_like(scores)
+    if method == 'zscore':
+        std = scores.std()
+        return (scores - scores.mean()) / std if std > 0 else np.zeros_like(scores)
+    if method in (None, 'none'):
+        return scores
+    raise ValueError(f"Unknown normalization: {method}")
+
+
+def topic_contributions(topic_runs, method='rrf', rrf_k=60, normalization='minmax', depth=None):
+    """
+    把多個 run 在同一主題的結果對齊到它們的聯集上。
+    回傳 (union_docids, contributions)，contributions 形狀為 (runs, union)，
+    每列是該 run 對每個文件的未加權貢獻：RRF 為 1 / (rrf_k + rank)，weighted 為正規化後的分數；
+    沒有出現在該 run 的文件貢獻為 0。
+    """
+    topic_runs = list(topic_runs)
+    lengths = [
+        0 if topic_run is None else min(len(topic_run), depth) if depth else len(topic_run)
+        for topic_run in topic_runs
+    ]
+    all_docids = np.concatenate([
+        topic_run.docids[:length] for topic_run, length in zip(topic_runs, lengths) if topic_run is not None
+    ] or [np.empty(0, dtype=np.int64)])
+    union_docids, inverse = np.unique(all_docids, return_inverse=True)
+
+    contributions = np.zeros((len(topic_runs), len(union_docids)), dtype=np.float64)
+    offset = 0
+    for i, (topic_run, length) in enumerate(zip(topic_runs, lengths)):
+        if topic_run is None or not length:
+            continue
+        if method == 'rrf':
+            values = 1.0 / (rrf_k + np.arange(1, length + 1))
+        elif method == 'weighted':
+            values = normalize_scores(topic_run.scores[:length], normalization)
+        else:
+            raise ValueError(f"Unknown fusion method: {method}")
+        contributions[i, inverse[offset:offset + length]] = values
+        offset += length
+    return union_docids, contributions
+
+
+def _top_k(union_docids, fused_scores, k):
+    if k < len(fused_scores):
+        candidates = np.argpartition(-fused_scores, k)[:k]
+    else:
+        candidates = np.arange(len(fused_scores))
+    # 分數相同時依 docid 代碼排序，確保結果可重現
+    order = candidates[np.lexsort((union_docids[candidates], -fused_scores[candidates]))]
+    return TopicRun(union_docids[order], fused_scores[order])
+
+
+def fuse_runs_sweep(runs, weight_grid, method='rrf', k=1000, rrf_k=60, normalization='minmax', depth=None):
+    """
+    一次對多組權重做融合 (用於權重掃描)。
+    每個主題只對齊一次，之後以 (權重組數, runs) @ (runs, union) 的矩陣乘法得到所有組合的融合分數。
+    回傳與 weight_grid 等長的 [{query_id: TopicRun}, ...]。
+    """
+    weight_grid = np.atleast_2d(np.asarray(weight_grid, dtype=np.float64))
+    if weight_grid.shape[1] != len(runs):
+        raise ValueError(f"Expected {len(runs)} weights per setting, got {weight_grid.shape[1]}")
+
+    query_ids = list(dict.fromkeys(query_id for run in runs for query_id in run))
+    fused_runs = [{} for _ in range(len(weight_grid))]
+    for query_id in query_ids:
+        union_docids, contributions = topic_contributions(
+            [run.get(query_id) for run in runs], method=method, rrf_k=rrf_k,
+            normalization=normalization, depth=depth
+        )
+        if not len(union_docids):
+            continue
+        fused_scores = weight_grid @ contributions
+        for fused_run, scores in zip(fused_runs, fused_scores):
+            fused_run[query_id] = _top_k(union_docids, scores, k)
+    return fused_runs
+
+
+def fuse_runs(runs, weights=None, method='rrf', k=1000, rrf_k=60, normalization='minmax', depth=None):
+    """
+    融合兩個以上的 run (RRF 或正規化後的加權和)，回傳 {query_id: TopicRun}。
+    """
+    weights = [1.0] * len(runs) if weights is None else weights
+    return fuse_runs_sweep(runs, [weights], method=method, k=k, rrf_k=rrf_k,
+                           normalization=normalization, depth=depth)[0]
@@ -0,0 +1,220 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from dense_search import FlatIndex, encode_queries
+from doc_ids import DocIdTable
+from fusion import DocidVocab, topic_run_from_hits, fuse_runs
+from search_cache import model_fingerprint, index_fingerprint, encode_queries_cached, search_cached
+
+try:
+    from pyserini.search.lucene import LuceneSearcher
+except ImportError:  # 只有 BM25 檢索時才需要 pyserini (以及 Java)
+    LuceneSearcher = None
+
+
+def _require_pyserini():
+    if LuceneSearcher is None:
+        raise ImportError("BM25 retrieval requires pyserini. Install it with `pip install pyserini`.")
+
+
+class Bm25Retriever:
+    """
+    常駐的 Lucene BM25 搜尋器，以 Pyserini 的 batch_search 多執行緒處理一批查詢。
+    """
+    def __init__(self, index_dir, k1=0.9, b=0.4, threads=8):
+        _require_pyserini()
+        self.searcher = LuceneSearcher(index_dir)
+        self.searcher.set_bm25(k1, b)
+        self.threads = threads
+
+    def search(self, query_ids, query_texts, k):
+        """
+        回傳 {query_id: (docids, scores)}，依分數由高到低排序。
+        """
+        hits = self.searcher.batch_search(list(query_texts), list(query_ids), k=k, threads=self.threads)
+        return {
+            query_id: ([hit.docid for hit in hits.get(query_id, [])], [hit.score for hit in hits.get(query_id, [])])
+            for query_id in query_ids
+        }
+
+    def close(self):
+        self.searcher.close()
+
+
+def load_bm25_retriever(bm25_config, index_dir=None):
+    """
+    依 bm25.backend 建立 Lucene (Pyserini) 或原生 NumPy impact 索引 (bm25_index.py，不需要 JVM) 的 BM25 檢索器。
+    未指定 index_dir 時分別使用 bm25.index_dir 與 bm25.native_index_dir。
+    """
+    k1, b, threads = bm25_config.get('k1', 0.9), bm25_config.get('b', 0.4), bm25_config.get('threads', 8)
+    backend = bm25_config.get('backend', 'lucene')
+    if backend == 'native':
+        from bm25_index import NativeBm25Retriever
+        return NativeBm25Retriever(index_dir or bm25_config.get('native_index_dir', 'indexes/bm25_native'),
+                                   k1=k1, b=b, threads=threads)
+    if backend != 'lucene':
+        raise ValueError(f"Unknown BM25 backend '{backend}', expected 'lucene' or 'native'")
+    return Bm25Retriever(index_dir or bm25_config.get('index_dir', 'indexes/bm25'), k1=k1, b=b, threads=threads)
+
+
+def load_dense_index(index_path, block_size=131072, nprobe=None, ef_search=None, mmap=False, candidates=None):
+    """
+    依副檔名加載稠密索引：.npy 為精確分塊掃描的 FlatIndex，.shards.json 為 sharded_search.py 的分片清單
+    (啟動本機分片工作行程或連線到清單中的遠端分片)，.twostage.json 為 reduced_search.py 的降維掃描 + 完整向量重新計分
+    (candidates 為候選數，None 時使用清單中的預設)，.live.json 為 delta_index.py 的 base + delta 分段增量索引，
+    其他視為 faiss ANN 索引。
+    """
+    if index_path.endswith('.npy'):
+        return FlatIndex.load(index_path, block_size=block_size)
+    if index_path.endswith('.twostage.json'):
+        from reduced_search import TwoStageIndex
+        return TwoStageIndex.load(index_path, block_size=block_size, candidates=candidates)
+    if index_path.endswith('.live.json'):
+        from delta_index import LiveIndex
+        return LiveIndex.load(index_path, block_size=block_size)
+    if index_path.endswith('.shards.json'):
+        from sharded_search import ShardedIndex
+        return ShardedIndex.load(index_path, block_size=block_size, nprobe=nprobe, ef_search=ef_search)
+    from ann_index import AnnIndex
+    return AnnIndex.load(index_path, nprobe=nprobe, ef_search=ef_search, mmap=mmap)
+
+
+class DenseRetriever:
+    """
+    常駐的查詢編碼模型 + 稠密索引 (FlatIndex 或 AnnIndex) + doc-ID 表。
+    給定 SearchCache 時，查詢嵌入與 top-k 結果會先查快取 (需要 model_key / index_key 指紋)。
+    """
+    def __init__(self, tokenizer, model, index, corpus_ids, device='cpu', batch_size=256,
+                 cache=None, model_key=None, index_key=None):
+        self.tokenizer = tokenizer
+        self.model = model
+        self.index = index
+        self.corpus_ids = corpus_ids
+        self.device = device
+        self.batch_size = batch_size
+        self.cache = cache
+        self.model_key = model_key
+        self.index_key = index_key
+
+    @classmethod
+    def load(cls, model_name, index_path, ids_path=None, device='cpu', batch_size=256, cache=None, backend='torch',
+             **index_kwargs):
+        from encoders import load_model
+        index = load_dense_index(index_path, **index_kwargs)
+        # ANN 索引建立時記錄了對應的 doc-ID 表；增量索引自帶跨分段的 doc-ID 表 (更新後就地換新)
+        corpus_ids = getattr(index, 'corpus_ids', None)
+        ids_path = ids_path or getattr(index, 'meta', {}).get('ids_path')
+        if corpus_ids is None and ids_path is None:
+            raise ValueError(f"No doc-ID table given for dense index '{index_path}'")
+        if backend != 'torch':
+            device = 'cpu'
+        tokenizer, model = load_model(model_name, device, backend)
+        model_key = index_key = None
+        if cache is not None:
+            model_key = model_fingerprint(model_name, tokenizer, backend=backend)
+            search_params = {name: index_kwargs.get(name) for name in ('nprobe', 'ef_search')}
+            if index_kwargs.get('candidates'):
+                # 兩階段索引的候選數 (未指定時由清單決定，已含在清單檔的指紋中)
+                search_params['candidates'] = index_kwargs['candidates']
+            index_key = index_fingerprint(index_path, **search_params)
+        if corpus_ids is None:
+            corpus_ids = DocIdTable.load(ids_path)
+        return cls(tokenizer, model, index, corpus_ids, device=device, batch_size=batch_size,
+                   cache=cache, model_key=model_key, index_key=index_key)
+
+    def encode(self, query_texts):
+        return encode_queries(list(query_texts), self.tokenizer, self.model, self.device, self.batch_size).cpu()
+
+    def search(self, query_ids, query_texts, k):
+        """
+        回傳 {query_id: (docids, scores)}，依分數由高到低排序。
+        """
+        if self.cache is None:
+            scores, rows = self.index.search(self.encode(query_texts), k)
+        else:
+            query_embeddings = encode_queries_cached(
+                self.cache, self.model_key, list(query_texts), lambda texts: self.encode(texts).numpy()
+            )
+            index_key = self.index_key
+            if hasattr(self.index, 'refresh'):
+                # 增量索引每次 update / compact 後列號與結果都會變，快取鍵加上目前的 generation
+                self.index.refresh()
+                index_key = f"{index_key}:{self.index.meta['generation']}"
+            scores, rows = search_cached(self.cache, index_key, query_embeddings, k, self.index.search)
+        results = {}
+        for query_id, query_scores, query_rows in zip(query_ids, scores, rows):
+            valid = query_rows >= 0
+            results[query_id] = (self.corpus_ids.decode(query_rows[valid]), query_scores[valid])
+        return results
+
+
+class HybridRetriever:
+    """
+    在同一個程序中執行 BM25 與稠密檢索並在記憶體中融合。
+    每批查詢的兩種檢索同時送進執行緒池 (Lucene 走 JNI、PyTorch 矩陣運算都會釋放 GIL)，
+    結果不落地，直接以 fusion.py 融合成最終的 top-k。
+    """
+    def __init__(self, bm25, dense, weights=(0.5, 0.5), method='rrf', k=1000, rrf_k=60, normalization='minmax',
+                 depth=None):
+        self.bm25 = bm25
+        self.dense = dense
+        self.weights = list(weights)
+        self.method = method
+        self.k = k
+        self.rrf_k = rrf_k
+        self.normalization = normalization
+        # 每個系統取回的候選數
+        self.depth = depth or k
+        self.executor = ThreadPoolExecutor(max_workers=2)
+
+    def close(self):
+        self.executor.shutdown()
+
+    def search(self, query_ids, query_texts, timings=None, k=None):
+        """
+        檢索並融合一批查詢，回傳 ({query_id: TopicRun}, vocab)。
+        可傳入 timings dict 累計各階段秒數 (bm25、dense 為各自在執行緒中的時間)。
+        k 覆寫融合後保留的筆數 (預設為建立時的 k)；大於候選數時每個系統也改取 k 筆。
+        """
+        k = k or self.k
+        depth = max(self.depth, k)
+        sparse_future = self.executor.submit(_timed, self.bm25.search, query_ids, query_texts, depth)
+        dense_future = self.executor.submit(_timed, self.dense.search, query_ids, query_texts, depth)
+        (sparse, sparse_seconds), (dense, dense_seconds) = sparse_future.result(), dense_future.result()
+
+        start = time.time()
+        # DocidVocab 不是執行緒安全的，所以在主執行緒中才轉成整數代碼
+        vocab = DocidVocab()
+        runs = [
+            {query_id: topic_run_from_hits(docids, scores, vocab) for query_id, (docids, scores) in results.items()}
+            for results in (sparse, dense)
+        ]
+        fused = fuse_runs(runs, self.weights, method=self.method, k=k, rrf_k=self.rrf_k,
+                          normalization=self.normalization)
+        if timings is not None:
+            for name, seconds in (('bm25', sparse_seconds), ('dense', dense_seconds), ('fusion', time.time() - start)):
+                timings[name] = timings.get(name, 0.0) + seconds
+        return fused, vocab
+
+    def search_topics(self, topics, batch_size=64, timings=None):
+        """
+        依批次處理 [(query_id, query_text), ...]，逐批產生 ({query_id: TopicRun}, vocab)。
+        """
+        for start in range(0, len(topics), batch_size):
+            batch = topics[start:start + batch_size]
+            yield self.search([query_id for query_id, _ in batch], [query_text for _, query_text in batch], timings)
+
+
+def _timed(function, *args):
+    start = time.time()
+    with torch.no_grad():
+        result = function(*args)
+    return result, time.time() - start
+
+
+def default_device(requested):
+    if requested == 'cuda' and not torch.cuda.is_available():
+        return 'cpu'
+    return requested or 'cpu'
@@ -0,0 +1,165 @@
+import os
+import json
+import argparse
+import numpy as np
+
+from doc_ids import DocIdTable, DocIdTableWriter, EXTRA_FILE, KEY_SHIFT
+
+PARTS_FOLDER = 'parts'
+
+
+def parent_keys(files, doc_offsets):
+    """
+    父文件的鍵值：(檔案編號 << 40) | 文件位移，同一份文件的所有段落相同。
+    """
+    return (np.asarray(files, dtype=np.uint64) << np.uint64(KEY_SHIFT)) | np.asarray(doc_offsets, dtype=np.uint64)
+
+
+def write_part(parts_folder, name, doc_ids, start_chars, end_chars):
+    """
+    轉換語料時每一塊輸出對應的一份 (docid, start_char, end_char)，最後由 build_parent_index 依序合併。
+    """
+    os.makedirs(parts_folder, exist_ok=True)
+    base_path = os.path.join(parts_folder, name)
+    with open(f"{base_path}.ids.txt.tmp", 'w', encoding='utf-8') as f:
+        f.writelines(doc_id + '\n' for doc_id in doc_ids)
+    with open(f"{base_path}.chars.npy.tmp", 'wb') as f:
+        np.save(f, np.stack([np.asarray(start_chars, dtype=np.int32), np.asarray(end_chars, dtype=np.int32)], axis=1))
+    os.replace(f"{base_path}.chars.npy.tmp", f"{base_path}.chars.npy")
+    os.replace(f"{base_path}.ids.txt.tmp", f"{base_path}.ids.txt")
+
+
+def build_parent_index(index_path, part_names):
+    """
+    依語料順序合併各塊的輸出，建立段落 → 父文件的索引：
+      ids/              docid ↔ 列號 (doc_ids.py；列順序與處理後的語料相同)
+      chars.npy         每列的 (start_char, end_char)
+      family_rows.npy   依 (父文件, 段落序號) 排序後的列號
+      family_pos.npy    每列在 family_rows 中的位置
+    同一份文件的段落在 family_rows 中相鄰且依序排列，鄰近段落只是位置 ±1。
+    """
+    parts_folder = os.path.join(index_path, PARTS_FOLDER)
+    counts = [np.load(os.path.join(parts_folder, f"{name}.chars.npy"), mmap_mode='r').shape[0] for name in part_names]
+    total_rows = sum(counts)
+
+    ids_writer = DocIdTableWriter(os.path.join(index_path, 'ids'), total_rows)
+    chars = np.lib.format.open_memmap(os.path.join(index_path, 'chars.npy'), mode='w+', dtype=np.int32, shape=(total_rows, 2))
+    row = 0
+    for name, count in zip(part_names, counts):
+        base_path = os.path.join(parts_folder, name)
+        with open(f"{base_path}.ids.txt", 'r', encoding='utf-8') as f:
+            ids_writer.append(f.read().splitlines())
+        chars[row:row + count] = np.load(f"{base_path}.chars.npy")
+        row += count
+    ids_writer.close()
+    chars.flush()
+    del chars
+
+    table = DocIdTable.load(os.path.join(index_path, 'ids'))
+    keys = parent_keys(table.file, table.doc_offset)
+    # lexsort 以最後一個鍵為主鍵：先依父文件，再依段落序號
+    family_rows = np.lexsort((np.asarray(table.segment), keys))
+    family_pos = np.empty_like(family_rows)
+    family_pos[family_rows] = np.arange(len(family_rows))
+    np.save(os.path.join(index_path, 'family_rows.npy'), family_rows.astype(np.int64))
+    np.save(os.path.join(index_path, 'family_pos.npy'), family_pos.astype(np.int64))
+    with open(os.path.join(index_path, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump({'count': total_rows, 'parts': list(part_names)}, f, indent=2)
+    print(f"Parent index with {total_rows} segments written to '{index_path}'")
+
+
+class ParentIndex:
+    """
+    段落 → 父文件 / 鄰近段落的查詢。所有方法都一次處理一批命中的 docid (向量化)。
+    """
+    def __init__(self, path):
+        self.path = path
+        self.ids = DocIdTable.load(os.path.join(path, 'ids'))
+        self.chars = np.load(os.path.join(path, 'chars.npy'), mmap_mode='r')
+        self.family_rows = np.load(os.path.join(path, 'family_rows.npy'), mmap_mode='r')
+        self.family_pos = np.load(os.path.join(path, 'family_pos.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def parent_keys(self, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        return parent_keys(self.ids.file[rows], self.ids.doc_offset[rows])
+
+    def parents(self, doc_ids):
+        """
+        回傳 (父文件 docid 清單, 段落序號陣列)；找不到的 docid 父文件為 None、序號為 -1。
+        """
+        rows = self.ids.lookup(doc_ids)
+        found = (rows >= 0) & (np.asarray(self.ids.file[np.maximum(rows, 0)]) != EXTRA_FILE)
+        safe_rows = np.where(found, rows, 0)
+        files = np.asarray(self.ids.file[safe_rows])
+        doc_offsets = np.asarray(self.ids.doc_offset[safe_rows])
+        ordinals = np.where(found, np.asarray(self.ids.segment[safe_rows]).astype(np.int64), -1)
+        prefix, width = self.ids.prefix, self.ids.file_width
+        parents = [
+            f"{prefix}{file_no:0{width}d}_{doc_offset}" if ok else None
+            for ok, file_no, doc_offset in zip(found.tolist(), files.tolist(), doc_offsets.tolist())
+        ]
+        return parents, ordinals
+
+    def neighbours(self, rows, window=1, include_self=True):
+        """
+        對每個命中的列取出同一份文件中段落序號相差不超過 window 的段落。
+        回傳 (hit_index, neighbour_rows, distance) 三個等長的扁平陣列，依命中順序、再依段落序號排列；
+        列號為 -1 的命中不會出現在結果中。
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        hits = np.flatnonzero(rows >= 0)
+        positions = np.asarray(self.family_pos[rows[hits]])
+        distance = np.arange(-window, window + 1)
+        if not include_self:
+            distance = distance[distance != 0]
+        # (hits, 2 * window + 1) 的候選位置，超出範圍或不同父文件的丟掉
+        candidates = positions[:, None] + distance[None, :]
+        in_range = (candidates >= 0) & (candidates < len(self.family_rows))
+        candidate_rows = np.asarray(self.family_rows[np.clip(candidates, 0, len(self.family_rows) - 1)])
+        same_parent = in_range & (
+            self.parent_keys(candidate_rows.ravel()).reshape(candidate_rows.shape) == self.parent_keys(rows[hits])[:, None]
+        )
+        hit_index = np.broadcast_to(hits[:, None], candidates.shape)[same_parent]
+        return hit_index, candidate_rows[same_parent], np.broadcast_to(distance[None, :], candidates.shape)[same_parent]
+
+    def overlapping(self, rows, max_window=2):
+        """
+        同一份文件中與命中段落的字元範圍 [start_char, end_char) 重疊的其他段落
+        (滑動視窗切段時相鄰段落會重疊)。只檢查段落序號 ±max_window 以內的候選。
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        hit_index, neighbour_rows, distance = self.neighbours(rows, window=max_window, include_self=False)
+        hit_chars = np.asarray(self.chars[rows[hit_index]])
+        neighbour_chars = np.asarray(self.chars[neighbour_rows])
+        overlap = (neighbour_chars[:, 0] < hit_chars[:, 1]) & (hit_chars[:, 0] < neighbour_chars[:, 1])
+        return hit_index[overlap], neighbour_rows[overlap], distance[overlap]
+
+    def expand(self, doc_ids, window=1):
+        """
+        方便用的包裝：回傳每個命中 docid 的 [鄰近段落 docid, ...] (含自己，依段落序號排列)。
+        """
+        hit_index, neighbour_rows, _ = self.neighbours(self.ids.lookup(doc_ids), window=window)
+        expanded = [[] for _ in doc_ids]
+        for i, doc_id in zip(hit_index.tolist(), self.ids.decode(neighbour_rows)):
+            expanded[i].append(doc_id)
+        return expanded
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the segment-to-document (parent-child) index')
+    parser.add_argument('--index', default='data/corpus/parent_index')
+    parser.add_argument('--window', type=int, default=1)
+    parser.add_argument('doc_ids', nargs='+')
+    args = parser.parse_args()
+
+    index = ParentIndex(args.index)
+    parents, ordinals = index.parents(args.doc_ids)
+    for doc_id, parent, ordinal, siblings in zip(args.doc_ids, parents, ordinals, index.expand(args.doc_ids, args.window)):
+        print(f"{doc_id}\tparent={parent}\tordinal={ordinal}\tsiblings={','.join(siblings)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+import os
+import time
+import argparse
+import numpy as np
+
+STORAGE_DTYPES = {
+    'float32': np.float32,
+    'float16': np.float16,
+    'int8': np.int8,
+}
+
+
+def quant_params_path(embeddings_path):
+    """
+    int8 量化參數 (每個維度的 scale/offset) 與嵌入檔放在一起的檔名。
+    """
+    return f"{embeddings_path}.quant.npz"
+
+
+def compute_int8_params(arrays, chunk_rows=1 << 20):
+    """
+    串流掃過一或多個 (可為 memmap 的) 嵌入矩陣，計算每個維度的最小/最大值，
+    回傳 int8 量化參數：x ≈ (code + 128) * scale + offset。
+    """
+    minimum, maximum = None, None
+    for array in arrays:
+        for start in range(0, array.shape[0], chunk_rows):
+            chunk = np.asarray(array[start:start + chunk_rows], dtype=np.float32)
+            if not len(chunk):
+                continue
+            chunk_min, chunk_max = chunk.min(axis=0), chunk.max(axis=0)
+            minimum = chunk_min if minimum is None else np.minimum(minimum, chunk_min)
+            maximum = chunk_max if maximum is None else np.maximum(maximum, chunk_max)
+    scale = np.maximum(maximum - minimum, 1e-12) / 255.0
+    return {'scale': scale.astype(np.float32), 'offset': minimum.astype(np.float32)}
+
+
+def quantize_chunk(chunk, storage, params=None):
+    """
+    把一段 float32 嵌入轉成指定的儲存格式。
+    """
+    if storage == 'float32':
+        return np.asarray(chunk, dtype=np.float32)
+    if storage == 'float16':
+        return np.asarray(chunk, dtype=np.float16)
+    if storage == 'int8':
+        codes = np.rint((np.asarray(chunk, dtype=np.float32) - params['offset']) / params['scale']) - 128
+        return np.clip(codes, -128, 127).astype(np.int8)
+    raise ValueError(f"Unknown storage type: {storage}")
+
+
+def dequantize_chunk(chunk, params=None):
+    """
+    quantize_chunk 的反向：把任一種儲存格式的嵌入轉回 float32 (int8 需要量化參數)。
+    """
+    chunk = np.asarray(chunk)
+    if chunk.dtype == np.int8:
+        return (chunk.astype(np.float32) + 128) * params['scale'] + params['offset']
+    return chunk.astype(np.float32, copy=False)
+
+
+def save_quant_params(embeddings_path, params):
+    np.savez(quant_params_path(embeddings_path), scale=params['scale'], offset=params['offset'])
+
+
+def load_quant_params(embeddings_path):
+    """
+    讀取 int8 嵌入檔對應的量化參數；不存在時回傳 None。
+    """
+    path = quant_params_path(embeddings_path)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        return {'scale': data['scale'], 'offset': data['offset']}
+
+
+def quantize_embeddings(input_path, output_path, storage, chunk_rows=1 << 20):
+    """
+    把 float32 的語料嵌入串流轉成 float16 或 int8 (每維度 scale/offset) 儲存。
+    """
+    embeddings = np.load(input_path, mmap_mode='r')
+    params = compute_int8_params([embeddings], chunk_rows) if storage == 'int8' else None
+    output = np.lib.format.open_memmap(
+        output_path, mode='w+', dtype=STORAGE_DTYPES[storage], shape=embeddings.shape
+    )
+    for start in range(0, embeddings.shape[0], chunk_rows):
+        output[start:start + chunk_rows] = quantize_chunk(embeddings[start:start + chunk_rows], storage, params)
+    output.flush()
+    del output
+    if params is not None:
+        save_quant_params(output_path, params)
+    return output_path
+
+
+def _evaluate_run(qrels, run, metrics=('ndcg_cut_10', 'recall_1000')):
+    import pytrec_eval
+    evaluator = pytrec_eval.RelevanceEvaluator(qrels, set(metrics))
+    results = evaluator.evaluate(run)
+    return {metric: sum(result[metric] for result in results.values()) / max(1, len(results)) for metric in metrics}
+
+
+def compare_storage(embeddings_path, ids_path, topics_file, qrels_file, model_name, storages=('float16', 'int8'),
+                    output_dir=None, k=1000, block_size=131072):
+    """
+    以 float32 為基準，比較各種精簡儲存格式在我們的 qrels 上的 nDCG@10 / recall@1000、磁碟大小與掃描時間。
+    """
+    import pytrec_eval
+    from dense_search import FlatIndex, read_topics, encode_queries
+    from doc_ids import DocIdTable
+    from run_dense_retrieval import load_model
+
+    topics = read_topics(topics_file)
+    tokenizer, model = load_model(model_name, 'cpu')
+    query_embeddings = encode_queries([query_text for _, query_text in topics], tokenizer, model, 'cpu')
+    corpus_ids = DocIdTable.load(ids_path)
+    with open(qrels_file, 'r') as f:
+        qrels = pytrec_eval.parse_qrel(f)
+
+    output_dir = output_dir or os.path.dirname(os.path.abspath(embeddings_path))
+    os.makedirs(output_dir, exist_ok=True)
+    variants = [('float32', embeddings_path)]
+    for storage in storages:
+        path = os.path.join(output_dir, f"{os.path.basename(embeddings_path)[:-4]}.{storage}.npy")
+        if not os.path.exists(path):
+            print(f"Quantizing embeddings to {storage} -> '{path}'...")
+            quantize_embeddings(embeddings_path, path, storage)
+        variants.append((storage, path))
+
+    report = []
+    for storage, path in variants:
+        index = FlatIndex.load(path, block_size=block_size)
+        start = time.time()
+        scores, rows = index.search(query_embeddings, k)
+        elapsed = time.time() - start
+        run = {}
+        for (query_id, _), query_scores, query_rows in zip(topics, scores, rows):
+            run[query_id] = dict(zip(corpus_ids.decode(query_rows), query_scores.astype(float).tolist()))
+        report.append({
+            'storage': storage,
+            'size_mb': os.path.getsize(path) / 2 ** 20,
+            'search_seconds': elapsed,
+            **_evaluate_run(qrels, run),
+        })
+
+    baseline = report[0]
+    print(f"{'storage':<8} {'size(MB)':>10} {'search(s)':>10} {'nDCG@10':>9} {'delta':>8} {'R@1000':>8} {'delta':>8}")
+    for row in report:
+        print(f"{row['storage']:<8} {row['size_mb']:>10.1f} {row['search_seconds']:>10.2f} "
+              f"{row['ndcg_cut_10']:>9.4f} {row['ndcg_cut_10'] - baseline['ndcg_cut_10']:>+8.4f} "
+              f"{row['recall_1000']:>8.4f} {row['recall_1000'] - baseline['recall_1000']:>+8.4f}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reduced-precision storage for corpus embeddings')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    convert = subparsers.add_parser('convert', help='Convert float32 embeddings to float16 or int8')
+    convert.add_argument('input')
+    convert.add_argument('output')
+    convert.add_argument('--storage', choices=['float16', 'int8'], required=True)
+
+    compare = subparsers.add_parser('compare', help='Report nDCG@10 / recall@1000 deltas versus float32')
+    compare.add_argument('--embeddings', default='corpus_embeddings.npy')
+    compare.add_argument('--ids', default='corpus_ids')
+    compare.add_argument('--topics', required=True)
+    compare.add_argument('--qrels', required=True)
+    compare.add_argument('--model-name', default='pretrained_model/sentence-transformers/all-MiniLM-L6-v2')
+    compare.add_argument('--output-dir', default=None, help='Where the quantized copies are written')
+
+    args = parser.parse_args()
+    if args.command == 'convert':
+        quantize_embeddings(args.input, args.output, args.storage)
+        print(f"Saved {args.storage} embeddings to '{args.output}'")
+    else:
+        compare_storage(args.embeddings, args.ids, args.topics, args.qrels, args.model_name, output_dir=args.output_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import torch
+
+from ann_index import sample_rows, recall_at_k
+from dense_search import FlatIndex
+from quantization import (STORAGE_DTYPES, compute_int8_params, quantize_chunk, dequantize_chunk, save_quant_params,
+                          load_quant_params)
+
+METHODS = ('pca', 'truncate')
+MANIFEST_SUFFIX = '.twostage.json'
+DEFAULT_CANDIDATES = 4000
+
+
+def projection_path(reduced_path):
+    """
+    降維投影 (components / mean) 與降維矩陣放在一起的檔名。
+    """
+    return f"{reduced_path}.projection.npz"
+
+
+def fit_projection(embeddings, dim, method='pca', quant_params=None, sample_size=100000, seed=0):
+    """
+    回傳 (components[D, dim], mean[D], 保留的變異比例)。
+    pca：抽樣列的共變異矩陣取前 dim 個主成分；truncate：直接取前 dim 維 (適合 Matryoshka 類的模型)。
+    內積 q·x = q·mean + (q @ components)·((x - mean) @ components) + 捨棄維度的部分，
+    q·mean 對同一個查詢是常數，所以只比較降維後的內積不影響排序。
+    """
+    full_dim = embeddings.shape[1]
+    if not 0 < dim < full_dim:
+        raise ValueError(f"Reduced dimension must be between 1 and {full_dim - 1}, got {dim}")
+    if method not in METHODS:
+        raise ValueError(f"Unknown reduction method '{method}', expected one of {METHODS}")
+    sample = dequantize_chunk(embeddings[sample_rows(embeddings.shape[0], sample_size, seed)], quant_params)
+    if method == 'truncate':
+        variances = sample.var(axis=0)
+        return np.eye(full_dim, dim, dtype=np.float32), np.zeros(full_dim, dtype=np.float32), \
+            float(variances[:dim].sum() / max(variances.sum(), 1e-12))
+    mean = sample.mean(axis=0)
+    centered = (sample - mean).astype(np.float64)
+    eigenvalues, eigenvectors = np.linalg.eigh(centered.T @ centered / max(len(sample) - 1, 1))
+    order = np.argsort(eigenvalues)[::-1][:dim]
+    explained = float(eigenvalues[order].sum() / max(eigenvalues.sum(), 1e-12))
+    return eigenvectors[:, order].astype(np.float32), mean.astype(np.float32), explained
+
+
+class _ProjectedView:
+    """
+    以切片讀取時才投影的唯讀視圖，讓 compute_int8_params 可以直接串流掃過降維後的向量。
+    """
+
+    def __init__(self, embeddings, components, mean, quant_params=None):
+        self.embeddings = embeddings
+        self.components = components
+        self.mean = mean
+        self.quant_params = quant_params
+        self.shape = (embeddings.shape[0], components.shape[1])
+
+    def __getitem__(self, rows):
+        return (dequantize_chunk(self.embeddings[rows], self.quant_params) - self.mean) @ self.components
+
+
+def build_reduced(embeddings_path, dim, method='pca', storage='float32', output_path=None, candidates=DEFAULT_CANDIDATES,
+                  sample_size=100000, chunk_rows=1 << 18):
+    """
+    由 merge_temp_files 產生的語料嵌入建立降維副本 (<嵌入檔>.<method><dim>.npy，可再以 float16 / int8 儲存)
+    與兩階段搜尋的清單 (<嵌入檔>.<method><dim>.twostage.json)，回傳清單路徑。
+    清單可直接當作稠密索引路徑使用 (hybrid_search.load_dense_index)。
+    """
+    embeddings = np.load(embeddings_path, mmap_mode='r')
+    quant_params = load_quant_params(embeddings_path) if embeddings.dtype == np.int8 else None
+    base = embeddings_path[:-4] if embeddings_path.endswith('.npy') else embeddings_path
+    output_path = output_path or f"{base}.{method}{dim}.npy"
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    components, mean, explained = fit_projection(embeddings, dim, method, quant_params, sample_size)
+    print(f"{method} projection {embeddings.shape[1]} -> {dim} dims keeps {100 * explained:.1f}% of the variance")
+
+    projected = _ProjectedView(embeddings, components, mean, quant_params)
+    reduced_params = compute_int8_params([projected], chunk_rows) if storage == 'int8' else None
+    reduced = np.lib.format.open_memmap(output_path, mode='w+', dtype=STORAGE_DTYPES[storage], shape=projected.shape)
+    for start in range(0, projected.shape[0], chunk_rows):
+        reduced[start:start + chunk_rows] = quantize_chunk(projected[start:start + chunk_rows], storage, reduced_params)
+    reduced.flush()
+    del reduced
+    if reduced_params is not None:
+        save_quant_params(output_path, reduced_params)
+    np.savez(projection_path(output_path), components=components, mean=mean)
+
+    manifest_path = f"{output_path[:-4]}{MANIFEST_SUFFIX}"
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump({
+            'full': os.path.relpath(os.path.abspath(embeddings_path), manifest_dir),
+            'reduced': os.path.relpath(os.path.abspath(output_path), manifest_dir),
+            'method': method, 'dim': dim, 'full_dim': int(embeddings.shape[1]), 'storage': storage,
+            'rows': int(embeddings.shape[0]), 'explained_variance': explained, 'candidates': candidates,
+        }, f, indent=2)
+    print(f"Reduced embeddings written to '{output_path}', two-stage manifest to '{manifest_path}'")
+    return manifest_path
+
+
+class TwoStageIndex:
+    """
+    兩階段精確搜尋：先以 FlatIndex 分塊掃描降維副本取得每個查詢 candidates 個候選，
+    再從 memory-map 的完整嵌入只讀取候選列 (依列號排序讀取)，以完整維度重新計分後取 top-k。
+    掃描的位元組數約為完整掃描的 dim / full_dim；候選數以 evaluate 子命令對照完整掃描的 recall@k 調整。
+    search() 的介面與 FlatIndex 相同。
+    """
+
+    def __init__(self, reduced_index, full_embeddings, components, mean, full_quant_params=None,
+                 candidates=DEFAULT_CANDIDATES, rescore_batch=64, meta=None):
+        self.reduced_index = reduced_index
+        self.full_embeddings = full_embeddings
+        self.components = torch.from_numpy(components)
+        self.mean = mean
+        self.full_quant_params = full_quant_params
+        self.candidates = candidates
+        self.rescore_batch = rescore_batch
+        self.meta = meta or {}
+
+    @classmethod
+    def load(cls, manifest_path, block_size=131072, candidates=None):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+        full_path = os.path.join(manifest_dir, meta['full'])
+        reduced_path = os.path.join(manifest_dir, meta['reduced'])
+        full_embeddings = np.load(full_path, mmap_mode='r')
+        full_quant_params = None
+        if full_embeddings.dtype == np.int8:
+            full_quant_params = load_quant_params(full_path)
+            if full_quant_params is None:
+                raise FileNotFoundError(f"Missing quantization parameters for int8 embeddings '{full_path}'")
+        with np.load(projection_path(reduced_path)) as projection:
+            components, mean = projection['components'], projection['mean']
+        return cls(FlatIndex.load(reduced_path, block_size=block_size), full_embeddings, components, mean,
+                   full_quant_params, candidates=candidates or meta.get('candidates', DEFAULT_CANDIDATES), meta=meta)
+
+    def __len__(self):
+        return self.full_embeddings.shape[0]
+
+    @property
+    def dim(self):
+        return self.full_embeddings.shape[1]
+
+    def candidate_search(self, query_embeddings, depth):
+        """
+        第一階段：在降維副本上取每個查詢的前 depth 個候選列 (Q, depth)。
+        """
+        query_embeddings = torch.as_tensor(query_embeddings, dtype=torch.float32)
+        return self.reduced_index.search(query_embeddings @ self.components, depth)[1]
+
+    def rescore(self, query_embeddings, candidate_rows, k):
+        """
+        第二階段：以完整向量重新計分候選，回傳 (scores, rows)，形狀皆為 (Q, k)。
+        同一批查詢的候選取聯集後只讀一次。
+        """
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+        k = min(k, candidate_rows.shape[1])
+        top_scores = np.empty((len(query_embeddings), k), dtype=np.float32)
+        top_rows = np.empty((len(query_embeddings), k), dtype=np.int64)
+        for start in range(0, len(query_embeddings), self.rescore_batch):
+            queries = query_embeddings[start:start + self.rescore_batch]
+            rows = candidate_rows[start:start + self.rescore_batch]
+            unique_rows, inverse = np.unique(rows, return_inverse=True)
+            vectors = dequantize_chunk(self.full_embeddings[unique_rows], self.full_quant_params)
+            scores = np.take_along_axis(queries @ vectors.T, inverse.reshape(rows.shape), axis=1)
+            best = np.argpartition(-scores, k - 1, axis=1)[:, :k] if k < scores.shape[1] else \
+                np.tile(np.arange(scores.shape[1]), (len(scores), 1))
+            best_scores = np.take_along_axis(scores, best, axis=1)
+            order = np.argsort(-best_scores, axis=1, kind='stable')
+            top_scores[start:start + len(queries)] = np.take_along_axis(best_scores, order, axis=1)
+            top_rows[start:start + len(queries)] = np.take_along_axis(rows, np.take_along_axis(best, order, axis=1), axis=1)
+        return top_scores, top_rows
+
+    def search(self, query_embeddings, k, candidates=None):
+        """
+        回傳每個查詢的 top-k (scores, rows)，形狀皆為 (Q, k)，依完整維度的分數由高到低排序。
+        """
+        candidate_rows = self.candidate_search(query_embeddings, max(k, candidates or self.candidates))
+        if candidate_rows.shape[1] == 0:
+            return np.empty((len(candidate_rows), 0), dtype=np.float32), np.empty((len(candidate_rows), 0), dtype=np.int64)
+        return self.rescore(query_embeddings, candidate_rows, k)
+
+
+def sweep_candidates(index, flat_index, query_embeddings, k=1000, depths=(1000, 2000, 4000, 8000)):
+    """
+    對每個候選數量測 recall@k (以完整維度的精確掃描為基準) 與每個查詢的平均延遲 (含第一階段掃描的部分)。
+    重新計分是精確的，所以 recall@k 即為精確 top-k 落在候選中的比例。
+    """
+    start = time.time()
+    _, exact_rows = flat_index.search(query_embeddings, k)
+    exact_seconds = time.time() - start
+    results = [{'method': 'flat', 'candidates': None, f'recall@{k}': 1.0,
+                'ms_per_query': 1000 * exact_seconds / len(query_embeddings)}]
+    for depth in depths:
+        start = time.time()
+        candidate_rows = index.candidate_search(query_embeddings, max(k, depth))
+        scan_seconds = time.time() - start
+        _, rows = index.rescore(query_embeddings, candidate_rows, k)
+        total_seconds = time.time() - start
+        results.append({
+            'method': 'two-stage', 'candidates': depth,
+            f'recall@{k}': recall_at_k(rows, exact_rows),
+            'scan_ms_per_query': 1000 * scan_seconds / len(query_embeddings),
+            'ms_per_query': 1000 * total_seconds / len(query_embeddings),
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Two-stage dense search: reduced-dimension scan plus exact rescoring')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build = subparsers.add_parser('build', help='Write a reduced-dimension copy of the corpus embeddings')
+    build.add_argument('--embeddings', default='corpus_embeddings.npy')
+    build.add_argument('--dim', type=int, default=128)
+    build.add_argument('--method', choices=METHODS, default='pca')
+    build.add_argument('--storage', choices=['float32', 'float16', 'int8'], default='float32',
+                       help='Storage precision of the reduced copy')
+    build.add_argument('--output', default=None, help='Reduced embeddings path (default: <embeddings>.<method><dim>.npy)')
+    build.add_argument('--candidates', type=int, default=DEFAULT_CANDIDATES, help='Default candidate depth')
+    build.add_argument('--sample-size', type=int, default=100000, help='Rows sampled to fit the PCA')
+
+    evaluate = subparsers.add_parser('evaluate', help='Recall@k of the two-stage search versus the exact full scan')
+    evaluate.add_argument('--index', required=True, help='.twostage.json manifest')
+    evaluate.add_argument('--topics', default=None)
+    evaluate.add_argument('--model-name', default='pretrained_model/sentence-transformers/all-MiniLM-L6-v2')
+    evaluate.add_argument('--queries', default=None, help='Pre-encoded query embeddings (.npy) instead of --topics')
+    evaluate.add_argument('--k', type=int, default=1000)
+    evaluate.add_argument('--candidates', default='1000,2000,4000,8000', help='Comma-separated candidate depths')
+    evaluate.add_argument('--block-size', type=int, default=131072)
+    evaluate.add_argument('--output', default=None, help='Optional JSON report path')
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        build_reduced(args.embeddings, args.dim, args.method, args.storage, args.output, args.candidates,
+                      args.sample_size)
+        return
+
+    if args.queries:
+        query_embeddings = np.load(args.queries).astype(np.float32)
+    elif args.topics:
+        from dense_search import read_topics, encode_queries
+        from encoders import load_model
+        tokenizer, model = load_model(args.model_name, 'cpu')
+        query_embeddings = encode_queries([query_text for _, query_text in read_topics(args.topics)], tokenizer, model,
+                                          'cpu').numpy()
+    else:
+        parser.error('evaluate needs --topics or --queries')
+    index = TwoStageIndex.load(args.index, block_size=args.block_size)
+    flat_index = FlatIndex.load(os.path.join(os.path.dirname(os.path.abspath(args.index)), index.meta['full']),
+                                block_size=args.block_size)
+    results = sweep_candidates(index, flat_index, query_embeddings, k=args.k,
+                               depths=[int(depth) for depth in args.candidates.split(',')])
+    print(f"{'method':<10} {'candidates':>10} {f'recall@{args.k}':>12} {'scan ms/q':>10} {'ms/query':>10}")
+    for result in results:
+        print(f"{result['method']:<10} {str(result['candidates'] or '-'):>10} {result[f'recall@{args.k}']:>12.4f} "
+              f"{result.get('scan_ms_per_query', result['ms_per_query']):>10.2f} {result['ms_per_query']:>10.2f}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+import torch
+from transformers import AutoTokenizer, AutoModelForSequenceClassification
+
+from config import load_config
+from dense_search import read_topics
+from encoders import BACKENDS, apply_backend
+from fusion import DocidVocab, TopicRun, read_run, write_run
+from run_dense_retrieval import plan_length_batches
+from search_cache import SearchCache, make_key, model_fingerprint
+from segment_store import SegmentStore
+from telemetry import Telemetry, add_telemetry_args
+
+
+def load_cross_encoder(model_name, backend='torch', device='cpu', threads=None, onnx_dir=None):
+    """
+    加載 cross-encoder，backend 見 encoders.py (torch、torch-int8、onnx、onnx-int8)；
+    ONNX 檔匯出一次後存在 onnx_dir (預設見 encoders.default_onnx_dir) 重複使用。
+    """
+    if threads:
+        torch.set_num_threads(threads)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModelForSequenceClassification.from_pretrained(model_name)
+    model.eval()
+    return tokenizer, apply_backend(model, tokenizer, model_name, backend, device, threads, onnx_dir, task='classification')
+
+
+class CrossEncoderReranker:
+    """
+    以 cross-encoder 對 (查詢, 段落) 評分並重排 run 的前 depth 筆。
+    每個主題的段落依 token 長度排序、以 token 預算動態組批，每批只補齊到該批最長的長度；
+    給定 SearchCache 時先查快取，只計算沒算過的 (模型, 查詢, 段落文本) 組合。
+    """
+    def __init__(self, tokenizer, model, device='cpu', max_length=512, token_budget=16384, cache=None, model_key=None):
+        self.tokenizer = tokenizer
+        self.model = model
+        self.device = device
+        self.max_length = max_length
+        self.token_budget = token_budget
+        self.cache = cache
+        self.model_key = model_key
+        self.stats = {'pairs': 0, 'scored': 0, 'batches': 0}
+
+    @classmethod
+    def load(cls, model_name, backend='torch', device='cpu', threads=None, max_length=512, token_budget=16384,
+             cache=None, onnx_dir=None):
+        if backend != 'torch':
+            device = 'cpu'
+        tokenizer, model = load_cross_encoder(model_name, backend, device, threads, onnx_dir)
+        model_key = None
+        if cache is not None:
+            model_key = model_fingerprint(model_name, tokenizer, max_length, backend=backend)
+        return cls(tokenizer, model, device=device, max_length=max_length, token_budget=token_budget,
+                   cache=cache, model_key=model_key)
+
+    def _score_pairs(self, query, passages):
+        encoded = self.tokenizer([query] * len(passages), passages, truncation=True, max_length=self.max_length)
+        lengths = [len(input_ids) for input_ids in encoded['input_ids']]
+        scores = np.empty(len(passages), dtype=np.float32)
+        with torch.no_grad():
+            for batch_indices in plan_length_batches(lengths, self.token_budget):
+                features = [{key: encoded[key][i] for key in encoded.keys()} for i in batch_indices]
+                batch = self.tokenizer.pad(features, padding=True, return_tensors='pt').to(self.device)
+                logits = self.model(**batch).logits
+                # 單一輸出取該值；二元分類取「相關」類別
+                scores[batch_indices] = logits[:, -1].float().cpu().numpy()
+                self.stats['batches'] += 1
+        self.stats['scored'] += len(passages)
+        return scores
+
+    def score(self, query, passages):
+        """
+        回傳每個段落與查詢的相關分數 (float32 陣列)。
+        """
+        self.stats['pairs'] += len(passages)
+        if self.cache is None:
+            return self._score_pairs(query, passages) if passages else np.empty(0, dtype=np.float32)
+        keys = [
+            make_key('rerank', self.model_key, query, hashlib.sha256(passage.encode('utf-8')).hexdigest())
+            for passage in passages
+        ]
+        found = self.cache.get_many('rerank', keys)
+        scores = np.array([np.frombuffer(found[key], dtype=np.float32)[0] if key in found else np.nan for key in keys],
+                          dtype=np.float32)
+        missing = np.flatnonzero(np.isnan(scores))
+        if len(missing):
+            scores[missing] = self._score_pairs(query, [passages[i] for i in missing.tolist()])
+            self.cache.put_many('rerank', [(keys[i], scores[i:i + 1].tobytes()) for i in missing.tolist()])
+        return scores
+
+    def rerank_topic(self, query, topic_run, passages, depth=100):
+        """
+        重排 topic_run 的前 depth 筆 (passages 為對應的段落文本，找不到的為 None)，其餘維持原順序。
+        重排後的分數為 cross-encoder 分數；沒有文本的候選與尾端依原順序接在後面，
+        分數設為遞減且低於所有重排分數，使依分數排序的評估工具看到相同的順序。
+        """
+        head = min(depth, len(topic_run))
+        has_text = np.array([passage is not None for passage in passages[:head]], dtype=bool)
+        scored = np.flatnonzero(has_text)
+        scores = self.score(query, [passages[i] for i in scored.tolist()]).astype(np.float64)
+        order = np.argsort(-scores, kind='stable')
+        rest = np.concatenate([np.flatnonzero(~has_text), np.arange(head, len(topic_run))])
+        docids = np.concatenate([topic_run.docids[scored[order]], topic_run.docids[rest]])
+        floor = scores.min() if len(scores) else 0.0
+        return TopicRun(docids, np.concatenate([scores[order], floor - 1 - np.arange(len(rest), dtype=np.float64)]))
+
+
+def rerank_run(reranker, store, run, topics, vocab, depth=100):
+    """
+    逐主題從段落庫取出前 depth 筆的文本並重排，回傳 ({query_id: TopicRun}, {query_id: 耗時與筆數})。
+    沒有主題文字的 run 主題原樣保留。
+    """
+    reranked, timings = {}, {}
+    queries = dict(topics)
+    for query_id, topic_run in run.items():
+        if query_id not in queries:
+            reranked[query_id] = topic_run
+            continue
+        start = time.perf_counter()
+        head = topic_run.docids[:depth]
+        segments = store.get(vocab.decode(head))
+        passages = [
+            None if segment is None else f"{segment.get('title', '')}\n{segment['contents']}" for segment in segments
+        ]
+        reranked[query_id] = reranker.rerank_topic(queries[query_id], topic_run, passages, depth)
+        timings[query_id] = {
+            'pairs': len(head), 'missing': passages.count(None), 'seconds': time.perf_counter() - start
+        }
+    return reranked, timings
+
+
+def summarize_timings(timings):
+    seconds = np.array([timing['seconds'] for timing in timings.values()], dtype=np.float64)
+    pairs = sum(timing['pairs'] for timing in timings.values())
+    if not len(seconds):
+        return "no topics re-ranked"
+    p50, p95 = np.percentile(seconds, [50, 95])
+    return (f"{len(seconds)} topics, {pairs} pairs in {seconds.sum():.1f}s "
+            f"({pairs / max(seconds.sum(), 1e-9):.0f} pairs/s); per topic mean {seconds.mean() * 1000:.0f}ms "
+            f"p50 {p50 * 1000:.0f}ms p95 {p95 * 1000:.0f}ms max {seconds.max() * 1000:.0f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Re-rank the top of a TREC run with a cross-encoder')
+    parser.add_argument('--config', default=None, help='retrieval_config.yaml (rerank block)')
+    parser.add_argument('--run', required=True, help='First-stage TREC run (BM25, dense or hybrid)')
+    parser.add_argument('--topics', required=True)
+    parser.add_argument('--store', default='data/corpus/segment_store', help='Segment store built by segment_store.py')
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--run-name', default='rerank')
+    parser.add_argument('--model-name', default=None)
+    parser.add_argument('--backend', choices=BACKENDS, default=None)
+    parser.add_argument('--onnx-dir', default=None, help='Where the exported ONNX model is kept (default: <model>/onnx for a local model, else under $HF_HOME/onnx)')
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--threads', type=int, default=None, help='CPU threads for torch / ONNX Runtime')
+    parser.add_argument('--depth', type=int, default=None, help='Re-rank the top-N hits per topic; the tail keeps its order')
+    parser.add_argument('--token-budget', type=int, default=None, help='Max (rows x longest row) tokens per batch')
+    parser.add_argument('--max-length', type=int, default=None)
+    parser.add_argument('--data-config', default=None,
+                        help='data_config.yaml whose storage.cache_dir / max_cache_size enable the pair-score cache')
+    parser.add_argument('--timings', default=None, help='Write per-topic latency as JSON')
+    add_telemetry_args(parser)
+    args = parser.parse_args()
+    telemetry = Telemetry.from_args(args, 'rerank')
+
+    rerank_config = load_config(args.config).get('rerank', {})
+    backend = args.backend or rerank_config.get('backend', 'torch')
+    device = args.device or rerank_config.get('device', 'cpu')
+    if device == 'cuda' and not torch.cuda.is_available():
+        device = 'cpu'
+    depth = args.depth or rerank_config.get('depth', 100)
+
+    start = time.time()
+    with telemetry.stage('load'):
+        cache = SearchCache.from_config(args.data_config) if args.data_config else None
+        reranker = CrossEncoderReranker.load(
+            args.model_name or rerank_config.get('model_name', 'cross-encoder/ms-marco-MiniLM-L-6-v2'),
+            backend=backend, device=device, threads=args.threads or rerank_config.get('threads'),
+            max_length=args.max_length or rerank_config.get('max_length', 512),
+            token_budget=args.token_budget or rerank_config.get('token_budget', 16384),
+            cache=cache, onnx_dir=args.onnx_dir
+        )
+        store = SegmentStore(args.store)
+        vocab = DocidVocab()
+        run = read_run(args.run, vocab)
+        topics = read_topics(args.topics)
+    print(f"Loaded {backend} cross-encoder, segment store and {len(run)} topics in {time.time() - start:.1f}s")
+
+    with telemetry.stage('rerank') as stage:
+        reranked, timings = rerank_run(reranker, store, run, topics, vocab, depth)
+        stage.add_items(sum(timing['pairs'] for timing in timings.values()))
+        stage.set(topics=len(timings), scored_pairs=reranker.stats['scored'], batches=reranker.stats['batches'])
+    with telemetry.stage('write'):
+        write_run(args.output, reranked, args.run_name, vocab)
+    store.close()
+    print(f"Re-ranked top-{depth}: {summarize_timings(timings)}")
+    stats = reranker.stats
+    print(f"Scored {stats['scored']}/{stats['pairs']} pairs in {stats['batches']} batches"
+          + (f" ({cache.summary()})" if cache is not None else ''))
+    missing = sum(timing['missing'] for timing in timings.values())
+    if missing:
+        print(f"{missing} hits had no text in the segment store and were kept below the re-ranked hits")
+    if cache is not None:
+        cache.close()
+    if args.timings:
+        with open(args.timings, 'w', encoding='utf-8') as f:
+            json.dump(timings, f, indent=2)
+    print(f"Re-ranked run written to '{args.output}'")
+    telemetry.close()
+
+
+if __name__ == '__main__':
+    main()
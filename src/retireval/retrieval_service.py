@@ -0,0 +1,482 @@
+import os
+import json
+import signal
+import time
+import asyncio
+import argparse
+import threading
+import http.client
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from config import load_config
+from dense_search import read_topics
+from telemetry import Telemetry, add_telemetry_args
+
+MODES = ('dense', 'bm25', 'hybrid')
+# 延遲直方圖的桶上界 (毫秒)，最後一桶為 +Inf
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+HTTP_STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+class LatencyHistogram:
+    """
+    固定桶的延遲直方圖，另保留最近 window 筆樣本估計 p50 / p95 / p99。
+    """
+    def __init__(self, buckets_ms=LATENCY_BUCKETS_MS, window=10000):
+        self.buckets_ms = buckets_ms
+        self.counts = [0] * (len(buckets_ms) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, seconds):
+        ms = seconds * 1000
+        self.counts[bisect_left(self.buckets_ms, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.recent.append(ms)
+
+    def snapshot(self):
+        percentiles = np.percentile(self.recent, [50, 95, 99]) if self.recent else [None] * 3
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total_ms / self.count, 3) if self.count else None,
+            **{f"p{q}_ms": None if value is None else round(float(value), 3)
+               for q, value in zip((50, 95, 99), percentiles)},
+            'buckets': {f"le_{bound}ms": count for bound, count in zip(self.buckets_ms, self.counts)}
+                       | {'le_inf': self.counts[-1]},
+        }
+
+
+class MicroBatcher:
+    """
+    把同時到達的請求合併成小批次：佇列中第一個請求到達後最多再等 max_wait_ms 收集其他請求，
+    湊滿 max_batch_size 就立刻送出。批次在單一執行緒中依序執行 (模型不會被並行呼叫)，事件迴圈照常接收新請求。
+    process_batch(items) 須回傳與 items 等長的結果清單。
+    """
+    def __init__(self, process_batch, max_batch_size=32, max_wait_ms=5.0):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.batch_sizes = [0] * (max_batch_size + 1)
+        self.queue_wait = LatencyHistogram()
+        self.compute = LatencyHistogram()
+        self.in_flight = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self.executor.shutdown()
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future, time.perf_counter()))
+        return await future
+
+    async def _collect(self):
+        batch = [await self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            # 已在佇列中的請求直接取用，不必等待
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            start = time.perf_counter()
+            for _, _, enqueued in batch:
+                self.queue_wait.observe(start - enqueued)
+            self.batch_sizes[len(batch)] += 1
+            self.in_flight = len(batch)
+            try:
+                results = await loop.run_in_executor(self.executor, self.process_batch, [item for item, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (_, future, _), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+            self.compute.observe(time.perf_counter() - start)
+            self.in_flight = 0
+
+    def stats(self):
+        batches = sum(self.batch_sizes)
+        return {
+            'queue_depth': self.queue.qsize(),
+            'in_flight': self.in_flight,
+            'batches': batches,
+            'mean_batch_size': round(sum(size * count for size, count in enumerate(self.batch_sizes)) / batches, 2)
+                               if batches else None,
+            'batch_sizes': {size: count for size, count in enumerate(self.batch_sizes) if count},
+            'queue_wait': self.queue_wait.snapshot(),
+            'compute': self.compute.snapshot(),
+        }
+
+
+class RetrievalService:
+    """
+    常駐的檢索服務：查詢編碼模型、doc-ID 表、稠密索引與 (可選的) BM25 搜尋器只加載一次，
+    各請求經由 MicroBatcher 合併後，一批查詢只做一次編碼與一次索引掃描。
+    請求為 {"query": ..., "k": ..., "mode": "dense" | "bm25" | "hybrid"}，同一批中不同模式分開處理。
+    """
+    def __init__(self, dense=None, bm25=None, hybrid=None, k=1000, max_batch_size=32, max_wait_ms=5.0):
+        self.retrievers = {'dense': dense, 'bm25': bm25, 'hybrid': hybrid}
+        self.k = k
+        self.batcher = MicroBatcher(self._search_batch, max_batch_size, max_wait_ms)
+        self.latency = {mode: LatencyHistogram() for mode in MODES}
+        self.started_at = time.time()
+        self.errors = 0
+
+    def modes(self):
+        return [mode for mode in MODES if self.retrievers[mode] is not None]
+
+    def _search_batch(self, requests):
+        """
+        在批次執行緒中執行：依模式分組，每組以最大的 k 檢索一次，再依各請求的 k 截斷。
+        """
+        results = [None] * len(requests)
+        groups = {}
+        for position, request in enumerate(requests):
+            groups.setdefault(request['mode'], []).append(position)
+        with torch.inference_mode():
+            for mode, positions in groups.items():
+                # 以批次內的位置作為查詢 ID，客戶端送來相同 ID 也不會互相覆蓋
+                query_ids = [str(position) for position in positions]
+                query_texts = [requests[position]['query'] for position in positions]
+                k = max(requests[position]['k'] for position in positions)
+                hits = self._retrieve(mode, query_ids, query_texts, k)
+                for query_id, position in zip(query_ids, positions):
+                    docids, scores = hits[query_id]
+                    k = requests[position]['k']
+                    results[position] = [
+                        {'docid': docid, 'score': float(score)} for docid, score in zip(docids[:k], scores[:k])
+                    ]
+        return results
+
+    def _retrieve(self, mode, query_ids, query_texts, k):
+        retriever = self.retrievers[mode]
+        if mode != 'hybrid':
+            return retriever.search(query_ids, query_texts, k)
+        # 請求的 k 超過設定的 hybrid.k 時以請求的 k 檢索與融合，不會被截斷
+        fused, vocab = retriever.search(query_ids, query_texts, k=max(k, retriever.k))
+        return {
+            query_id: (vocab.decode(fused[query_id].docids), fused[query_id].scores) if query_id in fused else ([], [])
+            for query_id in query_ids
+        }
+
+    async def search(self, query, k=None, mode='dense'):
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode '{mode}', expected one of {MODES}")
+        if self.retrievers[mode] is None:
+            raise ValueError(f"Mode '{mode}' is not loaded in this service (available: {self.modes()})")
+        if not isinstance(query, str) or not query.strip():
+            raise ValueError("'query' must be a non-empty string")
+        k = int(k or self.k)
+        if k <= 0:
+            raise ValueError("'k' must be positive")
+        start = time.perf_counter()
+        hits = await self.batcher.submit({'query': query, 'k': k, 'mode': mode})
+        self.latency[mode].observe(time.perf_counter() - start)
+        return hits
+
+    def metrics(self):
+        return {
+            'uptime_seconds': round(time.time() - self.started_at, 1),
+            'modes': self.modes(),
+            'errors': self.errors,
+            'batcher': self.batcher.stats(),
+            'latency': {mode: histogram.snapshot() for mode, histogram in self.latency.items() if histogram.count},
+        }
+
+    # --- HTTP/1.1 (keep-alive)，只依賴標準函式庫 ---
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, payload = await self._route(method, path.split('?', 1)[0], body)
+                data = json.dumps(payload).encode('utf-8')
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTP_STATUS[status]}\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+                    .encode('latin-1') + data
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, method, path, body):
+        if path == '/health':
+            return 200, {'status': 'ok', 'modes': self.modes()}
+        if path == '/metrics':
+            return 200, self.metrics()
+        if path != '/search':
+            return 404, {'error': f"Unknown path '{path}'"}
+        if method != 'POST':
+            return 405, {'error': 'Use POST /search'}
+        try:
+            request = json.loads(body or b'{}')
+            # {"queries": [...]} 一次送多個查詢，各自進入批次佇列
+            if 'queries' in request:
+                results = await asyncio.gather(*(
+                    self.search(query, request.get('k'), request.get('mode', 'dense')) for query in request['queries']
+                ))
+                return 200, {'results': results}
+            return 200, {'results': await self.search(request.get('query'), request.get('k'),
+                                                       request.get('mode', 'dense'))}
+        except (ValueError, TypeError, KeyError) as e:
+            return 400, {'error': str(e)}
+        except Exception as e:
+            self.errors += 1
+            return 500, {'error': f"{type(e).__name__}: {e}"}
+
+    async def serve(self, host='127.0.0.1', port=8765, unix_socket=None):
+        """
+        服務到收到 SIGINT / SIGTERM 為止，結束前停止批次執行緒。
+        """
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        self.batcher.start()
+        if unix_socket:
+            if os.path.exists(unix_socket):
+                os.remove(unix_socket)
+            server = await asyncio.start_unix_server(self.handle_connection, path=unix_socket)
+            print(f"Serving {self.modes()} retrieval on unix socket '{unix_socket}'")
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port)
+            print(f"Serving {self.modes()} retrieval on http://{host}:{port}")
+        try:
+            async with server:
+                await stop.wait()
+        finally:
+            await self.batcher.stop()
+            if unix_socket and os.path.exists(unix_socket):
+                os.remove(unix_socket)
+        print("Service stopped")
+
+
+def load_service(config, model_name=None, dense_index=None, corpus_ids=None, bm25_index=None, data_config=None,
+                 nprobe=None, ef_search=None, max_batch_size=None, max_wait_ms=None, k=None):
+    """
+    依 retrieval_config.yaml 的 dense / bm25 / hybrid / service 設定建立服務；沒有 bm25_index 時只提供稠密檢索。
+    """
+    from hybrid_search import DenseRetriever, HybridRetriever, default_device, load_bm25_retriever
+    from search_cache import SearchCache
+
+    bm25_config = config.get('bm25', {})
+    dense_config = config.get('dense', {})
+    hybrid_config = config.get('hybrid', {})
+    service_config = config.get('service', {})
+
+    dense = bm25 = hybrid = None
+    if dense_index:
+        cache = SearchCache.from_config(data_config) if data_config else None
+        dense = DenseRetriever.load(
+            model_name or dense_config.get('model_name'), dense_index, ids_path=corpus_ids,
+            device=default_device(dense_config.get('device')), cache=cache,
+            backend=dense_config.get('backend', 'torch'), nprobe=nprobe, ef_search=ef_search,
+            candidates=dense_config.get('candidates')
+        )
+    if bm25_index:
+        bm25 = load_bm25_retriever(bm25_config, bm25_index)
+    if dense is not None and bm25 is not None:
+        hybrid = HybridRetriever(
+            bm25, dense,
+            weights=(hybrid_config.get('sparse_weight', 0.5), hybrid_config.get('dense_weight', 0.5)),
+            method=hybrid_config.get('fusion_method', 'rrf'), k=hybrid_config.get('k', 1000),
+            rrf_k=hybrid_config.get('rrf_k', 60), normalization=hybrid_config.get('normalization', 'minmax')
+        )
+    if dense is None and bm25 is None:
+        raise ValueError("The service needs a dense index, a BM25 index or both")
+    return RetrievalService(
+        dense, bm25, hybrid, k=k or service_config.get('k', 1000),
+        max_batch_size=max_batch_size or service_config.get('max_batch_size', 32),
+        max_wait_ms=max_wait_ms if max_wait_ms is not None else service_config.get('max_wait_ms', 5.0)
+    )
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=60):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        import socket
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class ServiceClient:
+    """
+    服務的同步客戶端 (每個執行緒各用一個，連線保持 keep-alive)。
+    """
+    def __init__(self, host='127.0.0.1', port=8765, unix_socket=None, timeout=60):
+        if unix_socket:
+            self.connection = UnixHTTPConnection(unix_socket, timeout)
+        else:
+            self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def request(self, method, path, payload=None):
+        body = json.dumps(payload).encode('utf-8') if payload is not None else None
+        self.connection.request(method, path, body=body, headers={'Content-Type': 'application/json'})
+        response = self.connection.getresponse()
+        result = json.loads(response.read())
+        if response.status != 200:
+            raise RuntimeError(f"{method} {path} failed with {response.status}: {result.get('error')}")
+        return result
+
+    def search(self, query, k=None, mode='dense'):
+        return self.request('POST', '/search', {'query': query, 'k': k, 'mode': mode})['results']
+
+    def metrics(self):
+        return self.request('GET', '/metrics')
+
+    def close(self):
+        self.connection.close()
+
+
+def query_topics(topics, output_path, run_name, k=1000, mode='dense', concurrency=8, host='127.0.0.1', port=8765,
+                 unix_socket=None):
+    """
+    以 concurrency 個並行客戶端把主題逐一送進服務 (模擬互動式使用)，結果寫成 TREC run，回傳各查詢的延遲 (秒)。
+    """
+    local, clients = threading.local(), []
+
+    def run_query(topic):
+        if not hasattr(local, 'client'):
+            local.client = ServiceClient(host, port, unix_socket)
+            clients.append(local.client)
+        start = time.perf_counter()
+        hits = local.client.search(topic[1], k, mode)
+        return topic[0], hits, time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(run_query, topics))
+    for client in clients:
+        client.close()
+
+    with open(output_path, 'w', encoding='utf-8') as f:
+        for query_id, hits, _ in results:
+            f.writelines(
+                f"{query_id} Q0 {hit['docid']} {rank} {hit['score']:.4f} {run_name}\n" for rank, hit in enumerate(hits, 1)
+            )
+    return [seconds for _, _, seconds in results]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Resident retrieval service with request micro-batching')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve = subparsers.add_parser('serve', help='Load the indexes once and serve queries over HTTP')
+    serve.add_argument('--config', default=None, help='retrieval_config.yaml (dense / bm25 / hybrid / service blocks)')
+    serve.add_argument('--dense-index', default=None, help='corpus_embeddings.npy or a faiss index')
+    serve.add_argument('--corpus-ids', default=None, help='Doc-ID table for the dense index')
+    serve.add_argument('--model-name', default=None, help='Query encoder (defaults to dense.model_name)')
+    serve.add_argument('--bm25-index', default=None, help='BM25 index (Lucene, or native with bm25.backend: native); enables the bm25 and hybrid modes')
+    serve.add_argument('--nprobe', type=int, default=None)
+    serve.add_argument('--ef-search', type=int, default=None)
+    serve.add_argument('--data-config', default=None,
+                       help='data_config.yaml whose storage.cache_dir / max_cache_size enable the dense search cache')
+    serve.add_argument('--max-batch-size', type=int, default=None, help='Requests coalesced into one batch')
+    serve.add_argument('--max-wait-ms', type=float, default=None, help='How long a batch waits for more requests')
+    serve.add_argument('--k', type=int, default=None, help='Default number of hits per query')
+    serve.add_argument('--host', default=None)
+    serve.add_argument('--port', type=int, default=None)
+    serve.add_argument('--unix-socket', default=None, help='Listen on a Unix socket instead of TCP')
+    add_telemetry_args(serve)
+
+    query = subparsers.add_parser('query', help='Send a topics file to a running service and write a TREC run')
+    query.add_argument('--topics', required=True)
+    query.add_argument('--output', required=True)
+    query.add_argument('--run-name', default='service')
+    query.add_argument('--mode', choices=MODES, default='dense')
+    query.add_argument('--k', type=int, default=1000)
+    query.add_argument('--concurrency', type=int, default=8, help='Parallel clients')
+    query.add_argument('--host', default='127.0.0.1')
+    query.add_argument('--port', type=int, default=8765)
+    query.add_argument('--unix-socket', default=None)
+
+    args = parser.parse_args()
+    if args.command == 'query':
+        topics = read_topics(args.topics)
+        latencies = query_topics(topics, args.output, args.run_name, args.k, args.mode, args.concurrency,
+                                 args.host, args.port, args.unix_socket)
+        latencies = np.array(latencies) * 1000
+        print(f"{len(topics)} queries: p50 {np.percentile(latencies, 50):.1f}ms p95 {np.percentile(latencies, 95):.1f}ms "
+              f"p99 {np.percentile(latencies, 99):.1f}ms")
+        client = ServiceClient(args.host, args.port, args.unix_socket)
+        batcher = client.metrics()['batcher']
+        client.close()
+        print(f"Service batches: {batcher['batches']} (mean size {batcher['mean_batch_size']})")
+        print(f"Run written to '{args.output}'")
+        return
+
+    config = load_config(args.config)
+    service_config = config.get('service', {})
+    telemetry = Telemetry.from_args(args, 'retrieval_service')
+    start = time.time()
+    with telemetry.stage('load'):
+        service = load_service(
+            config, model_name=args.model_name, dense_index=args.dense_index, corpus_ids=args.corpus_ids,
+            bm25_index=args.bm25_index, data_config=args.data_config, nprobe=args.nprobe, ef_search=args.ef_search,
+            max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms, k=args.k
+        )
+    print(f"Loaded {service.modes()} retrieval in {time.time() - start:.1f}s")
+    start = time.time()
+    asyncio.run(service.serve(
+        args.host or service_config.get('host', '127.0.0.1'), args.port or service_config.get('port', 8765),
+        args.unix_socket or service_config.get('unix_socket')
+    ))
+    telemetry.record('serve', time.time() - start, items=sum(histogram.count for histogram in service.latency.values()))
+    telemetry.close()
+
+
+if __name__ == '__main__':
+    main()
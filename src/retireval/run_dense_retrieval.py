@@ -2,17 +2,22 @@ import os
 import gzip
 import json
 import torch
-import torch.nn.functional as F
-from transformers import AutoTokenizer, AutoModel
+from transformers import AutoTokenizer
 from tqdm import tqdm
 import numpy as np
+import queue
 import shutil
+import argparse
+import multiprocessing as mp
 
-# --- 來自您範例的程式碼 (無變動) ---
-def mean_pooling(model_output, attention_mask):
-    token_embeddings = model_output[0]
-    input_mask_expanded = attention_mask.unsqueeze(-1).expand(token_embeddings.size()).float()
-    return torch.sum(token_embeddings * input_mask_expanded, 1) / torch.clamp(input_mask_expanded.sum(1), min=1e-9)
+from encode_pipeline import iter_encoded_windows, new_pipeline_stats
+from doc_ids import DocIdTableWriter
+from quantization import STORAGE_DTYPES, compute_int8_params, quantize_chunk, save_quant_params
+from segment_cache import SegmentEmbeddingCache, update_hash_index
+from search_cache import model_fingerprint
+# mean pooling / 正規化與模型加載 (含 ONNX、int8 後端) 見 encoders.py
+from encoders import BACKENDS, encode_features, load_model, sample_texts, verify_backend
+from telemetry import Telemetry, add_telemetry_args
 
 def process_batch(contents, tokenizer, model, device):
     """
@@ -20,44 +25,80 @@ def process_batch(contents, tokenizer, model, device):
     """
     # Tokenize sentences
     encoded_input = tokenizer(contents, padding=True, truncation=True, return_tensors='pt', max_length=512).to(device)
-    # Compute token embeddings
-    with torch.no_grad():
-        model_output = model(**encoded_input)
-    # Perform pooling
-    sentence_embeddings = mean_pooling(model_output, encoded_input['attention_mask'])
-    # Normalize embeddings
-    sentence_embeddings = F.normalize(sentence_embeddings, p=2, dim=1)
-    return sentence_embeddings.cpu()
+    return encode_features(encoded_input, model)
 
-# --- 主要邏輯修改 ---
+def plan_length_batches(lengths, token_budget):
+    """
+    依 token 長度由短到長排序後切成批次，使每批的 (列數 × 該批最長長度) 不超過 token_budget。
+    回傳每個批次在原始序列中的索引 (np.ndarray) 清單；單筆超過預算者自成一批。
+    """
+    lengths = np.asarray(lengths)
+    order = np.argsort(lengths, kind='stable')
+    batches = []
+    start = 0
+    while start < len(order):
+        end = start + 1
+        # 已排序，所以批次中最長的永遠是最後加入的那一筆
+        while end < len(order) and lengths[order[end]] * (end - start + 1) <= token_budget:
+            end += 1
+        batches.append(order[start:end])
+        start = end
+    return batches
 
-def create_corpus_embeddings_resumable(
-    corpus_folder, model_name, temp_output_folder, batch_size=32
-):
+def iter_tokenized_batches(contents, tokenizer, token_budget=None, max_length=512):
     """
-    可接續執行的索引建立流程。
-    為每個輸入文件在暫存資料夾中創建對應的嵌入檔案。
+    把一個視窗的文本 tokenize 成可直接送進模型的批次，產生 (原始索引, 已補齊的輸入)。
+    未設定 token_budget 時整個視窗為一批；否則依長度分桶，每批只補齊到該批最長的長度。
     """
-    # 建立暫存資料夾 (如果不存在)
-    os.makedirs(temp_output_folder, exist_ok=True)
-    
-    # 檢查是否有可用的 GPU
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    print(f"Using device: {device}")
+    if not token_budget:
+        encoded_input = tokenizer(contents, padding=True, truncation=True, return_tensors='pt', max_length=max_length)
+        yield torch.arange(len(contents)), encoded_input
+        return
 
-    # 從 HuggingFace Hub 加載模型
-    print("Loading model...")
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    model = AutoModel.from_pretrained(model_name).to(device)
-    model.eval()
+    encoded = tokenizer(contents, truncation=True, max_length=max_length)
+    lengths = [len(input_ids) for input_ids in encoded['input_ids']]
+    for batch_indices in plan_length_batches(lengths, token_budget):
+        features = [{key: encoded[key][i] for key in encoded.keys()} for i in batch_indices]
+        yield torch.from_numpy(batch_indices), tokenizer.pad(features, padding=True, return_tensors='pt')
 
-    # 1. 決定需要處理的檔案
-    all_source_files = {
+def process_length_bucketed(contents, tokenizer, model, device, token_budget=16384, max_length=512):
+    """
+    長度分桶的動態批次編碼。
+    先不補齊地 tokenize 整個視窗，依長度排序並以 token 預算組批，
+    每批只補齊到該批最長的長度，最後把嵌入向量依原始順序放回。
+    """
+    sentence_embeddings = None
+    for batch_indices, encoded_input in iter_tokenized_batches(contents, tokenizer, token_budget, max_length):
+        batch_embeddings = encode_features(encoded_input.to(device), model)
+        if sentence_embeddings is None:
+            sentence_embeddings = torch.empty((len(contents), batch_embeddings.shape[1]), dtype=batch_embeddings.dtype)
+        sentence_embeddings[batch_indices] = batch_embeddings
+    return sentence_embeddings
+
+# --- 主要邏輯修改 ---
+
+def encode_contents(contents, tokenizer, model, device, token_budget=None):
+    """
+    依設定選擇固定列數批次或長度分桶的動態批次來編碼一批文本。
+    """
+    if token_budget:
+        return process_length_bucketed(contents, tokenizer, model, device, token_budget=token_budget)
+    return process_batch(contents, tokenizer, model, device)
+
+def list_files_to_process(corpus_folder, temp_output_folder, shard_id=0, num_shards=1):
+    """
+    找出屬於本分片且尚未完成 (沒有 .done 標記) 的輸入檔案。
+    分片以排序後的完整檔案清單輪流分配，因此多台機器使用相同的 corpus_folder 路徑時分配結果一致。
+    """
+    all_source_files = sorted(
         os.path.join(dirpath, filename)
         for dirpath, _, filenames in os.walk(corpus_folder)
         for filename in filenames if filename.endswith('.json.gz')
+    )
+    shard_files = {
+        filepath for i, filepath in enumerate(all_source_files) if i % num_shards == shard_id
     }
-    
+
     processed_files = set()
     for filename in os.listdir(temp_output_folder):
         if filename.endswith('.done'):
@@ -65,123 +106,413 @@ def create_corpus_embeddings_resumable(
             original_path = filename[:-5].replace('___', '/')
             processed_files.add(original_path)
 
-    files_to_process = sorted(list(all_source_files - processed_files))
-    
+    files_to_process = sorted(shard_files - processed_files)
+    print(f"Total files: {len(all_source_files)}. Files in shard {shard_id}/{num_shards}: {len(shard_files)}. "
+          f"Already processed: {len(shard_files & processed_files)}. Files to process: {len(files_to_process)}")
+    return files_to_process
+
+def _iter_serial_windows(filepath, batch_size, encode):
+    """
+    單執行緒依序讀取、解析並編碼，每 batch_size 筆段落產生一次 (ids, embeddings)。
+    """
+    contents_batch = []
+    ids_batch = []
+
+    with gzip.open(filepath, 'rt', encoding='utf-8') as f:
+        for line in f:
+            try:
+                data = json.loads(line)
+                if 'id' in data and 'contents' in data and data['contents']:
+                    ids_batch.append(data['id'])
+                    contents_batch.append(data['contents'])
+
+                    if len(contents_batch) >= batch_size:
+                        yield ids_batch, encode(contents_batch)
+                        contents_batch, ids_batch = [], []
+
+            except (json.JSONDecodeError, KeyError):
+                continue
+
+    # 處理檔案中剩餘的最後一個批次
+    if contents_batch:
+        yield ids_batch, encode(contents_batch)
+
+def encode_file(filepath, tokenizer, model, device, temp_output_folder, batch_size=32, token_budget=None,
+                pipeline=False, stats=None, cache=None):
+    """
+    編碼單一輸入檔案，並在暫存資料夾寫入 .ids.json、.embed.npy 與 .done 標記。
+    各檔案先寫到暫存名稱再改名，多個行程或機器共用同一個暫存資料夾時不會讀到寫一半的檔案。
+    pipeline=True 時讀取/解析與 tokenize 在背景執行緒重疊進行，各階段吞吐量累計在 stats。
+    給定 SegmentEmbeddingCache 時，內容相同的段落只編碼一次，並另外寫出每列的內容雜湊 .hash.npy。
+    """
+    if cache is not None:
+        # 納入目前為止已完成的分片 (包含其他工作行程或先前執行的結果)
+        cache.refresh()
+
+    if pipeline:
+        windows = iter_encoded_windows(
+            filepath, batch_size,
+            tokenize_window=lambda contents: iter_tokenized_batches(contents, tokenizer, token_budget),
+            encode_batch=lambda encoded_input: encode_features(encoded_input.to(device), model),
+            stats=stats, cache=cache
+        )
+    else:
+        encode = lambda contents: encode_contents(contents, tokenizer, model, device, token_budget)
+        if cache is not None:
+            encode = lambda contents, encode=encode: cache.encode_window(contents, encode)
+        windows = _iter_serial_windows(filepath, batch_size, encode)
+
+    file_embeddings = []
+    file_doc_ids = []
+    for ids_batch, batch_embeddings in windows:
+        file_embeddings.append(batch_embeddings)
+        file_doc_ids.extend(ids_batch)
+
+    # 儲存該檔案的暫存結果
+    if file_doc_ids:
+        # 將檔案路徑轉換為安全的檔名
+        safe_filename = filepath.replace('/', '___')
+        base_path = os.path.join(temp_output_folder, safe_filename)
+        tmp_suffix = f".tmp{os.getpid()}"
+
+        # 儲存 IDs
+        with open(f"{base_path}.ids.json{tmp_suffix}", 'w', encoding='utf-8') as f_ids:
+            json.dump(file_doc_ids, f_ids)
+
+        # 儲存 embeddings
+        final_file_embeddings = torch.cat(file_embeddings).numpy()
+        with open(f"{base_path}.embed.npy{tmp_suffix}", 'wb') as f_embed:
+            np.save(f_embed, final_file_embeddings)
+
+        # 儲存內容雜湊 (最後才改名，有 .hash.npy 時 .embed.npy 一定已完整)
+        if cache is not None:
+            with open(f"{base_path}.hash.npy{tmp_suffix}", 'wb') as f_hash:
+                np.save(f_hash, cache.take_keys())
+
+        os.replace(f"{base_path}.ids.json{tmp_suffix}", f"{base_path}.ids.json")
+        os.replace(f"{base_path}.embed.npy{tmp_suffix}", f"{base_path}.embed.npy")
+        if cache is not None:
+            os.replace(f"{base_path}.hash.npy{tmp_suffix}", f"{base_path}.hash.npy")
+
+        # 建立一個完成標記檔
+        with open(f"{base_path}.done", 'w') as f_done:
+            f_done.write('done')
+
+    return len(file_doc_ids)
+
+def _encode_worker(worker_id, model_name, temp_output_folder, batch_size, token_budget, pipeline, num_threads,
+                   cache_folders, model_key, backend, onnx_dir, task_queue, result_queue):
+    """
+    工作行程：各自加載一份模型，從共用佇列取檔案編碼，直到收到 None 為止。
+    加載模型失敗 (路徑錯誤、GPU 記憶體不足等) 時也一定會送出結束訊息，主行程不會一直等待。
+    """
+    stats = new_pipeline_stats()
+    cache = None
+    error = None
+    try:
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        device = torch.device("cuda" if torch.cuda.is_available() and backend == 'torch' else "cpu")
+        tokenizer, model = load_model(model_name, device, backend, num_threads, onnx_dir)
+        cache = SegmentEmbeddingCache(cache_folders, model_key) if cache_folders else None
+
+        while True:
+            filepath = task_queue.get()
+            if filepath is None:
+                break
+            try:
+                num_segments = encode_file(filepath, tokenizer, model, device, temp_output_folder, batch_size,
+                                           token_budget, pipeline=pipeline, stats=stats, cache=cache)
+                result_queue.put((filepath, num_segments, None))
+            except Exception as e:
+                result_queue.put((filepath, 0, f"{type(e).__name__}: {e}"))
+                break # 發生錯誤時此工作行程停止，不再領取新的檔案
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    finally:
+        result_queue.put((None, worker_id, {
+            'error': error,
+            'stages': [stage.as_dict() for stage in stats.values()] if pipeline else None,
+            'dedup': cache.stats() if cache is not None else None,
+        }))
+
+def create_corpus_embeddings_resumable(
+    corpus_folder, model_name, temp_output_folder, batch_size=32, token_budget=None,
+    num_workers=1, threads_per_worker=None, shard_id=0, num_shards=1, pipeline=False, dedup=False, reuse_folders=(),
+    backend='torch', onnx_dir=None, parity_threshold=0.99
+):
+    """
+    可接續執行的索引建立流程。
+    為每個輸入文件在暫存資料夾中創建對應的嵌入檔案。
+    若設定 token_budget，batch_size 代表緩衝視窗的大小，視窗內改用長度分桶的動態批次編碼。
+    num_workers > 1 時啟動多個工作行程 (各有一份模型並固定 torch 執行緒數) 從共用佇列領取檔案；
+    shard_id/num_shards 則可把同一份工作拆給多台機器，寫入同一個暫存資料夾。
+    pipeline=True 時讀取/解析、tokenize 與模型編碼分成三個重疊的階段，並印出各階段的吞吐量。
+    dedup=True 時以段落文本的內容雜湊去除重複編碼，可沿用本次與 reuse_folders (先前以同一模型建立的暫存資料夾)
+    中已編碼的相同文本，並印出命中率。
+    backend 不是 torch 時 (ONNX Runtime / int8，見 encoders.py) 先以第一個檔案的段落比較其與 PyTorch 嵌入的
+    餘弦相似度，低於 parity_threshold 就停止。
+    回傳本次編碼的段落數。
+    """
+    # 建立暫存資料夾 (如果不存在)
+    os.makedirs(temp_output_folder, exist_ok=True)
+
+    # 1. 決定需要處理的檔案
+    files_to_process = list_files_to_process(corpus_folder, temp_output_folder, shard_id, num_shards)
+
     if not files_to_process:
         print("All files have already been processed and indexed.")
-        return
+        return 0
 
-    print(f"Total files: {len(all_source_files)}. Already processed: {len(processed_files)}. Files to process: {len(files_to_process)}")
+    if backend != 'torch':
+        # 同時在主行程完成 ONNX 匯出/量化，工作行程直接加載
+        verify_backend(model_name, backend, sample_texts(files_to_process[0]), threads_per_worker, onnx_dir,
+                       parity_threshold)
+
+    cache_folders, model_key = [], None
+    if dedup:
+        model_key = model_fingerprint(model_name, AutoTokenizer.from_pretrained(model_name), max_length=512,
+                                      backend=backend)
+        SegmentEmbeddingCache.mark_folder(temp_output_folder, model_name, model_key)
+        cache_folders = [temp_output_folder, *reuse_folders]
+        # 先把既有分片的雜湊合併成共用的 mmap 索引，工作行程不必各自載入
+        for folder in cache_folders:
+            update_hash_index(folder)
 
     # 2. 處理剩餘的檔案
-    for filepath in tqdm(files_to_process, desc="Processing files"):
-        file_embeddings = []
-        file_doc_ids = []
-        
-        contents_batch = []
-        ids_batch = []
+    if num_workers > 1:
+        return _encode_files_parallel(
+            files_to_process, model_name, temp_output_folder, batch_size, token_budget,
+            num_workers, threads_per_worker, pipeline, cache_folders, model_key, backend, onnx_dir
+        )
 
-        try:
-            with gzip.open(filepath, 'rt', encoding='utf-8') as f:
-                for line in f:
-                    try:
-                        data = json.loads(line)
-                        if 'id' in data and 'contents' in data and data['contents']:
-                            ids_batch.append(data['id'])
-                            contents_batch.append(data['contents'])
-
-                            if len(contents_batch) >= batch_size:
-                                batch_embeddings = process_batch(contents_batch, tokenizer, model, device)
-                                file_embeddings.append(batch_embeddings)
-                                file_doc_ids.extend(ids_batch)
-                                contents_batch, ids_batch = [], []
-
-                    except (json.JSONDecodeError, KeyError):
-                        continue
-            
-            # 處理檔案中剩餘的最後一個批次
-            if contents_batch:
-                batch_embeddings = process_batch(contents_batch, tokenizer, model, device)
-                file_embeddings.append(batch_embeddings)
-                file_doc_ids.extend(ids_batch)
-
-            # 3. 儲存該檔案的暫存結果
-            if file_doc_ids:
-                # 將檔案路徑轉換為安全的檔名
-                safe_filename = filepath.replace('/', '___')
-                
-                # 儲存 IDs
-                with open(os.path.join(temp_output_folder, f"{safe_filename}.ids.json"), 'w', encoding='utf-8') as f_ids:
-                    json.dump(file_doc_ids, f_ids)
-                
-                # 儲存 embeddings
-                final_file_embeddings = torch.cat(file_embeddings).numpy()
-                np.save(os.path.join(temp_output_folder, f"{safe_filename}.embed.npy"), final_file_embeddings)
-
-                # 建立一個完成標記檔
-                with open(os.path.join(temp_output_folder, f"{safe_filename}.done"), 'w') as f_done:
-                    f_done.write('done')
+    if threads_per_worker:
+        torch.set_num_threads(threads_per_worker)
+
+    # 檢查是否有可用的 GPU
+    device = torch.device("cuda" if torch.cuda.is_available() and backend == 'torch' else "cpu")
+    print(f"Using device: {device} ({backend})")
+
+    # 從 HuggingFace Hub 加載模型
+    print("Loading model...")
+    tokenizer, model = load_model(model_name, device, backend, threads_per_worker, onnx_dir)
+    cache = SegmentEmbeddingCache(cache_folders, model_key) if dedup else None
 
+    stats = new_pipeline_stats()
+    num_segments = 0
+    for filepath in tqdm(files_to_process, desc="Processing files"):
+        try:
+            num_segments += encode_file(filepath, tokenizer, model, device, temp_output_folder, batch_size, token_budget,
+                        pipeline=pipeline, stats=stats, cache=cache)
         except Exception as e:
             print(f"\nAn error occurred while processing {filepath}: {e}")
             print("The script will stop. You can run it again to resume.")
-            return # 發生錯誤時停止，以便下次可以從此檔案繼續
+            return num_segments # 發生錯誤時停止，以便下次可以從此檔案繼續
+        if pipeline:
+            tqdm.write("\n".join(str(stage) for stage in stats.values()))
+        if cache is not None:
+            tqdm.write(str(cache))
 
     print("All individual files have been processed.")
+    return num_segments
+
+def _encode_files_parallel(files_to_process, model_name, temp_output_folder, batch_size, token_budget, num_workers,
+                           threads_per_worker, pipeline, cache_folders=(), model_key=None, backend='torch', onnx_dir=None,
+                           result_poll_seconds=10):
+    """
+    以多個工作行程平行編碼檔案，完成與否仍以各檔案的 .done 標記為準。回傳編碼的段落數。
+    每 result_poll_seconds 秒沒有結果時檢查工作行程，有行程異常結束就終止其餘行程並拋出 RuntimeError。
+    """
+    num_workers = min(num_workers, len(files_to_process))
+    if not threads_per_worker:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // num_workers)
+    print(f"Starting {num_workers} worker processes with {threads_per_worker} threads each...")
+
+    ctx = mp.get_context('spawn')
+    task_queue = ctx.Queue()
+    result_queue = ctx.Queue()
+    for filepath in files_to_process:
+        task_queue.put(filepath)
+    for _ in range(num_workers):
+        task_queue.put(None)
+
+    workers = [
+        ctx.Process(
+            target=_encode_worker,
+            args=(worker_id, model_name, temp_output_folder, batch_size, token_budget, pipeline, threads_per_worker,
+                  list(cache_folders), model_key, backend, onnx_dir, task_queue, result_queue)
+        )
+        for worker_id in range(num_workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    failed = []
+    worker_errors = 0
+    finished_workers = set()
+    dedup_hits, dedup_total = 0, 0
+    num_segments = 0
+    with tqdm(total=len(files_to_process), desc="Processing files") as pbar:
+        while len(finished_workers) < num_workers:
+            try:
+                filepath, value, detail = result_queue.get(timeout=result_poll_seconds)
+            except queue.Empty:
+                # 正常結束的工作行程一定先送出結束訊息；異常結束 (例如被 OOM killer 終止) 的則永遠不會送
+                crashed = [
+                    worker_id for worker_id, worker in enumerate(workers)
+                    if worker_id not in finished_workers and worker.exitcode not in (None, 0)
+                ]
+                if crashed:
+                    for worker in workers:
+                        if worker.is_alive():
+                            worker.terminate()
+                    raise RuntimeError(
+                        "Worker process(es) " + ", ".join(
+                            f"{worker_id} (exit code {workers[worker_id].exitcode})" for worker_id in crashed
+                        ) + " died unexpectedly. You can run it again to resume."
+                    )
+                continue
+            if filepath is None:
+                # 工作行程結束，detail 為該行程各階段的吞吐量與去重命中數
+                finished_workers.add(value)
+                if detail['error'] is not None:
+                    worker_errors += 1
+                    print(f"\nWorker {value} failed: {detail['error']}")
+                if detail['stages'] is not None:
+                    tqdm.write(f"Worker {value}: " + ", ".join(
+                        f"{stage['stage']} {stage['items_per_second']} items/s (wait {stage['wait_seconds']}s)"
+                        for stage in detail['stages']
+                    ))
+                if detail['dedup'] is not None:
+                    dedup_hits += detail['dedup']['hits']
+                    dedup_total += detail['dedup']['hits'] + detail['dedup']['misses']
+            elif detail is not None:
+                failed.append(filepath)
+                print(f"\nAn error occurred while processing {filepath}: {detail}")
+            else:
+                num_segments += value
+                pbar.update(1)
+
+    for worker in workers:
+        worker.join()
+
+    if dedup_total:
+        print(f"Dedup: reused {dedup_hits}/{dedup_total} segment embeddings ({dedup_hits / dedup_total:.1%} hit rate)")
 
+    if failed or worker_errors:
+        print(f"{len(failed)} file(s) and {worker_errors} worker(s) failed. You can run it again to resume.")
+    else:
+        print("All individual files have been processed.")
+    return num_segments
 
-def merge_temp_files(temp_output_folder, output_embeddings_path, output_ids_path):
+
+def read_npy_header(path):
     """
-    合併暫存資料夾中的所有結果，生成最終的索引檔。
+    只讀取 .npy 檔頭，回傳 (shape, dtype)，不載入陣列內容。
     """
-    print(f"\nMerging temporary files from '{temp_output_folder}'...")
-    all_embeddings_list = []
-    all_ids_list = []
+    with open(path, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+    return shape, dtype
 
+def list_temp_shards(temp_output_folder):
+    """
+    依檔名排序列出暫存資料夾中成對的 (ids.json, embed.npy) 路徑。
+    """
     # 按檔名排序以確保一致性
     temp_files = sorted(os.listdir(temp_output_folder))
     
     # 找出所有對應的 ids.json 和 embed.npy 檔案
-    json_files = [f for f in temp_files if f.endswith('.ids.json')]
+    shards = []
+    for json_filename in temp_files:
+        if not json_filename.endswith('.ids.json'):
+            continue
+        base_name = json_filename[:-9] # 移除 '.ids.json'
+        embed_path = os.path.join(temp_output_folder, f"{base_name}.embed.npy")
+        if os.path.exists(embed_path):
+            shards.append((os.path.join(temp_output_folder, json_filename), embed_path))
+    return shards
 
-    if not json_files:
-        print("No temporary files to merge.")
-        return
+def merge_shards(shards, output_embeddings_path, output_ids_path, copy_rows=1 << 20, storage='float32',
+                 quant_params=None):
+    """
+    把 [(ids.json, embed.npy), ...] 依序串接成一個 memory-mapped 的嵌入矩陣與 doc-ID 表。
+    先只讀各檔的 .npy 檔頭算出總大小並預先配置輸出，再逐檔分段複製，記憶體用量只有單一檔案的大小。
+    storage 為 'int8' 時需要傳入量化參數 (會一併寫出 .quant.npz)。回傳合併的列數。
+    """
+    shapes = [read_npy_header(embed_path) for _, embed_path in shards]
+    total_rows = sum(shape[0] for shape, _ in shapes)
+    dims = {shape[1] for shape, _ in shapes if shape[0]}
+    if len(dims) != 1:
+        raise ValueError(f"Inconsistent embedding dimensions in temp files: {sorted(dims)}")
 
-    for json_filename in tqdm(json_files, desc="Merging files"):
-        base_name = json_filename[:-9] # 移除 '.ids.json'
-        embed_filename = f"{base_name}.embed.npy"
-        
-        json_path = os.path.join(temp_output_folder, json_filename)
-        embed_path = os.path.join(temp_output_folder, embed_filename)
+    final_embeddings = np.lib.format.open_memmap(
+        output_embeddings_path, mode='w+', dtype=STORAGE_DTYPES[storage], shape=(total_rows, dims.pop())
+    )
+    ids_writer = DocIdTableWriter(output_ids_path, total_rows)
+    row = 0
+    for json_path, embed_path in tqdm(shards, desc="Merging files"):
+        # 載入 IDs
+        with open(json_path, 'r', encoding='utf-8') as f:
+            ids = json.load(f)
 
-        if os.path.exists(embed_path):
-            # 載入 IDs
-            with open(json_path, 'r', encoding='utf-8') as f:
-                ids = json.load(f)
-                all_ids_list.extend(ids)
-            
-            # 載入 Embeddings
-            embeddings = np.load(embed_path)
-            all_embeddings_list.append(embeddings)
-    
-    if not all_ids_list:
+        # 以 mmap 讀取 Embeddings 並分段複製，避免整個檔案常駐記憶體
+        embeddings = np.load(embed_path, mmap_mode='r')
+        if len(ids) != embeddings.shape[0]:
+            raise ValueError(f"{json_path} has {len(ids)} ids but {embed_path} has {embeddings.shape[0]} rows")
+        for start in range(0, embeddings.shape[0], copy_rows):
+            chunk = embeddings[start:start + copy_rows]
+            final_embeddings[row + start:row + start + len(chunk)] = quantize_chunk(chunk, storage, quant_params)
+        row += embeddings.shape[0]
+        final_embeddings.flush()
+
+        ids_writer.append(ids)
+    ids_writer.close()
+    if quant_params is not None:
+        save_quant_params(output_embeddings_path, quant_params)
+    del final_embeddings
+    return total_rows
+
+
+def merge_temp_files(temp_output_folder, output_embeddings_path, output_ids_path, copy_rows=1 << 20, storage='float32',
+                     reduce_dim=None, reduce_method='pca'):
+    """
+    合併暫存資料夾中的所有結果，生成最終的索引檔 (見 merge_shards)，
+    同時把 IDs 串流寫成緊湊的 doc-ID 表 (見 doc_ids.py)。
+    storage 可設為 'float16' 或 'int8' (每維度 scale/offset) 以精簡格式輸出，int8 需要先多掃一次暫存檔求各維度範圍。
+    設定 reduce_dim 時另外寫出 PCA (或截斷) 降維的副本與兩階段搜尋清單 (見 reduced_search.py)。
+    之後語料只有部分檔案變動時，可用 delta_index.py 以 delta 分段增量更新，不必重新合併。
+    回傳合併的列數。
+    """
+    print(f"\nMerging temporary files from '{temp_output_folder}'...")
+    shards = list_temp_shards(temp_output_folder)
+
+    if not shards:
+        print("No temporary files to merge.")
+        return 0
+
+    if sum(read_npy_header(embed_path)[0][0] for _, embed_path in shards) == 0:
         print("No data found in temporary files.")
-        return
+        return 0
+    quant_params = None
+    if storage == 'int8':
+        print("Computing int8 quantization ranges...")
+        quant_params = compute_int8_params([np.load(embed_path, mmap_mode='r') for _, embed_path in shards], copy_rows)
 
-    # 合併成一個大的 NumPy 陣列
-    final_embeddings = np.concatenate(all_embeddings_list, axis=0)
-    
-    # 儲存最終結果
-    print(f"Saving final merged files...")
-    np.save(output_embeddings_path, final_embeddings)
-    with open(output_ids_path, 'w', encoding='utf-8') as f:
-        json.dump(all_ids_list, f)
+    total_rows = merge_shards(shards, output_embeddings_path, output_ids_path, copy_rows, storage, quant_params)
+    shape = read_npy_header(output_embeddings_path)[0]
+    if reduce_dim:
+        from reduced_search import build_reduced
+        build_reduced(output_embeddings_path, reduce_dim, reduce_method, storage=storage)
         
     print(f"\nMerge complete!")
-    print(f"Final embeddings saved to '{output_embeddings_path}' ({final_embeddings.shape})")
-    print(f"Final IDs saved to '{output_ids_path}' ({len(all_ids_list)} documents)")
+    print(f"Final embeddings saved to '{output_embeddings_path}' ({shape})")
+    print(f"Final IDs saved to '{output_ids_path}' ({total_rows} documents)")
     print(f"You can now run search.py. The temporary folder '{temp_output_folder}' can be deleted if desired.")
+    return total_rows
 
 
 if __name__ == '__main__':
@@ -192,23 +523,80 @@ if __name__ == '__main__':
     # 暫存與最終輸出路徑
     TEMP_OUTPUT_FOLDER = 'temp_output'
     FINAL_EMBEDDINGS_FILE = 'corpus_embeddings.npy'
-    FINAL_IDS_FILE = 'corpus_ids.json'
+    FINAL_IDS_FILE = 'corpus_ids'
     
     BATCH_SIZE = 1024
+    # 每個動態批次的 token 上限 (列數 × 補齊後長度)；設為 None 則使用固定列數批次
+    TOKEN_BUDGET = 16384
+    # 長度分桶時一次緩衝的段落數，視窗越大分桶越整齊
+    WINDOW_SIZE = 8192
+
+    parser = argparse.ArgumentParser(description='Encode the corpus into dense embeddings (resumable)')
+    parser.add_argument('--corpus-folder', default=CORPUS_FOLDER)
+    parser.add_argument('--model-name', default=MODEL_NAME)
+    parser.add_argument('--temp-output-folder', default=TEMP_OUTPUT_FOLDER)
+    parser.add_argument('--embeddings-output', default=FINAL_EMBEDDINGS_FILE)
+    parser.add_argument('--ids-output', default=FINAL_IDS_FILE)
+    parser.add_argument('--num-workers', type=int, default=1, help='Number of local encoder processes')
+    parser.add_argument('--threads-per-worker', type=int, default=None, help='torch.set_num_threads for each process')
+    parser.add_argument('--shard-id', type=int, default=0, help='Shard of the input files handled by this machine')
+    parser.add_argument('--num-shards', type=int, default=1, help='Total number of machines sharing the temp folder')
+    parser.add_argument('--pipeline', action=argparse.BooleanOptionalAction, default=True,
+                        help='Overlap reading/parsing, tokenization and encoding in separate threads')
+    parser.add_argument('--dedup', action=argparse.BooleanOptionalAction, default=True,
+                        help='Skip the forward pass for segments whose text was already embedded (content hash)')
+    parser.add_argument('--reuse-embeddings', nargs='*', default=[],
+                        help='Temp folders of earlier runs with the same model whose embeddings may be reused')
+    parser.add_argument('--backend', choices=BACKENDS, default='torch',
+                        help='Encoder backend; onnx / onnx-int8 run under ONNX Runtime on CPU (see encoders.py)')
+    parser.add_argument('--onnx-dir', default=None, help='Where the exported ONNX model is kept (default: <model>/onnx for a local model, else under $HF_HOME/onnx)')
+    parser.add_argument('--parity-threshold', type=float, default=0.99,
+                        help='Minimum cosine similarity of non-torch backends to the PyTorch embeddings')
+    parser.add_argument('--merge-only', action='store_true', help='Skip encoding and only merge the temp folder')
+    parser.add_argument('--storage', choices=['float32', 'float16', 'int8'], default='float32',
+                        help='Storage precision of the merged embeddings')
+    parser.add_argument('--reduce-dim', type=int, default=None,
+                        help='Also write a reduced-dimension copy (e.g. 64 or 128) for two-stage search')
+    parser.add_argument('--reduce-method', choices=['pca', 'truncate'], default='pca')
+    add_telemetry_args(parser)
+    args = parser.parse_args()
+    telemetry = Telemetry.from_args(args, 'dense_encode')
 
     # --- 執行流程 ---
     
     # 步驟 1: 處理所有單獨的檔案，支援中斷續傳
-    create_corpus_embeddings_resumable(
-        corpus_folder=CORPUS_FOLDER,
-        model_name=MODEL_NAME,
-        temp_output_folder=TEMP_OUTPUT_FOLDER,
-        batch_size=BATCH_SIZE
-    )
+    if not args.merge_only:
+        with telemetry.stage('encode') as stage:
+            stage.set(num_workers=args.num_workers, backend=args.backend)
+            stage.add_items(create_corpus_embeddings_resumable(
+                corpus_folder=args.corpus_folder,
+                model_name=args.model_name,
+                temp_output_folder=args.temp_output_folder,
+                batch_size=WINDOW_SIZE if TOKEN_BUDGET else BATCH_SIZE,
+                token_budget=TOKEN_BUDGET,
+                num_workers=args.num_workers,
+                threads_per_worker=args.threads_per_worker,
+                shard_id=args.shard_id,
+                num_shards=args.num_shards,
+                pipeline=args.pipeline,
+                dedup=args.dedup,
+                reuse_folders=args.reuse_embeddings,
+                backend=args.backend,
+                onnx_dir=args.onnx_dir,
+                parity_threshold=args.parity_threshold
+            ))
     
     # 步驟 2: 合併所有暫存檔為最終的索引
-    merge_temp_files(
-        temp_output_folder=TEMP_OUTPUT_FOLDER,
-        output_embeddings_path=FINAL_EMBEDDINGS_FILE,
-        output_ids_path=FINAL_IDS_FILE
-    )
\ No newline at end of file
+    # 多機分片時其他分片可能尚未完成，需等全部完成後再以 --merge-only 合併
+    if args.num_shards == 1 or args.merge_only:
+        with telemetry.stage('merge') as stage:
+            stage.set(storage=args.storage, reduce_dim=args.reduce_dim)
+            stage.add_items(merge_temp_files(
+                temp_output_folder=args.temp_output_folder,
+                output_embeddings_path=args.embeddings_output,
+                output_ids_path=args.ids_output,
+                storage=args.storage,
+                reduce_dim=args.reduce_dim,
+                reduce_method=args.reduce_method
+            ))
+    telemetry.close()
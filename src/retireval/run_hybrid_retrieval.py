@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import time
+
+from config import load_config
+from dense_search import read_topics
+from fusion import DocidVocab, read_run, write_run, format_run, fuse_runs, fuse_runs_sweep
+from telemetry import Telemetry, add_telemetry_args
+
+
+def setup_logging(log_file):
+    """Set up logging configuration."""
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file))
+    for handler in handlers:
+        handler.setLevel(logging.INFO)
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+
+    return logger
+
+
+def parse_weight_grid(spec, num_runs):
+    """
+    權重掃描設定，例如 "0:1:0.1" 代表第一個 run 的權重從 0 到 1 (間隔 0.1)，
+    兩個 run 時第二個 run 的權重為 1 - w；也接受以分號分隔的完整權重組 "0.3,0.7;0.5,0.5"。
+    """
+    if ';' in spec or (',' in spec and ':' not in spec):
+        return [[float(w) for w in setting.split(',')] for setting in spec.split(';')]
+    start, stop, step = (float(v) for v in spec.split(':'))
+    if num_runs != 2:
+        raise ValueError("Range sweeps are only supported for two runs; pass explicit weight settings instead")
+    steps = int(round((stop - start) / step)) + 1
+    return [[round(start + i * step, 10), round(1 - (start + i * step), 10)] for i in range(steps)]
+
+
+def run_topics(args, config, logger, telemetry):
+    """
+    一次完成 BM25 + 稠密檢索 + 融合：Lucene 搜尋器、查詢編碼模型與稠密索引只加載一次，
+    兩種檢索在每批查詢上同時執行，中間結果不寫入磁碟。
+    """
+    from hybrid_search import DenseRetriever, HybridRetriever, default_device, load_bm25_retriever
+    from search_cache import SearchCache
+
+    bm25_config = config.get('bm25', {})
+    dense_config = config.get('dense', {})
+    hybrid_config = config.get('hybrid', {})
+
+    start = time.time()
+    with telemetry.stage('load'):
+        bm25 = load_bm25_retriever(bm25_config, args.bm25_index)
+        cache = SearchCache.from_config(args.data_config) if args.data_config else None
+        dense = DenseRetriever.load(
+            args.model_name or dense_config.get('model_name'), args.dense_index, ids_path=args.corpus_ids,
+            device=default_device(dense_config.get('device')), cache=cache, backend=dense_config.get('backend', 'torch'),
+            nprobe=args.nprobe, ef_search=args.ef_search, candidates=dense_config.get('candidates')
+        )
+        retriever = HybridRetriever(
+            bm25, dense,
+            weights=(hybrid_config.get('sparse_weight', 0.5), hybrid_config.get('dense_weight', 0.5)),
+            method=args.method or hybrid_config.get('fusion_method', 'rrf'),
+            k=hybrid_config.get('k', 1000), rrf_k=hybrid_config.get('rrf_k', 60),
+            normalization=args.normalization or hybrid_config.get('normalization', 'minmax'),
+            depth=args.depth
+        )
+    logger.info(f"Loaded BM25 searcher and dense index in {time.time() - start:.1f}s")
+
+    topics = read_topics(args.topics)
+    timings = {}
+    start = time.time()
+    with telemetry.stage('retrieve', items=len(topics)):
+        with open(args.output, 'w', encoding='utf-8') as f:
+            for fused, vocab in retriever.search_topics(topics, batch_size=args.query_batch_size, timings=timings):
+                f.writelines(format_run(fused, args.run_name, vocab))
+        # bm25 / dense 在執行緒中同時進行，各自的累計時間加總可超過 retrieve 的牆鐘時間
+        for name, seconds in timings.items():
+            telemetry.record(name, seconds, items=len(topics))
+    retriever.close()
+    bm25.close()
+    if cache is not None:
+        logger.info(f"Dense cache: {cache.summary()}")
+        cache.close()
+    logger.info(f"Retrieved {len(topics)} topics in {time.time() - start:.1f}s "
+                f"(bm25 {timings.get('bm25', 0):.1f}s, dense {timings.get('dense', 0):.1f}s, "
+                f"fusion {timings.get('fusion', 0):.1f}s)")
+    logger.info(f"Hybrid run written to {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fuse sparse and dense TREC runs into a hybrid run')
+    parser.add_argument('--config', default=None, help='Path to retrieval_config.yaml')
+    parser.add_argument('--bm25-results', default=None, help='BM25 run file')
+    parser.add_argument('--dense-results', default=None, help='Dense run file')
+    parser.add_argument('--runs', nargs='*', default=[], help='Additional run files, optionally as path:weight')
+    parser.add_argument('--method', choices=['rrf', 'weighted'], default=None)
+    parser.add_argument('--normalization', choices=['minmax', 'zscore', 'none'], default=None)
+    parser.add_argument('--sweep', default=None,
+                        help='Weight sweep, e.g. "0:1:0.1" or "0.3,0.7;0.5,0.5"; writes one run per setting')
+    parser.add_argument('--topics', default=None,
+                        help='Topics file; runs BM25 and dense retrieval in-process instead of fusing run files')
+    parser.add_argument('--bm25-index', default=None, help='BM25 index (defaults to bm25.index_dir, or bm25.native_index_dir with bm25.backend: native)')
+    parser.add_argument('--dense-index', default=None, help='corpus_embeddings.npy or a faiss index')
+    parser.add_argument('--corpus-ids', default=None, help='Doc-ID table for the dense index')
+    parser.add_argument('--model-name', default=None, help='Query encoder (defaults to dense.model_name)')
+    parser.add_argument('--nprobe', type=int, default=None)
+    parser.add_argument('--ef-search', type=int, default=None)
+    parser.add_argument('--depth', type=int, default=None, help='Candidates per system (defaults to hybrid.k)')
+    parser.add_argument('--query-batch-size', type=int, default=64)
+    parser.add_argument('--data-config', default=None,
+                        help='data_config.yaml whose storage.cache_dir / max_cache_size enable the dense search cache')
+    add_telemetry_args(parser)
+    parser.add_argument('--output', required=True, help='Fused run file (a prefix when sweeping)')
+    parser.add_argument('--run-name', default='hybrid')
+    parser.add_argument('--log-file', default=None, help='Path to log file')
+    args = parser.parse_args()
+
+    logger = setup_logging(args.log_file)
+    config = load_config(args.config)
+    telemetry = Telemetry.from_args(args, 'hybrid_retrieval' if args.topics else 'fusion')
+    if args.topics:
+        if not args.dense_index:
+            parser.error('--dense-index is required with --topics')
+        if args.sweep:
+            parser.error('--sweep is only supported when fusing run files')
+        run_topics(args, config, logger, telemetry)
+        telemetry.close()
+        return
+
+    hybrid_config = config.get('hybrid', {})
+    method = args.method or hybrid_config.get('fusion_method', 'rrf')
+    normalization = args.normalization or hybrid_config.get('normalization', 'minmax')
+    k = hybrid_config.get('k', 1000)
+    rrf_k = hybrid_config.get('rrf_k', 60)
+
+    run_paths, weights = [], []
+    if args.bm25_results:
+        run_paths.append(args.bm25_results)
+        weights.append(hybrid_config.get('sparse_weight', 1.0))
+    if args.dense_results:
+        run_paths.append(args.dense_results)
+        weights.append(hybrid_config.get('dense_weight', 1.0))
+    for spec in args.runs:
+        # 權重接在最後一個冒號後；路徑本身可能含有冒號
+        path, weight = spec, 1.0
+        if ':' in spec:
+            head, tail = spec.rsplit(':', 1)
+            try:
+                path, weight = head, float(tail)
+            except ValueError:
+                pass
+        run_paths.append(path)
+        weights.append(weight)
+    if len(run_paths) < 2:
+        parser.error('At least two runs are needed for fusion')
+
+    start = time.time()
+    vocab = DocidVocab()
+    with telemetry.stage('read_runs', items=len(run_paths)):
+        runs = [read_run(path, vocab) for path in run_paths]
+    logger.info(f"Loaded {len(runs)} runs in {time.time() - start:.3f}s")
+
+    start = time.time()
+    if args.sweep:
+        weight_grid = parse_weight_grid(args.sweep, len(runs))
+        with telemetry.stage('fuse', items=len(weight_grid)):
+            fused_runs = fuse_runs_sweep(runs, weight_grid, method=method, k=k, rrf_k=rrf_k, normalization=normalization)
+        logger.info(f"Fused {len(weight_grid)} weight settings with {method} in {time.time() - start:.3f}s")
+        with telemetry.stage('write', items=len(fused_runs)):
+            for setting, fused in zip(weight_grid, fused_runs):
+                suffix = '_'.join(f"{w:g}" for w in setting)
+                write_run(f"{args.output}.{suffix}", fused, f"{args.run_name}-{suffix}", vocab)
+        logger.info(f"Wrote {len(fused_runs)} runs with prefix {args.output}")
+        telemetry.close()
+        return
+
+    with telemetry.stage('fuse') as stage:
+        fused = fuse_runs(runs, weights, method=method, k=k, rrf_k=rrf_k, normalization=normalization)
+        stage.add_items(len(fused))
+    logger.info(f"Fused {len(fused)} topics with {method} (weights {weights}) in {time.time() - start:.3f}s")
+    with telemetry.stage('write'):
+        write_run(args.output, fused, args.run_name, vocab)
+    logger.info(f"Hybrid run written to {args.output}")
+    telemetry.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import numpy as np
+
+from config import load_config
+
+SIZE_UNITS = {
+    '': 1, 'B': 1,
+    'K': 2 ** 10, 'KB': 2 ** 10, 'M': 2 ** 20, 'MB': 2 ** 20,
+    'G': 2 ** 30, 'GB': 2 ** 30, 'T': 2 ** 40, 'TB': 2 ** 40,
+}
+
+
+def parse_size(size):
+    """
+    把 "10GB"、"512MB" (或 "10G"、"512M") 之類的大小設定轉成 bytes；數字則直接視為 bytes。
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?B?)\s*', size.upper())
+    if match is None:
+        raise ValueError(f"Invalid size: {size}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def make_key(*parts):
+    """
+    內容定址的快取鍵：把各組成部分序列化後取 sha256。
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def _path_fingerprint(path):
+    """
+    路徑 (檔案或資料夾內的檔案) 的絕對路徑、大小與修改時間；檔案重建後指紋就會改變。
+    """
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        entries = sorted(
+            (name, os.path.getsize(os.path.join(path, name)), os.path.getmtime(os.path.join(path, name)))
+            for name in os.listdir(path) if os.path.isfile(os.path.join(path, name))
+        )
+    elif os.path.exists(path):
+        entries = [(os.path.getsize(path), os.path.getmtime(path))]
+    else:
+        entries = []  # 例如 HuggingFace Hub 上的模型名稱
+    return [path, entries]
+
+
+def model_fingerprint(model_name, tokenizer, max_length=None, backend='torch'):
+    """
+    查詢嵌入的快取鍵前綴：模型路徑 (含權重檔的大小/時間)、tokenizer 設定與池化方式；
+    int8 / ONNX 後端的嵌入與 PyTorch fp32 不完全相同，因此後端也是鍵的一部分 (torch 時維持原本的鍵)。
+    """
+    parts = [
+        'model', _path_fingerprint(model_name), type(tokenizer).__name__,
+        max_length or tokenizer.model_max_length, tokenizer.init_kwargs.get('do_lower_case'), 'mean-pooling-l2'
+    ]
+    if backend != 'torch':
+        parts.append(backend)
+    return make_key(*parts)
+
+
+def index_fingerprint(index_path, **search_params):
+    """
+    檢索結果的快取鍵前綴：索引檔 (含 int8 量化參數等附屬檔) 的指紋與搜尋參數。
+    """
+    sidecars = [path for path in (f"{index_path}.quant.npz", f"{index_path}.meta.json") if os.path.exists(path)]
+    return make_key('index', _path_fingerprint(index_path), [_path_fingerprint(path) for path in sidecars], search_params)
+
+
+class SearchCache:
+    """
+    磁碟上的查詢嵌入 / top-k 結果快取 (單一 SQLite 檔)，總大小超過上限時依最近使用時間 (LRU) 淘汰。
+    多個程序可以共用同一個快取資料夾。
+    """
+    def __init__(self, cache_dir, max_size='10GB'):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, 'search_cache.sqlite')
+        self.max_bytes = parse_size(max_size)
+        # HybridRetriever 會在工作執行緒中使用快取 (同一時間只有一個執行緒)
+        self.conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'key TEXT PRIMARY KEY, kind TEXT, value BLOB, size INTEGER, last_access REAL)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)')
+        self.conn.commit()
+        self.stats = {}
+
+    @classmethod
+    def from_config(cls, config_path):
+        """
+        依 data_config.yaml 的 storage.cache_dir / storage.max_cache_size 建立快取。
+        """
+        storage = load_config(config_path).get('storage', {})
+        return cls(storage.get('cache_dir', 'data/cache'), storage.get('max_cache_size', '10GB'))
+
+    def _count(self, kind, hits, misses):
+        stats = self.stats.setdefault(kind, {'hits': 0, 'misses': 0})
+        stats['hits'] += hits
+        stats['misses'] += misses
+
+    def get_many(self, kind, keys):
+        """
+        回傳 {key: bytes}，只包含命中的鍵，並更新它們的最近使用時間。
+        """
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        # SQLite 的參數數量有上限，分段查詢
+        for start in range(0, len(unique_keys), 500):
+            chunk = unique_keys[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            found.update(self.conn.execute(
+                f'SELECT key, value FROM entries WHERE key IN ({placeholders})', chunk
+            ).fetchall())
+            self.conn.execute(
+                f'UPDATE entries SET last_access = ? WHERE key IN ({placeholders})', [time.time(), *chunk]
+            )
+        self.conn.commit()
+        self._count(kind, sum(key in found for key in keys), sum(key not in found for key in keys))
+        return found
+
+    def put_many(self, kind, items):
+        now = time.time()
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO entries (key, kind, value, size, last_access) VALUES (?, ?, ?, ?, ?)',
+            [(key, kind, value, len(value), now) for key, value in items]
+        )
+        self.conn.commit()
+        self.evict()
+
+    def size(self):
+        return self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def evict(self):
+        """
+        超過大小上限時刪除最久未使用的項目，直到總大小回到上限的 90%。
+        """
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return 0
+        excess += self.max_bytes // 10
+        keys, freed = [], 0
+        for key, size in self.conn.execute('SELECT key, size FROM entries ORDER BY last_access'):
+            keys.append(key)
+            freed += size
+            if freed >= excess:
+                break
+        self.conn.executemany('DELETE FROM entries WHERE key = ?', [(key,) for key in keys])
+        self.conn.commit()
+        return len(keys)
+
+    def clear(self):
+        self.conn.execute('DELETE FROM entries')
+        self.conn.commit()
+        self.conn.execute('VACUUM')
+
+    def close(self):
+        self.conn.close()
+
+    def summary(self):
+        return ', '.join(
+            f"{kind}: {stats['hits']}/{stats['hits'] + stats['misses']} hits" for kind, stats in self.stats.items()
+        )
+
+
+def encode_queries_cached(cache, model_key, query_texts, encode):
+    """
+    先從快取取出查詢嵌入，只把沒命中的查詢交給 encode(texts) -> (n, dim) 編碼，並寫回快取。
+    回傳 (Q, dim) float32 numpy 陣列。
+    """
+    keys = [make_key('query_embedding', model_key, query_text) for query_text in query_texts]
+    found = cache.get_many('query_embedding', keys)
+    missing = [i for i, key in enumerate(keys) if key not in found]
+    vectors = {key: np.frombuffer(value, dtype=np.float32) for key, value in found.items()}
+    if missing:
+        # 同一批中重複的查詢只編碼一次
+        missing_keys = list(dict.fromkeys(keys[i] for i in missing))
+        texts = {keys[i]: query_texts[i] for i in missing}
+        encoded = np.asarray(encode([texts[key] for key in missing_keys]), dtype=np.float32)
+        vectors.update(zip(missing_keys, encoded))
+        cache.put_many('query_embedding', [(key, vectors[key].tobytes()) for key in missing_keys])
+    if not keys:
+        return np.empty((0, 0), dtype=np.float32)
+    return np.stack([vectors[key] for key in keys])
+
+
+def search_cached(cache, index_key, query_embeddings, k, search):
+    """
+    以 (索引指紋, 查詢嵌入, k) 為鍵快取 top-k 結果，只對沒命中的查詢呼叫 search(embeddings, k)。
+    回傳與 FlatIndex.search 相同的 (scores, rows)。
+    """
+    query_embeddings = np.ascontiguousarray(query_embeddings, dtype=np.float32)
+    keys = [
+        make_key('results', index_key, k, hashlib.sha256(query_embedding.tobytes()).hexdigest())
+        for query_embedding in query_embeddings
+    ]
+    found = cache.get_many('results', keys)
+    missing = [i for i, key in enumerate(keys) if key not in found]
+    results = {}
+    for key, value in found.items():
+        # 每筆結果依序存放 float32 分數與 int64 列號
+        count = len(value) // 12
+        results[key] = (np.frombuffer(value[:count * 4], dtype=np.float32), np.frombuffer(value[count * 4:], dtype=np.int64))
+    if missing:
+        scores, rows = search(query_embeddings[missing], k)
+        new_items = []
+        for i, query_scores, query_rows in zip(missing, scores, rows):
+            query_scores = np.asarray(query_scores, dtype=np.float32)
+            query_rows = np.asarray(query_rows, dtype=np.int64)
+            results[keys[i]] = (query_scores, query_rows)
+            new_items.append((keys[i], query_scores.tobytes() + query_rows.tobytes()))
+        cache.put_many('results', new_items)
+    width = max((len(results[key][0]) for key in keys), default=0)
+    scores = np.full((len(keys), width), -np.inf, dtype=np.float32)
+    rows = np.full((len(keys), width), -1, dtype=np.int64)
+    for i, key in enumerate(keys):
+        query_scores, query_rows = results[key]
+        scores[i, :len(query_scores)] = query_scores
+        rows[i, :len(query_rows)] = query_rows
+    return scores, rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or clear the query-embedding / result cache')
+    parser.add_argument('--config', default='configs/data_config.yaml')
+    parser.add_argument('command', choices=['stats', 'evict', 'clear'])
+    args = parser.parse_args()
+
+    cache = SearchCache.from_config(args.config)
+    if args.command == 'evict':
+        print(f"Evicted {cache.evict()} entries")
+    elif args.command == 'clear':
+        cache.clear()
+        print(f"Cleared '{cache.path}'")
+    for kind, count, size in cache.conn.execute('SELECT kind, COUNT(*), SUM(size) FROM entries GROUP BY kind'):
+        print(f"{kind:<16} {count:>10} entries {size / 2 ** 20:>10.1f} MB")
+    print(f"total {cache.size() / 2 ** 20:.1f} MB / limit {cache.max_bytes / 2 ** 20:.1f} MB")
+    cache.close()
+
+
+if __name__ == '__main__':
+    main()
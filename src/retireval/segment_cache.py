@@ -0,0 +1,486 @@
+import os
+import json
+import fcntl
+import hashlib
+import threading
+from contextlib import contextmanager
+import numpy as np
+import torch
+
+HASH_SUFFIX = '.hash.npy'
+ENCODER_FILE = 'encoder.json'
+INDEX_FILE = 'hash_index.json'
+INDEX_LOCK = 'hash_index.lock'
+# 索引中每個雜湊的其餘欄位 (依雜湊高 64 位元排序的 .hi.npy 另外存放，二分搜尋時是連續的)
+INDEX_META_DTYPE = np.dtype([('lo', '<u8'), ('shard', '<u4'), ('row', '<u4')])
+# 還沒併入索引的分片列數超過 MERGE_MIN_ROWS 且超過索引的 1/MERGE_RATIO 時合併
+MERGE_MIN_ROWS = 1 << 20
+MERGE_RATIO = 8
+MERGE_CHUNK = 1 << 22
+
+
+def hash_contents(contents):
+    """
+    每段文本的 128-bit 內容雜湊 (blake2b)，回傳 (N, 2) 的 uint64 陣列。
+    """
+    digests = b''.join(hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest() for text in contents)
+    return np.frombuffer(digests, dtype=np.uint64).reshape(-1, 2)
+
+
+class WindowPlan:
+    """
+    一個視窗的去重結果：
+    miss_positions 為需要實際編碼的位置 (每個新文本只出現一次)；
+    hit_positions/hit_vectors 為可直接沿用的嵌入；
+    copy_to/copy_from 為同一視窗內重複的文本，編碼後從第一次出現的位置複製；
+    deferred_positions 為前面的視窗正在編碼 (已規劃、尚未 fill) 的文本，fill 時從記憶體中的暫存取用。
+    """
+    __slots__ = ('keys', 'miss_positions', 'hit_positions', 'hit_vectors', 'copy_to', 'copy_from',
+                 'deferred_positions')
+
+    def __init__(self, keys, miss_positions, hit_positions, hit_vectors, copy_to, copy_from, deferred_positions):
+        self.keys = keys
+        self.miss_positions = miss_positions
+        self.hit_positions = hit_positions
+        self.hit_vectors = hit_vectors
+        self.copy_to = copy_to
+        self.copy_from = copy_from
+        self.deferred_positions = deferred_positions
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class _Shard:
+    """
+    還沒合併進資料夾雜湊索引的單一分片 (通常是這次執行中剛寫出的)，雜湊載入記憶體。
+    """
+    def __init__(self, hash_path, embed_path):
+        keys = np.load(hash_path)
+        order = np.argsort(keys[:, 0], kind='stable')
+        self.sorted_hi = keys[order, 0]
+        self.sorted_lo = keys[order, 1]
+        self.rows = order.astype(np.int32 if len(order) < 2 ** 31 else np.int64)
+        self.embeddings = np.load(embed_path, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.rows)
+
+    def lookup(self, keys):
+        """
+        回傳每個鍵在此分片中的列號，找不到為 -1。
+        """
+        if not len(self.sorted_hi) or not len(keys):
+            return np.full(len(keys), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.sorted_hi, keys[:, 0]), len(self.sorted_hi) - 1)
+        found = (self.sorted_hi[positions] == keys[:, 0]) & (self.sorted_lo[positions] == keys[:, 1])
+        return np.where(found, self.rows[positions], -1)
+
+
+def _shard_fingerprint(hash_path):
+    stat = os.stat(hash_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def list_hash_files(folder):
+    """
+    資料夾中已完成 (有 .embed.npy 與 .done 標記) 的分片雜湊檔名，依檔名排序。
+    沒有 .done 的分片 (中斷的編碼) 之後會被重新編碼改寫，所以不納入。
+    """
+    if not os.path.isdir(folder):
+        return []
+    filenames = set(os.listdir(folder))
+    return sorted(
+        filename for filename in filenames
+        if filename.endswith(HASH_SUFFIX) and filename[:-len(HASH_SUFFIX)] + '.embed.npy' in filenames
+        and filename[:-len(HASH_SUFFIX)] + '.done' in filenames
+    )
+
+
+def read_index_manifest(folder):
+    path = os.path.join(folder, INDEX_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+@contextmanager
+def _index_lock(folder, blocking=True):
+    # 唯讀的資料夾 (例如沿用的舊暫存資料夾) 無法建立鎖檔，視為拿不到鎖
+    try:
+        f = open(os.path.join(folder, INDEX_LOCK), 'w')
+    except OSError:
+        yield False
+        return
+    with f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _stale_shards(folder, manifest):
+    """
+    索引中檔案已被改寫 (重新編碼) 或刪除的分片編號。
+    """
+    stale = []
+    for shard, (filename, size, mtime_ns) in enumerate(manifest['shards']):
+        path = os.path.join(folder, filename)
+        if not os.path.exists(path) or _shard_fingerprint(path) != [size, mtime_ns]:
+            stale.append(shard)
+    return stale
+
+
+def update_hash_index(folder, blocking=True):
+    """
+    把資料夾中還沒納入的分片雜湊合併進排序好的索引 (hash_index.<generation>.hi.npy 與 .meta.npy)。
+    索引以 mmap 開啟，所有工作行程共用同一份頁面快取，不必各自把每個分片的雜湊載入記憶體，
+    查詢也只需要一次二分搜尋而不是逐一檢查分片。舊索引已排序，與新分片逐段合併後寫成新的一代，
+    再替換清單 (hash_index.json)；有分片被改寫時整個重建。回傳是否有更新。
+    """
+    with _index_lock(folder, blocking) as acquired:
+        if not acquired:
+            return False
+        old = read_index_manifest(folder)
+        manifest = old
+        if manifest is not None and _stale_shards(folder, manifest):
+            # 重建時不沿用舊的內容，但一代仍要往上加：舊檔可能還被其他工作行程 mmap，不能就地覆寫
+            manifest = None
+        manifest = manifest or {'generation': 0, 'prefix': None, 'shards': []}
+        covered = {filename for filename, _, _ in manifest['shards']}
+        new_files = [filename for filename in list_hash_files(folder) if filename not in covered]
+        if not new_files:
+            return False
+
+        keys, shard_ids, rows = [], [], []
+        for shard, filename in enumerate(new_files, len(manifest['shards'])):
+            shard_keys = np.load(os.path.join(folder, filename))
+            keys.append(shard_keys)
+            shard_ids.append(np.full(len(shard_keys), shard, dtype=np.uint32))
+            rows.append(np.arange(len(shard_keys), dtype=np.uint32))
+        keys = np.concatenate(keys)
+        order = np.argsort(keys[:, 0], kind='stable')
+        new_hi = keys[order, 0]
+        new_meta = np.empty(len(order), dtype=INDEX_META_DTYPE)
+        new_meta['lo'] = keys[order, 1]
+        new_meta['shard'] = np.concatenate(shard_ids)[order]
+        new_meta['row'] = np.concatenate(rows)[order]
+        del keys, shard_ids, rows
+
+        if manifest['prefix']:
+            old_hi = np.load(os.path.join(folder, f"{manifest['prefix']}.hi.npy"), mmap_mode='r')
+            old_meta = np.load(os.path.join(folder, f"{manifest['prefix']}.meta.npy"), mmap_mode='r')
+        else:
+            old_hi, old_meta = np.empty(0, dtype=np.uint64), np.empty(0, dtype=INDEX_META_DTYPE)
+
+        generation = (old['generation'] if old else 0) + 1
+        prefix = f"hash_index.{generation}"
+        total = len(old_hi) + len(new_hi)
+        out_hi = np.lib.format.open_memmap(os.path.join(folder, f"{prefix}.hi.npy"), mode='w+',
+                                           dtype=np.uint64, shape=(total,))
+        out_meta = np.lib.format.open_memmap(os.path.join(folder, f"{prefix}.meta.npy"), mode='w+',
+                                             dtype=INDEX_META_DTYPE, shape=(total,))
+        # 相同的 hi 時舊索引排在前面：新項目的位置 = 舊索引中 <= 它的個數 + 自己的序號，舊項目反之
+        new_positions = np.searchsorted(old_hi, new_hi, side='right') + np.arange(len(new_hi))
+        out_hi[new_positions] = new_hi
+        out_meta[new_positions] = new_meta
+        for start in range(0, len(old_hi), MERGE_CHUNK):
+            chunk_hi = np.asarray(old_hi[start:start + MERGE_CHUNK])
+            positions = np.arange(start, start + len(chunk_hi)) + np.searchsorted(new_hi, chunk_hi, side='left')
+            out_hi[positions] = chunk_hi
+            out_meta[positions] = old_meta[start:start + len(chunk_hi)]
+        out_hi.flush()
+        out_meta.flush()
+        del out_hi, out_meta, old_hi, old_meta
+
+        shards = manifest['shards'] + [
+            [filename, *_shard_fingerprint(os.path.join(folder, filename))] for filename in new_files
+        ]
+        tmp_path = os.path.join(folder, f"{INDEX_FILE}.tmp{os.getpid()}")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'generation': generation, 'prefix': prefix, 'rows': total, 'shards': shards}, f)
+        os.replace(tmp_path, os.path.join(folder, INDEX_FILE))
+        if old and old['prefix']:
+            # 已 mmap 舊索引的行程不受影響 (刪除只移除目錄項目)，下一次 refresh 就會改用新的一代
+            for suffix in ('.hi.npy', '.meta.npy'):
+                path = os.path.join(folder, f"{old['prefix']}{suffix}")
+                if os.path.exists(path):
+                    os.remove(path)
+    return True
+
+
+class _HashIndex:
+    """
+    一個資料夾的雜湊索引 (update_hash_index 寫出)：依雜湊高 64 位元排序，唯讀 mmap。
+    """
+    def __init__(self, folder, manifest):
+        self.folder = folder
+        self.generation = manifest['generation']
+        self.hi = np.load(os.path.join(folder, f"{manifest['prefix']}.hi.npy"), mmap_mode='r')
+        self.meta = np.load(os.path.join(folder, f"{manifest['prefix']}.meta.npy"), mmap_mode='r')
+        self.filenames = [filename for filename, _, _ in manifest['shards']]
+        self.valid = np.ones(len(self.filenames), dtype=bool)
+        self.valid[_stale_shards(folder, manifest)] = False
+        self._embeddings = {}
+
+    @classmethod
+    def open(cls, folder):
+        """
+        開啟資料夾目前的索引，沒有索引時回傳 None。
+        """
+        for _ in range(3):
+            manifest = read_index_manifest(folder)
+            if manifest is None:
+                return None
+            try:
+                return cls(folder, manifest)
+            except FileNotFoundError:
+                continue  # 讀取途中被新的一代取代，重讀清單
+        return None
+
+    @property
+    def covered(self):
+        """
+        由索引提供的分片檔名 (不含已被改寫的)。
+        """
+        return {filename for filename, valid in zip(self.filenames, self.valid) if valid}
+
+    def embeddings(self, shard):
+        if shard not in self._embeddings:
+            embed_path = os.path.join(self.folder, self.filenames[shard][:-len(HASH_SUFFIX)] + '.embed.npy')
+            self._embeddings[shard] = np.load(embed_path, mmap_mode='r')
+        return self._embeddings[shard]
+
+    def lookup(self, keys):
+        """
+        回傳 (分片編號, 列號)，找不到為 -1。
+        """
+        shards = np.full(len(keys), -1, dtype=np.int64)
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        if not len(self.hi) or not len(keys):
+            return shards, rows
+        positions = np.minimum(np.searchsorted(self.hi, keys[:, 0]), len(self.hi) - 1)
+        meta = self.meta[positions]
+        found = (np.asarray(self.hi[positions]) == keys[:, 0]) & (meta['lo'] == keys[:, 1])
+        found &= self.valid[meta['shard']]
+        shards[found] = meta['shard'][found]
+        rows[found] = meta['row'][found]
+        return shards, rows
+
+
+class SegmentEmbeddingCache:
+    """
+    以段落文本的內容雜湊去除重複編碼。
+
+    每個暫存分片在 .embed.npy 旁多寫一個 .hash.npy (每列文本的雜湊)，暫存資料夾本身就是快取，
+    不另外複製一份嵌入。各資料夾的雜湊合併成一個排序好、以 mmap 共用的索引 (update_hash_index)；
+    之後每處理一個檔案前呼叫 refresh() 納入新完成的分片 (包含其他工作行程寫出的)，
+    還沒合併的分片累積夠多時再併入索引。同一個檔案內已編碼但還沒寫出的文本則暫存在記憶體中。
+    plan() 在 tokenize 執行緒、fill() 在模型執行緒呼叫，共用的狀態都以鎖保護。
+    """
+    def __init__(self, folders, model_key):
+        self.folders = []
+        self.model_key = model_key
+        self.indexes = {}
+        self.shards = {}
+        self.pending = {}
+        self.in_flight = set()
+        self.file_keys = []
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        for folder in folders:
+            self._add_folder(folder)
+        self.refresh()
+
+    def _add_folder(self, folder):
+        encoder_path = os.path.join(folder, ENCODER_FILE)
+        if os.path.exists(encoder_path):
+            with open(encoder_path, 'r', encoding='utf-8') as f:
+                if json.load(f).get('model_key') != self.model_key:
+                    print(f"Skipping embedding reuse from '{folder}': it was encoded with a different model")
+                    return
+        self.folders.append(folder)
+
+    @staticmethod
+    def mark_folder(folder, model_name, model_key):
+        """
+        在暫存資料夾記錄所用的模型，之後的執行才能確認可以沿用其中的嵌入。
+        """
+        encoder_path = os.path.join(folder, ENCODER_FILE)
+        if not os.path.exists(encoder_path):
+            with open(encoder_path, 'w', encoding='utf-8') as f:
+                json.dump({'model_name': model_name, 'model_key': model_key}, f, indent=2)
+
+    def _refresh_folder(self, folder, merge=True):
+        """
+        重新開啟資料夾的索引 (有新的一代時)，並把還沒併入索引的分片載入記憶體；累積夠多時合併。
+        """
+        manifest = read_index_manifest(folder)
+        index = self.indexes.get(folder)
+        if manifest is not None and (index is None or index.generation != manifest['generation']):
+            index = self.indexes[folder] = _HashIndex.open(folder)
+        hash_files = list_hash_files(folder)
+        if index is not None:
+            # 失去 .done 標記的分片 (等待重新編碼) 不再由索引提供
+            eligible = set(hash_files)
+            index.valid &= np.array([filename in eligible for filename in index.filenames], dtype=bool)
+        covered = index.covered if index is not None else set()
+        tail_rows = 0
+        for filename in hash_files:
+            hash_path = os.path.join(folder, filename)
+            if filename in covered:
+                self.shards.pop(hash_path, None)
+                continue
+            if hash_path not in self.shards:
+                self.shards[hash_path] = _Shard(hash_path, hash_path[:-len(HASH_SUFFIX)] + '.embed.npy')
+            tail_rows += len(self.shards[hash_path])
+        index_rows = len(index.hi) if index is not None else 0
+        if merge and tail_rows > max(MERGE_MIN_ROWS, index_rows // MERGE_RATIO):
+            # 只有一個行程會拿到鎖進行合併，其他行程下一次 refresh 時改用新的索引
+            if update_hash_index(folder, blocking=False):
+                self._refresh_folder(folder, merge=False)
+
+    def refresh(self):
+        with self.lock:
+            for folder in self.folders:
+                self._refresh_folder(folder)
+            # 已寫出的分片會被上面載入，記憶體中的暫存可以清掉
+            self.pending = {}
+            self.in_flight = set()
+            self.file_keys = []
+
+    def _fetch(self, keys):
+        """
+        回傳 (found_mask, vectors)：vectors 只包含找到的鍵，依 keys 中的順序排列。呼叫端需持有鎖。
+        """
+        vectors = [None] * len(keys)
+        remaining = np.arange(len(keys))
+        for index in self.indexes.values():
+            if index is None or not len(remaining):
+                continue
+            shards, rows = index.lookup(keys[remaining])
+            hit = shards >= 0
+            for shard in np.unique(shards[hit]).tolist():
+                selected = np.flatnonzero(shards == shard)
+                # 依列號排序後再讀取，讓 mmap 的存取較連續
+                selected = selected[np.argsort(rows[selected], kind='stable')]
+                shard_vectors = np.asarray(index.embeddings(shard)[rows[selected]], dtype=np.float32)
+                for position, vector in zip(remaining[selected], shard_vectors):
+                    vectors[position] = vector
+            remaining = remaining[~hit]
+        for shard in self.shards.values():
+            if not len(remaining):
+                break
+            rows = shard.lookup(keys[remaining])
+            hit = rows >= 0
+            if hit.any():
+                hit_rows = rows[hit]
+                order = np.argsort(hit_rows, kind='stable')
+                shard_vectors = np.asarray(shard.embeddings[hit_rows[order]], dtype=np.float32)
+                for index, vector in zip(remaining[hit][order], shard_vectors):
+                    vectors[index] = vector
+            remaining = remaining[~hit]
+        for index in remaining:
+            vectors[index] = self.pending.get(keys[index].tobytes())
+        found = np.array([vector is not None for vector in vectors], dtype=bool)
+        return found, [vector for vector in vectors if vector is not None]
+
+    def plan(self, contents):
+        """
+        計算一個視窗的內容雜湊並查快取，回傳 WindowPlan。
+        前面的視窗已規劃編碼、但還沒 fill 的文本不會再編碼一次 (見 WindowPlan.deferred_positions)。
+        """
+        keys = hash_contents(contents)
+        with self.lock:
+            found, vectors = self._fetch(keys)
+            miss_positions, copy_to, copy_from, deferred_positions = [], [], [], []
+            first_seen = {}
+            for position in np.flatnonzero(~found).tolist():
+                key = keys[position].tobytes()
+                if key in first_seen:
+                    copy_to.append(position)
+                    copy_from.append(first_seen[key])
+                elif key in self.in_flight:
+                    deferred_positions.append(position)
+                else:
+                    first_seen[key] = position
+                    miss_positions.append(position)
+            self.in_flight.update(first_seen)
+            hit_positions = np.flatnonzero(found)
+            self.hits += len(hit_positions) + len(copy_to) + len(deferred_positions)
+            self.misses += len(miss_positions)
+        return WindowPlan(
+            keys, np.array(miss_positions, dtype=np.int64), hit_positions,
+            np.stack(vectors) if vectors else None,
+            np.array(copy_to, dtype=np.int64), np.array(copy_from, dtype=np.int64),
+            np.array(deferred_positions, dtype=np.int64)
+        )
+
+    def fill(self, plan, miss_embeddings):
+        """
+        把沿用的嵌入與新編碼的嵌入 (依 plan.miss_positions 的順序) 組回整個視窗，回傳 torch.Tensor。
+        新的嵌入同時記在記憶體中，供同一檔案後續的視窗使用；各視窗的雜湊依序累積，由 take_keys() 取出。
+        視窗必須依 plan() 的順序 fill，deferred 的文本才已經由前面的視窗編碼完成。
+        """
+        with self.lock:
+            self.file_keys.append(plan.keys)
+            deferred_vectors = None
+            if len(plan.deferred_positions):
+                deferred_vectors = np.stack([self.pending[plan.keys[position].tobytes()]
+                                             for position in plan.deferred_positions.tolist()])
+            if miss_embeddings is not None:
+                dim = miss_embeddings.shape[1]
+            else:
+                dim = (plan.hit_vectors if plan.hit_vectors is not None else deferred_vectors).shape[1]
+            embeddings = torch.empty((len(plan), dim), dtype=torch.float32)
+            if len(plan.hit_positions):
+                embeddings[torch.from_numpy(plan.hit_positions)] = torch.from_numpy(plan.hit_vectors)
+            if deferred_vectors is not None:
+                embeddings[torch.from_numpy(plan.deferred_positions)] = torch.from_numpy(deferred_vectors)
+            if len(plan.miss_positions):
+                embeddings[torch.from_numpy(plan.miss_positions)] = miss_embeddings
+                for position, vector in zip(plan.miss_positions.tolist(), miss_embeddings.numpy()):
+                    key = plan.keys[position].tobytes()
+                    self.pending[key] = vector
+                    self.in_flight.discard(key)
+            if len(plan.copy_to):
+                embeddings[torch.from_numpy(plan.copy_to)] = embeddings[torch.from_numpy(plan.copy_from)]
+        return embeddings
+
+    def take_keys(self):
+        """
+        取出目前檔案已完成視窗的雜湊 (依列順序)，寫成分片的 .hash.npy。
+        """
+        with self.lock:
+            keys = np.concatenate(self.file_keys) if self.file_keys else np.empty((0, 2), dtype=np.uint64)
+            self.file_keys = []
+        return keys
+
+    def encode_window(self, contents, encode):
+        """
+        只把快取中沒有的文本交給 encode(contents) 編碼，回傳整個視窗的嵌入。
+        """
+        plan = self.plan(contents)
+        miss_embeddings = None
+        if len(plan.miss_positions):
+            miss_embeddings = encode([contents[i] for i in plan.miss_positions.tolist()])
+        return self.fill(plan, miss_embeddings)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': round(self.hit_rate, 4)}
+
+    def __str__(self):
+        return (f"dedup    {self.hits + self.misses:>10} segments  {self.hits:>10} reused  "
+                f"hit rate {self.hit_rate:6.1%}")
@@ -0,0 +1,252 @@
+import os
+import gzip
+import json
+import time
+import zlib
+import shutil
+import argparse
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+from tqdm import tqdm
+
+from doc_ids import DocIdTable, DocIdTableWriter
+
+BLOCK_SIZE = 64 * 1024
+# 每列的位置：所在區塊、區塊內位移、長度
+INDEX_COLUMNS = ('block', 'offset', 'length')
+
+
+def list_corpus_files(corpus_folder):
+    """
+    與 run_dense_retrieval.py 相同的檔案順序 (排序後的完整路徑)。
+    """
+    return sorted(
+        os.path.join(dirpath, filename)
+        for dirpath, _, filenames in os.walk(corpus_folder)
+        for filename in filenames if filename.endswith('.json.gz')
+    )
+
+
+def _write_part(task):
+    """
+    把一個處理好的語料檔寫成獨立壓縮的區塊 (每塊約 block_size 位元組未壓縮)。
+    每個段落存原本的 JSON 行；回傳本檔的暫存輸出路徑與段落數。
+    """
+    filepath, part_path, block_size, level = task
+    index = []
+    block_sizes = []
+    block = bytearray()
+    with gzip.open(filepath, 'rb') as f_in, open(f"{part_path}.blocks", 'wb') as f_blocks, \
+            open(f"{part_path}.ids.txt", 'w', encoding='utf-8') as f_ids:
+        for line in f_in:
+            line = line.rstrip(b'\n')
+            if not line:
+                continue
+            doc_id = json.loads(line)['id']
+            if block and len(block) + len(line) > block_size:
+                compressed = zlib.compress(bytes(block), level)
+                f_blocks.write(compressed)
+                block_sizes.append(len(compressed))
+                block = bytearray()
+            index.append((len(block_sizes), len(block), len(line)))
+            block.extend(line)
+            f_ids.write(doc_id + '\n')
+        if block:
+            compressed = zlib.compress(bytes(block), level)
+            f_blocks.write(compressed)
+            block_sizes.append(len(compressed))
+    np.save(f"{part_path}.index.npy", np.array(index, dtype=np.uint32).reshape(-1, 3))
+    np.save(f"{part_path}.block_sizes.npy", np.array(block_sizes, dtype=np.uint64))
+    return part_path, len(index)
+
+
+def build_segment_store(corpus_folder, output_path, block_size=BLOCK_SIZE, level=6, num_processes=None):
+    """
+    從處理好的語料 (data/corpus/processed) 建立區塊壓縮的段落庫：
+      blocks.bin         各區塊獨立以 zlib 壓縮後串接
+      block_offsets.npy  每個區塊在 blocks.bin 的起點 (多一個結尾)
+      block/offset/length.npy  每列段落所在的區塊與區塊內位置
+      ids/               docid → 列號 的 doc-ID 表 (見 doc_ids.py)
+    各檔案平行壓縮，最後依檔案順序串接。
+    """
+    files = list_corpus_files(corpus_folder)
+    if not files:
+        raise FileNotFoundError(f"No .json.gz files found in '{corpus_folder}'")
+    os.makedirs(output_path, exist_ok=True)
+    tmp_folder = os.path.join(output_path, 'tmp')
+    os.makedirs(tmp_folder, exist_ok=True)
+
+    tasks = [
+        (filepath, os.path.join(tmp_folder, f"{i:05d}"), block_size, level) for i, filepath in enumerate(files)
+    ]
+    with Pool(num_processes or cpu_count()) as pool:
+        parts = list(tqdm(pool.imap(_write_part, tasks), total=len(tasks), desc="Compressing blocks"))
+
+    total_rows = sum(count for _, count in parts)
+    columns = {
+        name: np.lib.format.open_memmap(os.path.join(output_path, f"{name}.npy"), mode='w+', dtype=np.uint32, shape=(total_rows,))
+        for name in INDEX_COLUMNS
+    }
+    ids_writer = DocIdTableWriter(os.path.join(output_path, 'ids'), total_rows)
+    block_offsets = [np.zeros(1, dtype=np.uint64)]
+    row, num_blocks, byte_offset = 0, 0, 0
+    with open(os.path.join(output_path, 'blocks.bin'), 'wb') as f_blocks:
+        for part_path, count in tqdm(parts, desc="Concatenating"):
+            with open(f"{part_path}.blocks", 'rb') as f_part:
+                shutil.copyfileobj(f_part, f_blocks, 16 * 2 ** 20)
+            index = np.load(f"{part_path}.index.npy")
+            block_sizes = np.load(f"{part_path}.block_sizes.npy")
+            columns['block'][row:row + count] = index[:, 0] + num_blocks
+            columns['offset'][row:row + count] = index[:, 1]
+            columns['length'][row:row + count] = index[:, 2]
+            block_offsets.append(byte_offset + np.cumsum(block_sizes, dtype=np.uint64))
+            with open(f"{part_path}.ids.txt", 'r', encoding='utf-8') as f_ids:
+                ids_writer.append(f_ids.read().splitlines())
+            row += count
+            num_blocks += len(block_sizes)
+            byte_offset += int(block_sizes.sum())
+    ids_writer.close()
+    for column in columns.values():
+        column.flush()
+    np.save(os.path.join(output_path, 'block_offsets.npy'), np.concatenate(block_offsets))
+    with open(os.path.join(output_path, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump({'count': total_rows, 'blocks': num_blocks, 'block_size': block_size, 'codec': 'zlib'}, f, indent=2)
+    shutil.rmtree(tmp_folder)
+    print(f"Segment store with {total_rows} segments in {num_blocks} blocks written to '{output_path}'")
+    return output_path
+
+
+class SegmentStore:
+    """
+    依 docid 或列號隨機讀取段落。只解壓縮需要的區塊，並以 LRU 快取最近用過的區塊；
+    一次讀取多筆時先依區塊排序，同一區塊只解壓縮一次。
+    """
+    def __init__(self, path, cache_blocks=4096):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.block_offsets = np.load(os.path.join(path, 'block_offsets.npy'))
+        self.columns = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r') for name in INDEX_COLUMNS}
+        self.ids = DocIdTable.load(os.path.join(path, 'ids'))
+        self.blocks = open(os.path.join(path, 'blocks.bin'), 'rb')
+        self.cache_blocks = cache_blocks
+        self.cache = OrderedDict()
+
+    def __len__(self):
+        return self.meta['count']
+
+    def close(self):
+        self.blocks.close()
+
+    def read_block(self, block):
+        data = self.cache.get(block)
+        if data is not None:
+            self.cache.move_to_end(block)
+            return data
+        start, end = int(self.block_offsets[block]), int(self.block_offsets[block + 1])
+        data = zlib.decompress(os.pread(self.blocks.fileno(), end - start, start))
+        self.cache[block] = data
+        if len(self.cache) > self.cache_blocks:
+            self.cache.popitem(last=False)
+        return data
+
+    def get_raw(self, rows):
+        """
+        回傳各列段落的原始 JSON (bytes)；列號為 -1 的位置回傳 None。
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        results = [None] * len(rows)
+        valid = np.flatnonzero(rows >= 0)
+        if not len(valid):
+            return results
+        blocks = np.asarray(self.columns['block'][rows[valid]])
+        offsets = np.asarray(self.columns['offset'][rows[valid]])
+        lengths = np.asarray(self.columns['length'][rows[valid]])
+        for i in np.argsort(blocks, kind='stable'):
+            data = self.read_block(int(blocks[i]))
+            results[valid[i]] = data[offsets[i]:offsets[i] + lengths[i]]
+        return results
+
+    def get_rows(self, rows):
+        """
+        回傳各列段落的 dict (id, contents, title, headings, url)；列號為 -1 的位置回傳 None。
+        """
+        return [None if raw is None else json.loads(raw) for raw in self.get_raw(rows)]
+
+    def get(self, doc_ids):
+        """
+        依 docid 取出段落，找不到的回傳 None。
+        """
+        return self.get_rows(self.ids.lookup(doc_ids))
+
+    def __getitem__(self, doc_id):
+        return self.get([doc_id])[0]
+
+
+def hydrate_run(store, run_path, output_path, depth=None):
+    """
+    讀取 TREC run，為每個 (query_id, docid) 取出段落內容，寫成 JSON lines。
+    所有主題的 docid 一次查表、依區塊排序讀取。
+    """
+    entries = []
+    with open(run_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) != 6 or (depth and int(parts[3]) > depth):
+                continue
+            entries.append((parts[0], parts[2], int(parts[3]), float(parts[4])))
+    segments = store.get([doc_id for _, doc_id, _, _ in entries])
+    missing = 0
+    with open(output_path, 'w', encoding='utf-8') as f:
+        for (query_id, doc_id, rank, score), segment in zip(entries, segments):
+            if segment is None:
+                missing += 1
+                continue
+            f.write(json.dumps({'qid': query_id, 'docid': doc_id, 'rank': rank, 'score': score, **segment},
+                               ensure_ascii=False) + '\n')
+    return len(entries), missing
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Block-compressed random-access store of corpus segments')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build = subparsers.add_parser('build', help='Build the store from the processed corpus')
+    build.add_argument('--corpus-folder', default='data/corpus/processed/')
+    build.add_argument('--output', default='data/corpus/segment_store')
+    build.add_argument('--block-size', type=int, default=BLOCK_SIZE)
+    build.add_argument('--level', type=int, default=6)
+    build.add_argument('--num-processes', type=int, default=None)
+
+    get = subparsers.add_parser('get', help='Print segments by docid')
+    get.add_argument('--store', default='data/corpus/segment_store')
+    get.add_argument('doc_ids', nargs='+')
+
+    hydrate = subparsers.add_parser('hydrate', help='Attach segment text to every hit of a TREC run')
+    hydrate.add_argument('--store', default='data/corpus/segment_store')
+    hydrate.add_argument('--run', required=True)
+    hydrate.add_argument('--output', required=True)
+    hydrate.add_argument('--depth', type=int, default=None, help='Only hydrate the top-N hits per topic')
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        build_segment_store(args.corpus_folder, args.output, args.block_size, args.level, args.num_processes)
+        return
+
+    store = SegmentStore(args.store)
+    if args.command == 'get':
+        for doc_id, segment in zip(args.doc_ids, store.get(args.doc_ids)):
+            print(json.dumps(segment, ensure_ascii=False) if segment is not None else f"{doc_id}: not found")
+    else:
+        start = time.time()
+        total, missing = hydrate_run(store, args.run, args.output, args.depth)
+        elapsed = time.time() - start
+        print(f"Hydrated {total - missing}/{total} hits in {elapsed:.1f}s "
+              f"({total / max(elapsed, 1e-9):.0f} segments/s) -> '{args.output}'")
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
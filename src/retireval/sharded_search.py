@@ -0,0 +1,396 @@
+import os
+import json
+import socket
+import ipaddress
+import shutil
+import argparse
+import multiprocessing as mp
+from multiprocessing.connection import AuthenticationError, Client, Listener
+
+import numpy as np
+from tqdm import tqdm
+
+from quantization import load_quant_params, quant_params_path
+from run_dense_retrieval import list_temp_shards, read_npy_header
+
+MANIFEST_SUFFIX = '.shards.json'
+# 多節點部署時 coordinator 與 shard server 之間的連線驗證金鑰 (multiprocessing.connection 的 HMAC 驗證)
+AUTHKEY_ENV = 'SHARD_AUTHKEY'
+
+
+def file_boundaries(temp_output_folder):
+    """
+    依 merge_temp_files 的合併順序，回傳各暫存檔在合併後矩陣中的結束列號 (累積列數)。
+    """
+    return np.cumsum([read_npy_header(embed_path)[0][0] for _, embed_path in list_temp_shards(temp_output_folder)])
+
+
+def plan_shards(num_rows, num_shards, boundaries=None):
+    """
+    把 [0, num_rows) 切成 num_shards 個連續列區間 [(start, end), ...]，各區間列數盡量相等。
+    給定 boundaries (例如 file_boundaries 的結果) 時只在這些列號切開，每個分片都由完整的輸入檔組成。
+    """
+    if boundaries is None:
+        cuts = [round(num_rows * i / num_shards) for i in range(1, num_shards)]
+    else:
+        boundaries = np.asarray(boundaries)
+        if len(boundaries) < num_shards:
+            raise ValueError(f"Cannot split {len(boundaries)} files into {num_shards} shards")
+        cuts, lowest = [], 0
+        for i in range(1, num_shards):
+            # 在前一個切點之後、且後面每個分片至少留一個檔案的範圍內，取最接近理想切點的檔案邊界
+            highest = len(boundaries) - (num_shards - i)
+            position = lowest + int(np.abs(boundaries[lowest:highest] - num_rows * i / num_shards).argmin())
+            cuts.append(int(boundaries[position]))
+            lowest = position + 1
+    edges = [0, *cuts, num_rows]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def write_manifest(manifest_path, manifest):
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def load_manifest(manifest_path):
+    """
+    讀取分片清單，相對路徑以清單所在資料夾為準。
+    """
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    folder = os.path.dirname(os.path.abspath(manifest_path))
+    for shard in manifest['shards']:
+        shard['path'] = os.path.join(folder, shard['path'])
+    manifest['ids_path'] = os.path.join(folder, manifest['ids_path'])
+    return manifest
+
+
+def partition_index(embeddings_path, ids_path, output_folder, num_shards, temp_output_folder=None, copy=True,
+                    copy_rows=1 << 20):
+    """
+    把 merge_temp_files 產生的語料嵌入切成 num_shards 個列區間並寫出分片清單 <output_folder>/index.shards.json。
+    copy=True 時每個分片複製成獨立的 .npy (int8 另複製量化參數，所有分片共用同一組全域參數，分數可直接比較)，
+    可分送到不同機器；copy=False 時分片只是同一個檔案上的列區間，適合單機多行程。
+    分片回傳的是全域列號，doc-ID 表不需切分，由 coordinator 統一查詢。
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    embeddings = np.load(embeddings_path, mmap_mode='r')
+    boundaries = file_boundaries(temp_output_folder) if temp_output_folder else None
+    if boundaries is not None and boundaries[-1] != len(embeddings):
+        raise ValueError(f"'{temp_output_folder}' has {boundaries[-1]} rows but '{embeddings_path}' has {len(embeddings)}")
+    ranges = plan_shards(len(embeddings), num_shards, boundaries)
+
+    shards = []
+    for shard_id, (start, end) in enumerate(ranges):
+        if not copy:
+            shards.append({'path': os.path.relpath(os.path.abspath(embeddings_path), output_folder),
+                           'start': start, 'end': end, 'scan': [start, end]})
+            continue
+        shard_path = os.path.join(output_folder, f"shard_{shard_id:04d}.npy")
+        output = np.lib.format.open_memmap(shard_path, mode='w+', dtype=embeddings.dtype, shape=(end - start, embeddings.shape[1]))
+        for chunk_start in tqdm(range(start, end, copy_rows), desc=f"Shard {shard_id}", leave=False):
+            chunk_end = min(chunk_start + copy_rows, end)
+            output[chunk_start - start:chunk_end - start] = embeddings[chunk_start:chunk_end]
+        output.flush()
+        del output
+        if load_quant_params(embeddings_path) is not None:
+            shutil.copyfile(quant_params_path(embeddings_path), quant_params_path(shard_path))
+        shards.append({'path': os.path.basename(shard_path), 'start': start, 'end': end})
+        print(f"Shard {shard_id}: rows [{start}, {end}) -> '{shard_path}'")
+
+    manifest_path = os.path.join(output_folder, f"index{MANIFEST_SUFFIX}")
+    write_manifest(manifest_path, {
+        'source': os.path.abspath(embeddings_path),
+        'ids_path': os.path.relpath(os.path.abspath(ids_path), output_folder),
+        'num_rows': int(len(embeddings)), 'dim': int(embeddings.shape[1]), 'dtype': str(embeddings.dtype),
+        'shards': shards,
+    })
+    print(f"Wrote {len(shards)} shards to '{manifest_path}'")
+    return manifest_path
+
+
+def merge_shard_results(results, k):
+    """
+    k-way 合併各分片的 top-k：results 為 [(scores[Q, k_i], rows[Q, k_i]), ...] (rows 已是全域列號)，
+    回傳整體的 (scores[Q, k], rows[Q, k])；列號為 -1 的空位不參與排序。
+    """
+    scores = np.concatenate([np.where(rows >= 0, scores, -np.inf) for scores, rows in results], axis=1)
+    rows = np.concatenate([rows for _, rows in results], axis=1)
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return scores, rows
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    top = np.take_along_axis(top, order, axis=1)
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    top_rows = np.take_along_axis(rows, top, axis=1)
+    top_rows[~np.isfinite(top_scores)] = -1
+    return top_scores.astype(np.float32), top_rows
+
+
+class ShardSearcher:
+    """
+    單一分片：加載分片索引 (FlatIndex 或 faiss 索引)，只掃描自己的列區間，回傳全域列號。
+    """
+    def __init__(self, shard, block_size=131072, nprobe=None, ef_search=None, threads=None):
+        import torch
+        from hybrid_search import load_dense_index
+
+        if threads:
+            torch.set_num_threads(threads)
+        self.index = load_dense_index(shard['path'], block_size=block_size, nprobe=nprobe, ef_search=ef_search)
+        self.scan = shard.get('scan')
+        # 獨立的分片檔從第 0 列開始，加上 start 才是全域列號；列區間分片本來就回傳全域列號
+        self.offset = 0 if self.scan else shard['start']
+
+    def search(self, query_embeddings, k):
+        if self.scan:
+            scores, rows = self.index.search(query_embeddings, k, start_row=self.scan[0], end_row=self.scan[1])
+        else:
+            scores, rows = self.index.search(query_embeddings, k)
+        rows = np.where(rows >= 0, rows + self.offset, -1)
+        return scores, rows
+
+    def serve(self, connection):
+        """
+        處理 coordinator 的請求直到收到 None 或連線中斷：請求為 (query_embeddings, k)，回覆 ('ok', (scores, rows))。
+        """
+        while True:
+            try:
+                request = connection.recv()
+            except EOFError:
+                return
+            if request is None:
+                return
+            try:
+                connection.send(('ok', self.search(*request)))
+            except Exception as e:
+                connection.send(('error', f"{type(e).__name__}: {e}"))
+
+
+def _local_worker(connection, shard, block_size, nprobe, ef_search, threads):
+    try:
+        searcher = ShardSearcher(shard, block_size, nprobe, ef_search, threads)
+    except Exception as e:
+        connection.send(('error', f"{type(e).__name__}: {e}"))
+        return
+    connection.send(('ok', None))
+    searcher.serve(connection)
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def get_authkey(authkey=None):
+    """
+    TCP 分片連線的共用密鑰：Listener 會 unpickle 收到的資料，沒有密鑰就等於讓任何連得到的人執行程式碼，所以不提供預設值。
+    """
+    authkey = authkey or os.environ.get(AUTHKEY_ENV)
+    if not authkey:
+        raise ValueError(f"No shard authkey given; pass --authkey or set ${AUTHKEY_ENV}")
+    return authkey.encode('utf-8')
+
+
+def is_loopback(host):
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+def serve_shard(manifest_path, shard_id, address, authkey=None, block_size=131072, nprobe=None, ef_search=None,
+                threads=None, allow_remote=False):
+    """
+    在本機 (或遠端節點) 以 TCP 提供單一分片的搜尋，一次服務一個 coordinator 連線，斷線後等待下一個。
+    必須給定密鑰；預設只接受 loopback 位址，allow_remote=True 才會在其他介面上監聽。
+    """
+    host, port = parse_address(address)
+    key = get_authkey(authkey)
+    if not allow_remote and not is_loopback(host):
+        raise ValueError(f"Refusing to listen on non-loopback address '{address}' without --allow-remote")
+    shard = load_manifest(manifest_path)['shards'][shard_id]
+    searcher = ShardSearcher(shard, block_size, nprobe, ef_search, threads)
+    with Listener((host, port), authkey=key) as listener:
+        print(f"Serving shard {shard_id} (rows [{shard['start']}, {shard['end']})) on {address}")
+        while True:
+            try:
+                connection = listener.accept()
+            except (AuthenticationError, EOFError, OSError) as e:
+                # 密鑰錯誤或握手中斷的連線直接丟棄，繼續等待下一個 coordinator
+                print(f"Rejected connection: {type(e).__name__}: {e}")
+                continue
+            with connection:
+                print(f"Coordinator connected from {listener.last_accepted}")
+                searcher.serve(connection)
+
+
+class ShardedIndex:
+    """
+    scatter-gather 稠密搜尋：把一批查詢廣播給所有分片 (本機工作行程或遠端 shard server)，
+    各分片同時計算自己的 top-k，再由 coordinator 做 k-way 合併。
+    介面與 FlatIndex / AnnIndex 相同 (search 回傳全域列號)，可直接交給 DenseRetriever / search_topics 使用；
+    每個工作行程只掃描 (或 mmap) 自己的列區間，記憶體與計算量隨分片數分散。
+    """
+    def __init__(self, connections, manifest, processes=()):
+        self.connections = connections
+        self.manifest = manifest
+        self.processes = list(processes)
+        self.meta = {'ids_path': manifest['ids_path']}
+
+    @classmethod
+    def launch(cls, manifest_path, block_size=131072, nprobe=None, ef_search=None, threads_per_shard=None):
+        """
+        每個分片啟動一個本機工作行程 (spawn)，以 Pipe 傳遞查詢與結果 (匿名 socketpair，不開放任何位址)。
+        spawn 的子行程繼承 multiprocessing 以 os.urandom 產生的行程密鑰，這裡明確重設一次確保不是固定值。
+        """
+        manifest = load_manifest(manifest_path)
+        if not threads_per_shard:
+            threads_per_shard = max(1, (os.cpu_count() or 1) // len(manifest['shards']))
+        ctx = mp.get_context('spawn')
+        mp.current_process().authkey = os.urandom(32)
+        connections, processes = [], []
+        for shard in manifest['shards']:
+            parent, child = ctx.Pipe()
+            process = ctx.Process(target=_local_worker, args=(child, shard, block_size, nprobe, ef_search,
+                                                               threads_per_shard), daemon=True)
+            process.start()
+            child.close()
+            connections.append(parent)
+            processes.append(process)
+        index = cls(connections, manifest, processes)
+        index._gather()
+        print(f"Started {len(processes)} shard workers with {threads_per_shard} threads each")
+        return index
+
+    @classmethod
+    def connect(cls, manifest_path, addresses, authkey=None):
+        """
+        連線到各節點上以 serve-shard 啟動的 shard server，addresses 依分片順序排列。
+        """
+        key = get_authkey(authkey)
+        manifest = load_manifest(manifest_path)
+        if len(addresses) != len(manifest['shards']):
+            raise ValueError(f"Got {len(addresses)} addresses for {len(manifest['shards'])} shards")
+        connections = [Client(parse_address(address), authkey=key) for address in addresses]
+        return cls(connections, manifest)
+
+    @classmethod
+    def load(cls, manifest_path, block_size=131072, nprobe=None, ef_search=None, addresses=None, **kwargs):
+        """
+        清單中有 addresses (或呼叫時給定) 就連線到遠端分片，否則啟動本機工作行程。
+        """
+        addresses = addresses or load_manifest(manifest_path).get('addresses')
+        if addresses:
+            return cls.connect(manifest_path, addresses, kwargs.get('authkey'))
+        return cls.launch(manifest_path, block_size, nprobe, ef_search, kwargs.get('threads_per_shard'))
+
+    def __len__(self):
+        return self.manifest['num_rows']
+
+    @property
+    def dim(self):
+        return self.manifest['dim']
+
+    def _gather(self):
+        results = []
+        for shard_id, connection in enumerate(self.connections):
+            try:
+                status, result = connection.recv()
+            except EOFError:
+                raise RuntimeError(f"Shard {shard_id} worker exited unexpectedly")
+            if status != 'ok':
+                raise RuntimeError(f"Shard {shard_id} failed: {result}")
+            results.append(result)
+        return results
+
+    def search(self, query_embeddings, k):
+        query_embeddings = np.ascontiguousarray(np.asarray(query_embeddings, dtype=np.float32))
+        # 先全部送出再收結果，各分片同時計算
+        for connection in self.connections:
+            connection.send((query_embeddings, k))
+        return merge_shard_results(self._gather(), k)
+
+    def close(self):
+        for connection in self.connections:
+            try:
+                connection.send(None)
+                connection.close()
+            except OSError:
+                pass
+        for process in self.processes:
+            process.join(timeout=10)
+        self.connections, self.processes = [], []
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Partition the dense index and serve it as scatter-gather shards')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    partition = subparsers.add_parser('partition', help='Split merged embeddings into row-range shards')
+    partition.add_argument('--embeddings', default='corpus_embeddings.npy')
+    partition.add_argument('--ids', default='corpus_ids', help='Doc-ID table of the merged embeddings')
+    partition.add_argument('--output-folder', required=True)
+    partition.add_argument('--num-shards', type=int, required=True)
+    partition.add_argument('--temp-output-folder', default=None,
+                           help='Temp folder of run_dense_retrieval.py; shards are cut at its per-file boundaries')
+    partition.add_argument('--no-copy', action='store_true',
+                           help='Describe shards as row ranges of the merged file instead of copying them (single machine)')
+
+    serve = subparsers.add_parser('serve-shard', help='Serve one shard over TCP for a remote coordinator')
+    serve.add_argument('--manifest', required=True)
+    serve.add_argument('--shard', type=int, required=True)
+    serve.add_argument('--address', required=True, help='host:port to listen on')
+    serve.add_argument('--authkey', default=None, help=f"Shared secret (required; or set ${AUTHKEY_ENV})")
+    serve.add_argument('--allow-remote', action='store_true',
+                       help='Listen on a non-loopback address (the authkey is the only protection; use a private network)')
+    serve.add_argument('--threads', type=int, default=None)
+    serve.add_argument('--block-size', type=int, default=131072)
+    serve.add_argument('--nprobe', type=int, default=None)
+    serve.add_argument('--ef-search', type=int, default=None)
+
+    verify = subparsers.add_parser('verify', help='Check sharded search against a single flat index')
+    verify.add_argument('--manifest', required=True)
+    verify.add_argument('--addresses', nargs='*', default=None, help='Remote shard servers (default: local workers)')
+    verify.add_argument('--authkey', default=None, help=f"Shared secret of the shard servers (or set ${AUTHKEY_ENV})")
+    verify.add_argument('--num-queries', type=int, default=100)
+    verify.add_argument('--k', type=int, default=100)
+
+    args = parser.parse_args()
+    tcp = args.command == 'serve-shard' or getattr(args, 'addresses', None)
+    if tcp and not (args.authkey or os.environ.get(AUTHKEY_ENV)):
+        parser.error(f"--authkey (or ${AUTHKEY_ENV}) is required for TCP shard servers")
+    if args.command == 'partition':
+        partition_index(args.embeddings, args.ids, args.output_folder, args.num_shards, args.temp_output_folder,
+                        copy=not args.no_copy)
+    elif args.command == 'serve-shard':
+        serve_shard(args.manifest, args.shard, args.address, args.authkey, args.block_size, args.nprobe,
+                    args.ef_search, args.threads, args.allow_remote)
+    else:
+        import time
+        from dense_search import FlatIndex
+
+        manifest = load_manifest(args.manifest)
+        flat = FlatIndex.load(manifest['source'])
+        rng = np.random.default_rng(0)
+        queries = np.array(flat.embeddings[np.sort(rng.choice(len(flat), args.num_queries, replace=False))],
+                           dtype=np.float32)
+        if flat.quant_params is not None:
+            queries = queries * flat.quant_params['scale'] + flat.quant_params['offset'] + 128 * flat.quant_params['scale']
+        start = time.time()
+        _, exact_rows = flat.search(queries, args.k)
+        flat_seconds = time.time() - start
+        index = ShardedIndex.load(args.manifest, addresses=args.addresses, authkey=args.authkey)
+        start = time.time()
+        _, rows = index.search(queries, args.k)
+        sharded_seconds = time.time() - start
+        index.close()
+        overlap = np.mean([len(np.intersect1d(a, b)) / args.k for a, b in zip(rows, exact_rows)])
+        print(f"{len(manifest['shards'])} shards: top-{args.k} overlap with the flat index {overlap:.4f} "
+              f"(flat {flat_seconds:.2f}s, sharded {sharded_seconds:.2f}s)")
+
+
+if __name__ == '__main__':
+    main()
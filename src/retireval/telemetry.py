@@ -0,0 +1,261 @@
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import socket
+import resource
+import subprocess
+from contextlib import contextmanager
+
+PROFILERS = ('cprofile', 'py-spy')
+# 設定此環境變數時 (run_pipeline.sh 會 export)，未指定 --telemetry 的階段也會寫出 <目錄>/<run_name>.<時間>.<pid>.json
+TELEMETRY_DIR_ENV = 'TELEMETRY_DIR'
+
+
+def _read_proc(path, fields):
+    """
+    讀取 /proc 下 "key: value" 格式的檔案，不支援的平台回傳 None。
+    """
+    try:
+        with open(path, 'r') as f:
+            values = dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        return None
+    return {field: int(values[field].split()[0]) for field in fields if field in values}
+
+
+def _reset_peak_rss():
+    """
+    把 VmHWM (RSS 高水位) 歸零成目前的 RSS，之後讀到的高水位就只涵蓋這個階段 (Linux 4.0+)。
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _memory_mb():
+    """
+    (目前 RSS, 高水位 RSS)，單位 MB；沒有 /proc 時以 ru_maxrss (整個行程的高水位) 代替。
+    """
+    status = _read_proc('/proc/self/status', ('VmRSS', 'VmHWM'))
+    if status and 'VmHWM' in status:
+        return status['VmRSS'] / 1024, status['VmHWM'] / 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return None, peak
+
+
+def _snapshot():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'time': time.perf_counter(),
+        'cpu': own.ru_utime + own.ru_stime,
+        # 子行程 (ProcessPoolExecutor、多工作行程編碼) 結束並被回收後才會計入
+        'child_cpu': children.ru_utime + children.ru_stime,
+        'io': _read_proc('/proc/self/io', ('rchar', 'wchar', 'read_bytes', 'write_bytes')),
+    }
+
+
+class Stage:
+    """
+    一個計時中的階段；在 with 區塊內以 add_items() 累加處理的項目數 (段落、查詢、run 檔...)。
+    """
+
+    def __init__(self, name, parent, items=None):
+        self.name = name
+        self.parent = parent
+        self.items = items
+        self.peak_rss_mb = 0.0
+        self.start_offset = None
+        self.extra = {}
+
+    def add_items(self, count):
+        self.items = (self.items or 0) + count
+
+    def set(self, **values):
+        """
+        附加階段特有的數值 (例如快取命中率)，會原樣寫入時間軸。
+        """
+        self.extra.update(values)
+
+
+class _NullStage(Stage):
+    def __init__(self):
+        super().__init__(None, None)
+
+
+class Telemetry:
+    """
+    輕量的階段計時與資源紀錄：每個 stage() 記錄牆鐘時間、處理項目數與吞吐量、CPU 使用率 (含已回收的子行程)、
+    該階段的 RSS 高水位與 I/O 位元組數 (/proc/self/io)，結束時把整個行程的時間軸寫成 JSON，
+    generate_trec_report.py 的 --timelines 可把它附在評估結果表後面。
+    stage() 可巢狀使用，子階段以 "父/子" 命名；output_path 為 None 時所有操作都是空操作，呼叫端不必判斷是否啟用。
+    profile_stage 指定的階段會另外以 cProfile (.prof，可用 snakeviz / pstats 讀取) 或 py-spy (speedscope JSON) 取樣。
+    """
+
+    def __init__(self, run_name, output_path=None, profile_stage=None, profiler='cprofile'):
+        if profiler not in PROFILERS:
+            raise ValueError(f"Unknown profiler '{profiler}', expected one of {PROFILERS}")
+        self.run_name = run_name
+        self.output_path = output_path
+        self.profile_stage = profile_stage
+        self.profiler = profiler
+        self.records = []
+        self._open = []
+        self._start = _snapshot()
+        self._started_at = time.strftime('%Y-%m-%dT%H:%M:%S')
+        if self.enabled:
+            _reset_peak_rss()
+
+    @property
+    def enabled(self):
+        return self.output_path is not None
+
+    @classmethod
+    def from_args(cls, args, run_name):
+        """
+        由 add_telemetry_args() 加入的參數建立；未指定 --telemetry 時改用 TELEMETRY_DIR 環境變數，兩者皆無則停用。
+        環境變數目錄下的檔名附上開始時間與 PID (<run_name>.<時間>.<pid>.json)，同一個階段重複執行不會互相覆蓋。
+        """
+        output_path = args.telemetry
+        if output_path is None and os.environ.get(TELEMETRY_DIR_ENV):
+            os.makedirs(os.environ[TELEMETRY_DIR_ENV], exist_ok=True)
+            output_path = os.path.join(
+                os.environ[TELEMETRY_DIR_ENV], f"{run_name}.{time.strftime('%Y%m%d-%H%M%S')}.{os.getpid()}.json"
+            )
+        return cls(run_name, output_path, args.profile_stage, args.profiler)
+
+    def _update_peaks(self):
+        _, peak = _memory_mb()
+        for stage in self._open:
+            stage.peak_rss_mb = max(stage.peak_rss_mb, peak)
+
+    @contextmanager
+    def stage(self, name, items=None):
+        if not self.enabled:
+            yield _NullStage()
+            return
+        parent = self._open[-1].name if self._open else None
+        stage = Stage(f"{parent}/{name}" if parent else name, parent, items)
+        # 先把目前的高水位記到外層階段，再歸零給這個階段使用
+        self._update_peaks()
+        _reset_peak_rss()
+        self._open.append(stage)
+        stop_profiler = self._start_profiler(stage.name) if self.profile_stage in (name, stage.name) else None
+        start = _snapshot()
+        stage.start_offset = round(start['time'] - self._start['time'], 4)
+        try:
+            yield stage
+        finally:
+            end = _snapshot()
+            if stop_profiler is not None:
+                stop_profiler()
+            self._update_peaks()
+            self._open.pop()
+            rss_mb, _ = _memory_mb()
+            self.records.append(self._record(stage, start, end, rss_mb))
+
+    def record(self, name, seconds, items=None, parent=None, **extra):
+        """
+        加入呼叫端自行計時的子階段 (例如 HybridRetriever 在每批查詢累計的 bm25 / dense / fusion 時間)；
+        只有牆鐘時間與吞吐量，沒有資源數據。
+        """
+        if not self.enabled:
+            return
+        if parent is None and self._open:
+            parent, start_offset = self._open[-1].name, self._open[-1].start_offset
+        else:
+            start_offset = round(time.perf_counter() - self._start['time'] - seconds, 4)
+        self.records.append({
+            'name': f"{parent}/{name}" if parent else name, 'parent': parent,
+            'start_offset': start_offset, 'wall_seconds': round(seconds, 4),
+            'items': items, 'items_per_second': round(items / seconds, 2) if items and seconds > 0 else None,
+            **extra,
+        })
+
+    def _record(self, stage, start, end, rss_mb):
+        wall = end['time'] - start['time']
+        cpu = end['cpu'] - start['cpu']
+        child_cpu = end['child_cpu'] - start['child_cpu']
+        record = {
+            'name': stage.name, 'parent': stage.parent,
+            'start_offset': stage.start_offset, 'wall_seconds': round(wall, 4),
+            'items': stage.items,
+            'items_per_second': round(stage.items / wall, 2) if stage.items and wall > 0 else None,
+            'cpu_seconds': round(cpu, 4), 'child_cpu_seconds': round(child_cpu, 4),
+            # 以單核為 100%，多執行緒 / 多行程時可超過 100%
+            'cpu_percent': round(100 * (cpu + child_cpu) / wall, 1) if wall > 0 else None,
+            'peak_rss_mb': round(stage.peak_rss_mb, 1),
+            'rss_mb': round(rss_mb, 1) if rss_mb is not None else None,
+        }
+        if start['io'] and end['io']:
+            # rchar/wchar 含頁快取命中的讀寫；read_bytes/write_bytes 是實際到達儲存裝置的位元組
+            record.update({f"io_{field}": end['io'][field] - start['io'][field] for field in end['io']})
+        record.update(stage.extra)
+        return record
+
+    def _start_profiler(self, stage_name):
+        base_path = f"{os.path.splitext(self.output_path)[0]}.{stage_name.replace('/', '.')}"
+        if self.profiler == 'cprofile':
+            import cProfile
+            profile = cProfile.Profile()
+            profile.enable()
+
+            def stop():
+                profile.disable()
+                profile.dump_stats(f"{base_path}.prof")
+                print(f"cProfile stats for stage '{stage_name}' written to '{base_path}.prof'", file=sys.stderr)
+            return stop
+
+        if shutil.which('py-spy') is None:
+            raise RuntimeError("py-spy profiling requires the py-spy executable: pip install py-spy")
+        # py-spy 以另一個行程附加到本行程取樣 (需要 ptrace 權限)，收到 SIGINT 後寫出 speedscope 檔
+        process = subprocess.Popen([
+            'py-spy', 'record', '--pid', str(os.getpid()), '--format', 'speedscope',
+            '--output', f"{base_path}.speedscope.json", '--subprocesses', '--nonblocking'
+        ])
+
+        def stop():
+            process.send_signal(signal.SIGINT)
+            process.wait()
+            print(f"py-spy profile for stage '{stage_name}' written to '{base_path}.speedscope.json'", file=sys.stderr)
+        return stop
+
+    def timeline(self):
+        end = _snapshot()
+        _, peak = _memory_mb()
+        return {
+            'run_name': self.run_name,
+            'host': socket.gethostname(), 'pid': os.getpid(), 'argv': sys.argv,
+            'started_at': self._started_at,
+            'wall_seconds': round(end['time'] - self._start['time'], 4),
+            'cpu_seconds': round(end['cpu'] - self._start['cpu'] + end['child_cpu'] - self._start['child_cpu'], 4),
+            'peak_rss_mb': round(max([peak] + [record.get('peak_rss_mb') or 0 for record in self.records]), 1),
+            # 依開始時間排序，同時開始的外層階段排在子階段前面
+            'stages': sorted(self.records, key=lambda record: (record['start_offset'], record['name'].count('/'))),
+        }
+
+    def close(self):
+        if not self.enabled:
+            return
+        with open(self.output_path, 'w', encoding='utf-8') as f:
+            json.dump(self.timeline(), f, indent=2)
+        print(f"Telemetry timeline written to '{self.output_path}'", file=sys.stderr)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def add_telemetry_args(parser):
+    parser.add_argument('--telemetry', default=None,
+                        help=f"Write a per-stage timing / resource timeline as JSON (default: ${TELEMETRY_DIR_ENV}/<stage>.<time>.<pid>.json)")
+    parser.add_argument('--profile-stage', default=None, help='Profile this stage (e.g. "encode", "merge" or "retrieve")')
+    parser.add_argument('--profiler', choices=PROFILERS, default='cprofile')
@@ -1,23 +1,37 @@
 import torch
 import torch.nn.functional as F
-from transformers import AutoTokenizer, AutoModel
+from transformers import AutoTokenizer
 import numpy as np
-import json
+import os
+import sys
+import argparse
 
-# --- 來自您範例的程式碼 ---
-
-# Mean Pooling - Take attention mask into account for correct averaging
-def mean_pooling(model_output, attention_mask):
-    token_embeddings = model_output[0] # First element of model_output contains all token embeddings
-    input_mask_expanded = attention_mask.unsqueeze(-1).expand(token_embeddings.size()).float()
-    return torch.sum(token_embeddings * input_mask_expanded, 1) / torch.clamp(input_mask_expanded.sum(1), min=1e-9)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src', 'retireval'))
+from doc_ids import DocIdTable
+from dense_search import read_topics, encode_queries, format_trec_run
+from hybrid_search import load_dense_index
+from search_cache import SearchCache, model_fingerprint, index_fingerprint, encode_queries_cached, search_cached
+# mean pooling 與模型加載 (PyTorch 或 ONNX Runtime / int8 後端) 與語料編碼共用同一份實作
+from encoders import mean_pooling, load_model
+from telemetry import Telemetry, add_telemetry_args
 
 # --- 主程式開始 ---
 
-def search_topics(topics_file, model_name, corpus_embeddings_path, corpus_ids_path, top_k=1000, run_name="Gemini-MiniLM-run"):
+def search_topics(topics_file, model_name, corpus_embeddings_path, corpus_ids_path, top_k=1000, run_name="Gemini-MiniLM-run",
+                  batch_size=None, block_size=131072, cache=None, backend='torch', telemetry=None):
     """
     加載查詢，與語料庫嵌入進行比較，並以 TREC 格式輸出 top-k 結果。
+    設定 batch_size 時使用批次模式：所有查詢一起編碼，語料嵌入以 mmap 分塊 (block_size 列) 掃描，
+    每塊只合併 block-local 的 top-k，一次掃描語料即可服務所有查詢。
+    批次模式的 corpus_embeddings_path 也可以是 faiss 索引或 sharded_search.py 的分片清單 (.shards.json)，
+    後者把查詢廣播給各分片的工作行程再合併 top-k。
+    也可以是 reduced_search.py 的兩階段清單 (.twostage.json)：先掃描降維副本取候選，再以完整向量重新計分；
+    或 delta_index.py 的增量索引清單 (.live.json)，此時 doc-ID 表由索引的各分段提供。
+    backend 選擇查詢編碼後端 (torch、torch-int8、onnx、onnx-int8，見 encoders.py)，須與語料編碼時一致。
+    批次模式可再傳入 SearchCache：查詢嵌入與 top-k 結果都先查快取，全部命中時連模型都不用加載。
+    telemetry (telemetry.py) 記錄模型/索引加載、查詢編碼、搜尋與輸出各階段的時間與資源。
     """
+    telemetry = telemetry or Telemetry(run_name)
     # # 檢查是否有可用的 GPU
     # device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     # print(f"Using device: {device}")
@@ -25,52 +39,91 @@ def search_topics(topics_file, model_name, corpus_embeddings_path, corpus_ids_pa
 
     # 從 HuggingFace Hub 加載模型
     print("Loading model for query encoding...")
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    model = AutoModel.from_pretrained(model_name).to(device)
-    model.eval()
+    with telemetry.stage('load_model'):
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model = None
+        if cache is None or not batch_size:
+            _, model = load_model(model_name, device, backend)
 
     # 加載預先計算好的語料庫嵌入和 ID
     print("Loading corpus index...")
-    corpus_embeddings = torch.from_numpy(np.load(corpus_embeddings_path)).to(device)
-    with open(corpus_ids_path, 'r', encoding='utf-8') as f:
-        corpus_ids = json.load(f)
-    
+    # doc-ID 表以 mmap 加載，只在輸出 top-k 時才組回 docid 字串 (也接受舊的 JSON 清單)
+    with telemetry.stage('load_index'):
+        corpus_ids = DocIdTable.load(corpus_ids_path)
+        if batch_size:
+            index = load_dense_index(corpus_embeddings_path, block_size=block_size)
+            corpus_ids = getattr(index, 'corpus_ids', corpus_ids)
+
+    if batch_size:
+        print(f"Loaded {len(index)} document embeddings.")
+
+        print(f"Processing queries from '{topics_file}'...")
+        topics = read_topics(topics_file)
+        query_texts = [query_text for _, query_text in topics]
+        if cache is None:
+            with telemetry.stage('encode', items=len(query_texts)):
+                query_embeddings = encode_queries(query_texts, tokenizer, model, device, batch_size)
+            with telemetry.stage('search', items=len(query_texts)):
+                scores, rows = index.search(query_embeddings, top_k)
+        else:
+            def encode_missing(texts):
+                # 只有快取沒命中時才加載模型
+                nonlocal model
+                if model is None:
+                    _, model = load_model(model_name, device, backend)
+                return encode_queries(texts, tokenizer, model, device, batch_size).numpy()
+
+            with telemetry.stage('encode', items=len(query_texts)):
+                query_embeddings = encode_queries_cached(cache, model_fingerprint(model_name, tokenizer, backend=backend), query_texts, encode_missing)
+            with telemetry.stage('search', items=len(query_texts)):
+                scores, rows = search_cached(cache, index_fingerprint(corpus_embeddings_path), query_embeddings, top_k, index.search)
+            print(f"Cache: {cache.summary()}")
+        with telemetry.stage('write', items=len(topics)):
+            for line in format_trec_run([query_id for query_id, _ in topics], scores, rows, corpus_ids, run_name):
+                print(line, flush=False)
+        return
+
+    with telemetry.stage('load_embeddings'):
+        corpus_embeddings = torch.from_numpy(np.load(corpus_embeddings_path)).to(device)
     print(f"Loaded {len(corpus_ids)} document embeddings.")
 
     # 讀取並處理查詢
     print(f"Processing queries from '{topics_file}'...")
-    with open(topics_file, 'r', encoding='utf-8') as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
+    # 逐一查詢時編碼、搜尋與輸出交錯進行，整段記為一個階段
+    with telemetry.stage('search') as stage:
+        with open(topics_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
             
-            # 分割 queryid 和 query text
-            query_id, query_text = line.split('\t', 1)
-            # breakpoint()
+                # 分割 queryid 和 query text
+                query_id, query_text = line.split('\t', 1)
+                stage.add_items(1)
+                # breakpoint()
             
-            # --- 編碼單個查詢 ---
-            encoded_input = tokenizer([query_text], padding=True, truncation=True, return_tensors='pt').to(device)
-            with torch.no_grad():
-                model_output = model(**encoded_input)
-            query_embedding = mean_pooling(model_output, encoded_input['attention_mask'])
-            query_embedding = F.normalize(query_embedding, p=2, dim=1)
-
-            # --- 進行向量搜尋 ---
-            # 使用矩陣乘法高效計算餘弦相似度 (因為向量都已標準化)
-            # (1, dim) @ (dim, N) -> (1, N)
-            cos_scores = torch.mm(query_embedding, corpus_embeddings.T)[0]
-
-            # 獲取 top-k 結果
-            top_results = torch.topk(cos_scores, k=min(top_k, len(corpus_ids)), largest=True)
-
-            # --- 以 TREC 格式輸出 ---
-            # 格式: query_id Q0 document_id rank score run_name
-            for rank, (score, idx) in enumerate(zip(top_results.values, top_results.indices), 1):
-                doc_id = corpus_ids[idx.item()]
-                # print(f"{query_id} Q0 {doc_id} {rank} {score.item():.4f} {run_name}")
-                # 直接寫入檔案，避免大量print造成效能問題
-                print(f"{query_id} Q0 {doc_id} {rank} {score.item():.4f} {run_name}", flush=False)
+                # --- 編碼單個查詢 ---
+                encoded_input = tokenizer([query_text], padding=True, truncation=True, return_tensors='pt').to(device)
+                with torch.no_grad():
+                    model_output = model(**encoded_input)
+                query_embedding = mean_pooling(model_output, encoded_input['attention_mask'])
+                query_embedding = F.normalize(query_embedding, p=2, dim=1)
+
+                # --- 進行向量搜尋 ---
+                # 使用矩陣乘法高效計算餘弦相似度 (因為向量都已標準化)
+                # (1, dim) @ (dim, N) -> (1, N)
+                cos_scores = torch.mm(query_embedding, corpus_embeddings.T)[0]
+
+                # 獲取 top-k 結果
+                top_results = torch.topk(cos_scores, k=min(top_k, len(corpus_ids)), largest=True)
+
+                # --- 以 TREC 格式輸出 ---
+                # 格式: query_id Q0 document_id rank score run_name
+                top_doc_ids = corpus_ids.decode(top_results.indices.numpy())
+                for rank, (score, doc_id) in enumerate(zip(top_results.values, top_doc_ids), 1):
+                    # print(f"{query_id} Q0 {doc_id} {rank} {score.item():.4f} {run_name}")
+                    # 直接寫入檔案，避免大量print造成效能問題
+                    print(f"{query_id} Q0 {doc_id} {rank} {score.item():.4f} {run_name}", flush=False)
 
 
 if __name__ == '__main__':
@@ -80,11 +133,29 @@ if __name__ == '__main__':
     CORPUS_EMBEDDINGS_FILE = './test/test_embeddings.npy'
     CORPUS_IDS_FILE = './test/test_corpus_ids.json'
     TOP_K = 1000
+    # 查詢編碼的批次大小 (設為 None 則逐一查詢)，以及每次掃描的語料列數
+    BATCH_SIZE = 256
+    BLOCK_SIZE = 131072
+    # 查詢嵌入 / 結果快取的位置與大小上限取自 data_config.yaml 的 storage 設定 (設為 None 則不使用快取)
+    DATA_CONFIG = 'configs/data_config.yaml'
+    # 查詢編碼後端，須與建立語料嵌入時 run_dense_retrieval.py 的 --backend 相同
+    BACKEND = 'torch'
+
+    # 其餘設定沿用上面的常數，命令列只接受 telemetry 的參數 (--telemetry / --profile-stage / --profiler)
+    parser = argparse.ArgumentParser(description='Dense search over precomputed corpus embeddings')
+    add_telemetry_args(parser)
+    telemetry = Telemetry.from_args(parser.parse_args(), 'dense_search')
     
     search_topics(
         topics_file=TOPICS_FILE,
         model_name=MODEL_NAME,
         corpus_embeddings_path=CORPUS_EMBEDDINGS_FILE,
         corpus_ids_path=CORPUS_IDS_FILE,
-        top_k=TOP_K
-    )
\ No newline at end of file
+        top_k=TOP_K,
+        batch_size=BATCH_SIZE,
+        block_size=BLOCK_SIZE,
+        cache=SearchCache.from_config(DATA_CONFIG) if DATA_CONFIG else None,
+        backend=BACKEND,
+        telemetry=telemetry
+    )
+    telemetry.close()
\ No newline at end of file